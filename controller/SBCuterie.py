@@ -13,16 +13,74 @@ import os
 
 # import json
 import sys
+import asyncio
+import atexit
+import sqlite3
 import time
 import datetime
-import smtplib, ssl, email.message  # Keep this in here and add email functions for various notifications.
-import sqlite3
 
 # Local project file imports
 import modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
-from modules.AHT20 import AHT20  # Lib for AHT20 sensors
+from modules.AHT20 import (  # Lib for AHT20 sensors
+    AHT20CRCError,
+    AHT20PollStrategy,
+    AHT20TimeoutError,
+)
+from modules.sensor_registry import SensorRegistry  # One initialized AHT20 per mux lane
 from modules.grove_i2c_relay_regular import RELAY  # Lib for I2C relays
 import modules.TCA9548A as TCA9548  # Lib for I2C MUX
+import modules.i2c_bus as I2C  # Shared long-lived I2C bus handles for the libs above
+from modules.log_writer import LogWriter  # Buffered, batched writes to the SQLite logs
+from modules.timers import ActuatorTimers, TimerScheduler  # Humidifier pulses, lockouts, duty cycles
+from modules.alerts import AlertDispatcher  # Queued, deduplicated alert emails
+from modules.retention import RetentionEngine  # Ages out and compacts the logs in small slices
+from modules.settings_cache import SettingsCache  # In-memory settings profiles, reloaded on change
+from modules.schedule import schedule_enabled  # Compiled SCHEDULE timelines
+from modules.runtime import Runtime  # asyncio tasks, executors and per-task lag
+from modules.controller import Readings, build_controller  # The control decisions, no I/O
+from modules.quorum import QUORUM_NO_AGREEMENT, quorum, reading  # N sensor agreement
+from modules.sensor_bias import SensorBiasTracker  # Per sensor bias and drift against the quorum
+from modules.estimator import ChamberEstimator  # Filtered chamber estimate from all the sensors
+from modules.thermal_model import fit_from_history  # Learned chamber model for predictive control
+
+#
+# Hardware
+#
+
+# One stateful mux object so selecting the lane we are already on is free.
+mux = TCA9548.get_mux(
+    I2CBus=CONST.I2C_BUS,
+    multiplexer_addr=CONST.I2C_MUX_ADDR,
+    debug_status=CONST.DEBUG_STATUS,
+)
+# One long-lived relay board object, see get_relay().
+relay = None
+# How the AHT20s wait for their conversions to finish.
+aht20_poll_strategy = AHT20PollStrategy(
+    initial_wait=CONST.AHT20_POLL_INITIAL_WAIT,
+    poll_interval=CONST.AHT20_POLL_INTERVAL,
+    timeout=CONST.AHT20_POLL_TIMEOUT,
+)
+# Each AHT20 is soft reset and calibration checked once, then again only after errors.
+sensor_registry = SensorRegistry(
+    mux,
+    I2CBusNum=CONST.I2C_BUS,
+    poll_strategy=aht20_poll_strategy,
+    reset_interval=CONST.AHT20_RESET_INTERVAL,
+    debug_status=CONST.DEBUG_STATUS,
+)
+# Buffered log writer, see get_log_writer().
+log_writer = None
+# Cached settings profiles, see get_settings_cache().
+settings_cache = None
+# Background alert mailer, see get_alert_dispatcher().
+alert_dispatcher = None
+# Timed actuator actions, see get_actuator_timers().
+actuator_timers = None
+# Sensor bias and drift statistics, see get_sensor_bias().
+sensor_bias = None
+# Filtered temperature/humidity estimate, see get_chamber_estimator().
+chamber_estimator = None
 
 #
 # Functions
@@ -39,7 +97,7 @@ def touch(fname):
         open(fname, "a").close()
 
 
-def load_db_values(ID):
+def load_db_values(ID=None):
     """
     This function is called at script initialization and loads operating values
     from a local SQLite DB and makes them available throughout the script.
@@ -63,228 +121,138 @@ def load_db_values(ID):
         GoogleSheetID  # Not yet - For the current google spreadsheet we are logging to and "value" is a key in another table for the sheet config
         ScheduleStatus # Are we running a scheduled curing profile or static targets?
         ScheduleID # What Schedule are we running?
+
+    ID None means the active profile (the ACTIVEPROFILE table).  Profiles are
+    served from the in-memory settings cache, see get_settings_cache().
     """
-    setting_id = ID
-    conn = sqlite3.connect("SBCuterieDB.db")
-    query = conn.execute(
-        "SELECT ProfileLabel,AirPumpDuty,AirPumpIdleTime,LogServerStatus,NotificationEmail,ReportingConfig,ScheduleStatus,ScheduleID from CTRLSETTING WHERE ID = ?",
-        (setting_id),
-    )
-    query2 = conn.execute(
-        "SELECT CurrentTempSetPoint,CurrentTempMaxOvershoot,CurrentHumiditySetpoint,CurrentHumidityMaxOvershoot,ControlHumidity from ENVSETTING WHERE ID = ?",
-        (setting_id),
-    )
-    conn.close()
-    return {
-        "ProfileLabel": query[0],
-        "AirPumpDuty": query[1],
-        "AirPumpIdleTime": query[2],
-        "LogServerStatus": query[3],
-        "NotificationEmail": query[4],
-        "ReportingConfig": query[5],
-        "ScheduleStatus": query[6],
-        "ScheduleID": query[7],
-        "CurrentTempSetPoint": query2[0],
-        "CurrentTempMaxOvershoot": query2[1],
-        "CurrentHumiditySetpoint": query2[2],
-        "CurrentHumidityMaxOvershoot": query2[3],
-        "ControlHumidity": query2[4],
-    }
+    return get_settings_cache().get(ID)
 
 
-def quorum_check(value_x, value_y, value_z, delta_max):
-    """
-    Quorum Checking function
-    Requires 3 input values and a max allowed delta between sensors as args.
-    Checks all 3 values against each other and max delta to determine if sensor has
-    failed or is way out of agreement with the other two.
-    Returns a "Return Code" and a value.
-    Return Codes:
-    0 - All sensors agree,
-    1 - sensor x out of spec,
-    2 - sensor y out of spec,
-    3 - sensor z out of spec,
-    4 - no sensors agree, you should error out/email/alarm/etc.
-    5 - sensors agree in pairs but spread across all 3 exceeds delta
-    """
-    # Reset values
-    agree_xy = False
-    agree_xz = False
-    agree_yz = False
-
-    x_min = value_x - delta_max
-    x_max = value_x + delta_max
-    y_min = value_y - delta_max
-    y_max = value_y + delta_max
-
-    # Check for agreement between pairs
-    if x_min <= value_y <= x_max:
-        agree_xy = True
-    if x_min <= value_z <= x_max:
-        agree_xz = True
-    if y_min <= value_z <= y_max:
-        agree_yz = True
-
-    # Evaluate if all sensors either disagree or agree
-    if not (agree_xy) and not (agree_xz) and not (agree_yz):
-        val = 0
-        return_val = [4, val]
-        return return_val  # Set this to return error code stating none of the sensors agree
-
-    if agree_xy and agree_xz and agree_yz:
-        val = (value_x + value_y + value_z) / 3
-        val = round(val, 1)
-        return_val = [0, val]
-        return (
-            return_val  # Set this to return all good code and average of all 3 sensors
+def get_settings_cache():
+    """
+    Return the settings cache, loading every profile on first use.  Call its
+    refresh() each tick to pick up edits committed to the DB.
+    """
+    global settings_cache
+    if settings_cache is None:
+        settings_cache = SettingsCache(
+            CONST.DB_FILE,
+            default_profile=CONST.DEFAULT_PROFILE_ID,
+            ramp_step=CONST.SCHEDULE_RAMP_STEP,
         )
+    return settings_cache
+
+
+def get_active_schedule(schedule_status, schedule_id):
+    """
+    The compiled schedule the active profile runs, None when it uses the static
+    ENVSETTING setpoints.  Compiled once and kept until its SCHEDULE rows change.
+    """
+    if not schedule_enabled(schedule_status):
+        return None
+    return get_settings_cache().get_schedule(schedule_id)
 
-    # Catch edge case of agreement between two separate pairs but not the third.
-    # For this case also return an average of all 3.
-    if (
-        (agree_xy and agree_yz and not agree_xz)
-        or (agree_yz and agree_xz and not agree_xy)
-        or (agree_xy and agree_xz and not agree_yz)
-    ):
-        val = (value_x + value_y + value_z) / 3
-        val = round(val, 1)
-        return_val = [5, val]
-        return return_val  # Set this to return all large spread code and average of all 3 sensors
-
-    # If we flow through all the previous checks, identify which sensor is out of line with quorum.
-    if agree_xy and not agree_yz and not agree_xz:
-        val = (value_x + value_y) / 2
-        val = round(val, 1)
-        return_val = [3, val]
-        return return_val  # Set this to return one bad sensor code for sensor z and average of 2 remaining sensors
-
-    if not agree_xy and agree_yz and not agree_xz:
-        val = (value_y + value_z) / 2
-        val = round(val, 1)
-        return_val = [1, val]
-        return return_val  # Set this to return one bad sensor code for sensor x and average of 2 remaining sensors
-
-    if not agree_xy and not agree_yz and agree_xz:
-        val = (value_x + value_z) / 2
-        val = round(val, 1)
-        return_val = [2, val]
-        return return_val  # Set this to return one bad sensor code for sensor y and average of 2 remaining sensors
+
+def read_with_crc_retries(mux_channel, read):
+    """
+    Call one of the AHT20 read functions, retrying it up to
+    CONST.AHT20_CRC_RETRIES times if the measure frame fails its CRC check
+    before the AHT20CRCError is passed up.
+    """
+    for attempt in range(CONST.AHT20_CRC_RETRIES + 1):
+        try:
+            return read()
+        except AHT20CRCError as e:
+            sys.stderr.write(
+                "MUX channel " + str(mux_channel) + " sensor: " + str(e) + "\n"
+            )
+            if attempt == CONST.AHT20_CRC_RETRIES:
+                raise
+
+
+def read_aht20(mux_channel):
+    """
+    Select the MUX lane for one AHT20 and take a single conversion from it.
+    Returns (temperature, humidity) from the same measure frame.
+    """
+    with I2C.get_bus(CONST.I2C_BUS):  # Hold the bus from the mux switch until the sensor is read
+        try:
+            sensor = sensor_registry.select(mux_channel)
+            return read_with_crc_retries(mux_channel, sensor.read)
+        except (OSError, AHT20CRCError, AHT20TimeoutError):
+            sensor_registry.mark_error(mux_channel)  # Soft reset it next time round
+            mux.resync()  # The mux may have been reset by whatever upset the bus
+            raise
+
+
+def sample_aht20s(mux_channels):
+    """
+    Pipelined read of several AHT20s.  Every sensor is switched to and told to
+    start a conversion without waiting, then we come back round and collect
+    each frame, so the conversions overlap instead of running back to back.
+    Returns a list of (temperature, humidity) in the order of mux_channels.
+    """
+    if not CONST.AHT20_PIPELINED_SAMPLING:
+        return [read_aht20(mux_channel) for mux_channel in mux_channels]
+
+    with I2C.get_bus(CONST.I2C_BUS):  # Nobody else gets the mux until every sensor is collected
+        mux_channel = None
+        try:
+            sensors = []
+            for mux_channel in mux_channels:
+                sensor = sensor_registry.select(mux_channel)
+                sensor.trigger_measure()
+                sensors.append(sensor)
+
+            readings = []
+            for mux_channel, sensor in zip(mux_channels, sensors):
+                mux.select(mux_channel)
+                readings.append(read_with_crc_retries(mux_channel, sensor.collect))
+            return readings
+        except (OSError, AHT20CRCError, AHT20TimeoutError):
+            sensor_registry.mark_error(mux_channel)  # Soft reset it next time round
+            mux.resync()  # The mux may have been reset by whatever upset the bus
+            raise
 
 
 def get_sensor_data():
     """
     Get Sensor Data
-    In this block we will read 3 temp/humidity sensors, call quorum
-    function and report readings and/or error conditions.  We require the MUX
-    lane (1/2/3/4/5/6/7/8) for sensors A/B/C set in the globals as well as max
-    drift between two sensors beyond which we consider a sensor to be in error.
-    Select the appropriate mux port for each AHT20 sensor then read the values,
-    check for quorum, return values.
+    In this block we will read the temp/humidity sensors, check them for
+    quorum and report readings and/or error conditions.  The MUX lanes of the
+    sensors are CONST.AHT20_MUX_CHANS (three as shipped, add more there) and
+    the max drift beyond which a sensor is considered in error is
+    MAX_TEMP_SENSOR_DRIFT/MAX_HUMI_SENSOR_DRIFT, see modules/quorum.py.
+    With CONST.CHAMBER_ESTIMATOR on the values returned are the filtered
+    estimate of the sensors quorum kept, see modules/estimator.py.
     DEV NOTE: Remember to set handling for exceptional errors.
     """
-    TCA9548.i2c_mux_channel(
-        I2CBus=CONST.I2C_BUS,
-        multiplexer_addr=CONST.I2C_MUX_ADDR,
-        i2c_channel_setup=CONST.AHTX_MUX_CHAN,
-        debug_status=CONST.DEBUG_STATUS,
-    )
-    sensor_a = AHT20(I2CBusNum=CONST.I2C_BUS)
-    sensor_a_hum = sensor_a.get_humidity()
-    sensor_a_temp = sensor_a.get_temperature()
-
-    TCA9548.i2c_mux_channel(
-        I2CBus=CONST.I2C_BUS,
-        multiplexer_addr=CONST.I2C_MUX_ADDR,
-        i2c_channel_setup=CONST.AHTY_MUX_CHAN,
-        debug_status=CONST.DEBUG_STATUS,
-    )
-    sensor_b = AHT20(I2CBusNum=CONST.I2C_BUS)
-    sensor_b_hum = sensor_b.get_humidity()
-    sensor_b_temp = sensor_b.get_temperature()
-
-    TCA9548.i2c_mux_channel(
-        I2CBus=CONST.I2C_BUS,
-        multiplexer_addr=CONST.I2C_MUX_ADDR,
-        i2c_channel_setup=CONST.AHTZ_MUX_CHAN,
-        debug_status=CONST.DEBUG_STATUS,
-    )
-    sensor_c = AHT20(I2CBusNum=CONST.I2C_BUS)
-    sensor_c_hum = sensor_c.get_humidity()
-    sensor_c_temp = sensor_c.get_temperature()
-
+    readings = sample_aht20s(CONST.AHT20_MUX_CHANS)
     last_sensor_read_time = datetime.datetime.now()
+    tracker = get_sensor_bias()
 
-    temp_check = quorum_check(
-        sensor_a_temp, sensor_b_temp, sensor_c_temp, CONST.MAX_TEMP_SENSOR_DRIFT
-    )
-    hum_check = quorum_check(
-        sensor_a_hum, sensor_b_hum, sensor_c_hum, CONST.MAX_HUMI_SENSOR_DRIFT
-    )
-
-    if temp_check[0] == 0:
-        # All sensors agree
-        return_temp = temp_check[1]
-        return_temp_code = "Good"
-    if temp_check[0] == 1:
-        # Sensor X Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor X Disagrees"
-        sys.stderr.write("Temperature Sensor X disagrees with other two.")
-    if temp_check[0] == 2:
-        # Sensor Y Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor Y Disagrees"
-        sys.stderr.write("Temperature Sensor Y disagrees with other two.")
-    if temp_check[0] == 3:
-        # Sensor Z Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor Z Disagrees"
-        sys.stderr.write("Temperature Sensor Z disagrees with other two.")
-    if temp_check[0] == 4:
-        # No sensors agree
-        return_temp = 0
-        return_temp_code = "No Sensors Agree"
-        sys.stderr.write("None of the Termperature Sensors agree.")
-    if temp_check[0] == 5:
-        # 2 pair agreement, spread > MAX_DRIFT but average usable
-        return_temp = temp_check[1]
-        return_temp_code = "Large Spread"
-        sys.stderr.write(
-            "Range Across All Temperature Sensors exceeds max delta but pairs good."
-        )
-
-    if hum_check[0] == 0:
-        # All sensors agree
-        return_hum = hum_check[1]
-        return_hum_code = "Good"
-    if hum_check[0] == 1:
-        # Sensor X Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor X Disagrees"
-        sys.stderr.write("Humidity Sensor X disagrees with other two.")
-    if hum_check[0] == 2:
-        # Sensor Y Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor Y Disagrees"
-        sys.stderr.write("Humidity Sensor Y disagrees with other two.")
-    if hum_check[0] == 3:
-        # Sensor Z Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor Z Disagrees"
-        sys.stderr.write("Humidity Sensor Z disagrees with other two.")
-    if hum_check[0] == 4:
-        # No sensors agree
-        return_hum = 0
-        return_hum_code = "No Sensors Agree"
-        sys.stderr.write("None of the Humidity Sensors agree.")
-    if hum_check[0] == 5:
-        # 2 pair agreement, spread > MAX_DRIFT but average usable
-        return_hum = hum_check[1]
-        return_hum_code = "Large Spread"
-        sys.stderr.write(
-            "Range Across All Humidity Sensors exceeds max delta but pairs good."
-        )
+    results = []
+    for name, values, delta_max in (
+        ("Temperature", [reading[0] for reading in readings], CONST.MAX_TEMP_SENSOR_DRIFT),
+        ("Humidity", [reading[1] for reading in readings], CONST.MAX_HUMI_SENSOR_DRIFT),
+    ):
+        corrected = tracker.correct(CONST.AHT20_SENSOR_NAMES, name, values)
+        result = quorum(corrected, delta_max, CONST.QUORUM_MAD_THRESHOLD)
+        code, value = reading(name, result, CONST.AHT20_SENSOR_NAMES, values)
+        if result.code != QUORUM_NO_AGREEMENT:
+            if CONST.CHAMBER_ESTIMATOR:
+                estimate = get_chamber_estimator().update(
+                    name,
+                    corrected,
+                    result.inliers,
+                    tracker.noise(CONST.AHT20_SENSOR_NAMES, name),
+                )
+                value = round(estimate.value, 2)
+            for sensor in tracker.update(CONST.AHT20_SENSOR_NAMES, name, values, result.median):
+                report_degrading_sensor(sensor, name)
+        results.append((code, value))
 
+    (return_temp_code, return_temp), (return_hum_code, return_hum) = results
     return (
         last_sensor_read_time,
         return_temp_code,
@@ -294,11 +262,88 @@ def get_sensor_data():
     )
 
 
+def get_sensor_bias():
+    """
+    Return the sensor bias/drift tracker, loading what it learned before the
+    last restart on first use, see modules/sensor_bias.py.
+    """
+    global sensor_bias
+    if sensor_bias is None:
+        sensor_bias = SensorBiasTracker(
+            get_log_writer(),
+            limits={
+                "Temperature": CONST.MAX_TEMP_SENSOR_DRIFT,
+                "Humidity": CONST.MAX_HUMI_SENSOR_DRIFT,
+            },
+            bias_half_life=CONST.SENSOR_BIAS_HALF_LIFE,
+            drift_half_life=CONST.SENSOR_DRIFT_HALF_LIFE,
+            horizon=CONST.SENSOR_DRIFT_HORIZON,
+            apply_offsets=CONST.SENSOR_BIAS_APPLY_OFFSETS,
+        )
+    return sensor_bias
+
+
+def get_chamber_estimator():
+    """
+    Return the chamber estimator, creating it on first use.  It only keeps a
+    few numbers per quantity and starts over after a restart.
+    """
+    global chamber_estimator
+    if chamber_estimator is None:
+        chamber_estimator = ChamberEstimator(
+            CONST.ESTIMATOR_SENSOR_NOISE,
+            CONST.ESTIMATOR_PROCESS_NOISE,
+            confidence=CONST.ESTIMATOR_CONFIDENCE,
+            max_gap=10 * CONST.SLEEP_SECONDS,
+        )
+    return chamber_estimator
+
+
+def report_degrading_sensor(sensor, quantity):
+    """
+    Warn that a sensor is wandering away from the others before quorum
+    starts rejecting it.
+    """
+    stats = get_sensor_bias().stats[(sensor, quantity)]
+    body = "{} sensor {} looks to be degrading: {}".format(
+        quantity, sensor, ", ".join(stats.reasons)
+    )
+    sys.stderr.write(body + "\n")
+    get_log_writer().log_event(body)
+    send_alert("Chamber Sensor Degrading", body)
+
+
+def get_relay():
+    """
+    Return the relay board object, creating it on first use.  It lives for the
+    whole run so its shadow of the channel mask stays valid.  Creating a RELAY
+    clears every relay on the board, so this must only happen once.
+    """
+    global relay
+    if relay is None:
+        with I2C.get_bus(CONST.I2C_BUS):
+            try:
+                # Assume by default the relays are plugged into the first output port
+                mux.select(CONST.OUT1_MUX_CHAN)
+                relay = RELAY(
+                    i2cbus=CONST.I2C_BUS,
+                    device_address=CONST.RELAY_DEV_ADDRESS,
+                    num_relays=4,
+                    debug_action=CONST.DEBUG_STATUS,
+                )
+            except OSError:
+                mux.resync()
+                raise
+    return relay
+
+
 def set_device_status(device, setting):
     """
     This function sets the relay status for the appropriate device.
     Uses globals for the appropriate I2C addresses and values to
     reference the appropriate relay.
+    The change is only staged in the relay shadow mask, call
+    apply_device_status() to write every change from this tick in one go.
     Devices:
         heating
         cooling
@@ -310,24 +355,16 @@ def set_device_status(device, setting):
         ON
         OFF
     """
-    TCA9548.i2c_mux_channel(
-        I2CBus=CONST.I2C_BUS,
-        multiplexer_addr=CONST.I2C_MUX_ADDR,
-        i2c_channel_setup=8,  # Assume by default the relays are plugged into the last port
-        debug_status=CONST.DEBUG_STATUS,
-    )
-    relay = RELAY(
-        i2cbus=CONST.I2C_BUS,
-        device_address=CONST.RELAY_DEV_ADDRESS,
-        num_relays=4,
-        debug_action=CONST.DEBUG_STATUS,
-    )
-
-    if setting == "ON":
-        relay.channel_on(CONST.RELAY_NUM[device])
-
-    if setting == "OFF":
-        relay.channel_off(CONST.RELAY_NUM[device])
+    if setting == "ON" and get_actuator_timers().is_locked_out(device):
+        # Still inside its minimum off time (compressor protection), it stays off
+        if CONST.DEBUG_STATUS:
+            print(
+                device + " locked out for",
+                int(get_actuator_timers().lockout_remaining(device)),
+                "s more",
+            )
+        setting = "OFF"
+    get_relay().stage_channel(CONST.RELAY_NUM[device], setting == "ON")
 
     if CONST.DEBUG_STATUS:
         print("Set " + device + " status to " + setting + " at " + time.strftime("%c"))
@@ -335,414 +372,476 @@ def set_device_status(device, setting):
     return time.time()
 
 
+def device_locked_out(device):
+    # True while device is held off by its minimum off lockout, for the controller's arbiter
+    return get_actuator_timers().is_locked_out(device)
+
+
+def device_setting(device):
+    # What the last board write left device at, "ON" or "OFF"
+    return "ON" if get_relay().channel_state & (1 << (CONST.RELAY_NUM[device] - 1)) else "OFF"
+
+
+def apply_device_status():
+    """
+    Write the relay mask staged by set_device_status() to the board as a
+    single transaction.  Nothing is written if the mask has not changed.
+    Each relay that switched is logged for the duty cycle accounting, see
+    modules/duty.py.
+    """
+    board = get_relay()
+    if board.pending_state == board.channel_state:
+        return False
+    switched = board.channel_state ^ board.pending_state
+    turned_off = board.channel_state & ~board.pending_state
+    with I2C.get_bus(CONST.I2C_BUS):  # Hold the bus from the mux switch until the relays are set
+        try:
+            mux.select(CONST.OUT1_MUX_CHAN)
+            written = board.commit()
+        except OSError:
+            mux.resync()
+            raise
+    # Devices that really went off start their minimum off time, not before the write
+    # succeeded or a failed write would lock out a compressor that is still running
+    for device, seconds in CONST.MINIMUM_OFF_TIME.items():
+        if turned_off & (1 << (CONST.RELAY_NUM[device] - 1)):
+            get_actuator_timers().lock_out(device, seconds)
+    for device, relay_num in CONST.RELAY_NUM.items():
+        if switched & (1 << (relay_num - 1)):
+            get_log_writer().log_relay(device, turned_off & (1 << (relay_num - 1)) == 0)
+    return written
+
+
+def get_actuator_timers():
+    """
+    Return the actuator timers (humidifier pulses, minimum off lockouts, the air
+    pump cycle), creating them and their scheduler on first use.  Timers fire
+    while the main loop waits out a tick, see TimerScheduler.run_until().
+    """
+    global actuator_timers
+    if actuator_timers is None:
+        actuator_timers = ActuatorTimers(
+            TimerScheduler(), set_device_status, apply_device_status
+        )
+    return actuator_timers
+
+
+def get_log_writer():
+    """
+    Return the buffered SQLite log writer, creating it (and its one long-lived
+    connection) on first use.
+    """
+    global log_writer
+    if log_writer is None:
+        log_writer = LogWriter(
+            CONST.DB_FILE,
+            flush_rows=CONST.LOG_FLUSH_ROWS,
+            flush_interval=CONST.LOG_FLUSH_INTERVAL,
+            synchronous=CONST.LOG_SYNCHRONOUS,
+            auto_flush=False,  # Flushed by whoever owns the writer, see the logging task
+        )
+    return log_writer
+
+
 def write_logs(temperature, humidity, event):
     """
     Support for future gsheets logging, syslog, whatever will get added here, alerts is send_alert function.
     Default always writes to local SQLite DB, others are potential extras.
+    Rows are queued and written in batches, see modules/log_writer.py.
+    """
+    get_log_writer().write(temperature, humidity, event, devices_on=relay_devices_on())
+
+
+def relay_devices_on():
+    """
+    The set of devices whose relay is on in the current (staged) relay mask,
+    recorded with each ENVIROLOG row for the duty cycle rollups.  None until
+    the relay board has been set up.
+    """
+    if relay is None:
+        return None
+    return {
+        device
+        for device, relay_num in CONST.RELAY_NUM.items()
+        if relay.pending_state & (1 << (relay_num - 1))
+    }
+
+
+def close_logs():
+    """
+    Flush any queued log rows and close the DB connection, called at exit.
+    The sensor bias statistics are saved first.
+    """
+    if log_writer is not None:
+        if sensor_bias is not None:
+            sensor_bias.save()
+        log_writer.close()
+
+
+def get_alert_dispatcher():
+    """
+    Return the alert dispatcher, starting its worker thread on first use.
     """
-    conn = sqlite3.connect("SBCuterieDB.db")
-    sql1 = """ INSERT into ENVIROLOG (Time, Temperature, Humidity) VALUES (?,?,?) """
-    sql2 = """ INSERT into EVENTLOG (Time, Event) VALUES (?,?) """
-    ct = datetime.now()
-    timestamp = datetime.timestamp(ct)
-    conn.execute(sql1, (timestamp, temperature, humidity))
-    conn.execute(sql2, (timestamp, event))
-    conn.close()
+    global alert_dispatcher
+    if alert_dispatcher is None:
+        alert_dispatcher = AlertDispatcher(
+            CONST.SMTP_SERVER,
+            CONST.SMTP_PORT,
+            CONST.SENDER_EMAIL,
+            password=CONST.EMAIL_PASSWORD,
+            queue_size=CONST.ALERT_QUEUE_SIZE,
+            dedup_window=CONST.ALERT_DEDUP_WINDOW,
+            max_retries=CONST.ALERT_MAX_RETRIES,
+        )
+        alert_dispatcher.start()
+    return alert_dispatcher
 
 
 def send_alert(subject, body):
     """
     Function to send alerts via various means.
     Email as default but future additional options can be added here
+    Alerts are queued and sent from a background thread so a slow or dead mail
+    server never holds up the control loop, see modules/alerts.py.
     """
-    msg = email.message.Message()
-    msg["From"] = CONST.SENDER_EMAIL
-    msg["To"] = NotificationEmail
-    msg["Subject"] = subject
-    msg.set_payload(body)
-
-    context = ssl.create_default_context()
     try:
-        server = smtplib.SMTP(CONST.SMTP_SERVER, CONST.SMTP_PORT)
-        server.starttls(context=context)  # Secure the connection
-        server.login(CONST.SENDER_EMAIL, CONST.EMAIL_PASSWORD)
-        server.sendmail(CONST.SENDER_EMAIL, NotificationEmail, msg.as_string)
-    except Exception as e:
-        # Print any error messages to stderr
-        sys.stderr.write(e)
-    finally:
-        server.quit()
+        to = load_db_values()["NotificationEmail"]
+    except (KeyError, sqlite3.Error):  # No settings yet, mail ourselves
+        to = CONST.SENDER_EMAIL
+    get_alert_dispatcher().send(subject, body, to)
+
+
+def stop_alerts():
+    """
+    Give queued alerts a last chance to go out at shutdown.
+    """
+    if alert_dispatcher is not None:
+        alert_dispatcher.stop()
 
 
 # #######################################################################################
-#     Main loop
+#     Control
 # #######################################################################################
 
-# only allow one instance
-try:
-    import socket
-
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-    # Create an abstract socket, by prefixing it with null.
-    s.bind("\0postconnect_gateway_notify_lock")
-except socket.error as e:
-    error_code = e.args[0]
-    error_string = e.args[1]
-    print("Process already running (%d:%s ). Exiting" % (error_code, error_string))
-    send_alert("Picuterie Startup failed, already running", error_string)
-    sys.exit(0)
-
-# OK, Start up
-current_time_this_cure = datetime.datetime.now()
-print("Starting SBCuterie at " + time.strftime("%c"))
-send_alert("Picuterie Startup", "System startup triggered at" + time.strftime("%c"))
-
-# Ensure everything is OFF
-last_cool_time = set_device_status("cooling", "OFF")
-last_heat_time = set_device_status("heating", "OFF")
-last_humid_time = set_device_status("humidifier", "OFF")
-last_dehumid_time = set_device_status("dehumidifier", "OFF")
-# last_air_pump_off_time = set_device_status("air", "OFF")
-# last_air_pump_on_time = last_air_pump_off_time
-cool_status = "OFF"
-heat_status = "OFF"
-humidifier_status = "OFF"
-dehumidifier_status = "OFF"
-# air_pump_status = "OFF"
-
-# Read Initial Data
-# In a basic setup system will only be using one batch of settings at a time.
-# This should be replaced with a look into the DB and pull out the active settings.
-# Until then, we will load set #1.
-results = load_db_values(1)
-ProfileLabel = results["ProfileLabel"]
-CurrentTempSetPoint = results["CurrentTempSetPoint"]
-CurrentTempMaxOvershoot = results["CurrentTempMaxOvershoot"]
-CurrentHumiditySetpoint = results["CurrentHumiditySetpoint"]
-CurrentHumidityMaxOvershoot = results["CurrentHumidityMaxOvershoot"]
-ControlHumidity = results["ControlHumidity"]
-# AirPumpDuty = results["AirPumpDuty"]
-# AirPumpIdleTime = results["AirPumpIdleTime"]
-LogServerStatus = results["LogServerStatus"]
-NotificationEmail = results["NotificationEmail"]
-ReportingConfig = results["ReportingConfig"]
-ScheduleStatus = results["ScheduleStatus"]
-ScheduleID = results["ScheduleID"]
-
-last_refresh = time.time()
-
-# Read Sensors
-(
-    last_sensor_read_time,
-    temp_quorum_code,
-    chamber_temperature,
-    humidity_quorum_code,
-    chamber_humidity,
-) = get_sensor_data()
-
-last_chamber_temperature = chamber_temperature
-last_chamber_humidity = chamber_humidity
-
-# Write our first set of values into the DB.
-event = "Picuterie Startup"
-write_logs(chamber_temperature, chamber_humidity, event)
-
-state_change = 1  # make sure status gets written
-
-# Main control loop the below state table is identical for humidity
-#
-# 		Heat delta to cool	-----------------------------		Turn Cooler On
-# 		Temp error upper	------------  	Turn Heater Off
-# 		Temp Setpoint 		------------<<
-# 		Temp error lower	------------  	Turn Cooler Off
-# 		Cool delta to Heat	-----------------------------		Turn Heater On
-#
-
-last_uptime = time.time()
 
-print("Main")
+def load_settings(controller=None):
+    """
+    Build the chamber controller from the active settings profile, or hand an
+    existing one the reloaded settings.  Also restarts whatever else runs off the
+    settings (the air pump cycle).
+    """
+    results = load_db_values()
+    schedule = get_active_schedule(results["ScheduleStatus"], results["ScheduleID"])
+    if controller is None:
+        controller = build_controller(CONST, results, schedule, lockout=device_locked_out)
+        if controller.model is not None:
+            # Start from what the log says about the chamber rather than from nothing
+            now = time.time()
+            with get_log_writer().lock:
+                get_log_writer().flush()
+                samples = fit_from_history(
+                    get_log_writer().conn,
+                    controller.model,
+                    now - CONST.THERMAL_MODEL_HISTORY_DAYS * 86400,
+                    now,
+                )
+            print("Chamber model seeded from", samples, "logged samples")
+    else:
+        controller.update_settings(results, schedule)
+    # The air pump is sidelined until it has a relay, the timers run its cycle once it does
+    if "air" in CONST.RELAY_NUM:
+        get_actuator_timers().start_duty_cycle(
+            "air", results["AirPumpDuty"], results["AirPumpIdleTime"]
+        )
+    return controller
 
-while True:
-    try:
 
-        # Pat the dog
-        touch(CONST.SOFTDOG_FILE)
-
-        current_uptime = datetime.timedelta(seconds=int(time.time() - last_uptime))
-
-        # Insert a query to log the uptime via UPDATE query to approprite table"
-
-        # Do we need to refresh settings?
-        # Do this once every 30 minutes from the DB, this implies that schedules can have a resolution no finer than 30 min.
-        if (time.time() - last_refresh) > 1800:
-            # remember to sub future variable in for the "1" below
-            results = load_db_values(1)
-            ProfileLabel = results["ProfileLabel"]
-            CurrentTempSetPoint = results["CurrentTempSetPoint"]
-            CurrentTempMaxOvershoot = results["CurrentTempMaxOvershoot"]
-            CurrentHumiditySetpoint = results["CurrentHumiditySetpoint"]
-            CurrentHumidityMaxOvershoot = results["CurrentHumidityMaxOvershoot"]
-            ControlHumidity = results["ControlHumidity"]
-            # AirPumpDuty = results["AirPumpDuty"]
-            # AirPumpIdleTime = results["AirPumpIdleTime"]
-            LogServerStatus = results["LogServerStatus"]
-            NotificationEmail = results["NotificationEmail"]
-            ReportingConfig = results["ReportingConfig"]
-            ScheduleStatus = results["ScheduleStatus"]
-            ScheduleID = results["ScheduleID"]
-            last_refresh = time.time()
-
-        # Read Sensors
-        (
-            last_sensor_read_time,
+def control_step(controller, reading, now=None):
+    """
+    Make the control decisions for one sensor reading and carry them out:
+    relays, humidifier pulses, logs and alerts.  Runs on the I2C executor.
+    now is the decision time, the wall clock unless a simulator passes its own.
+    Returns True if the chamber panicked and the controller has to exit.
+    """
+    (
+        last_sensor_read_time,
+        temp_quorum_code,
+        chamber_temperature,
+        humidity_quorum_code,
+        chamber_humidity,
+    ) = reading
+    temperature_interval = humidity_interval = None
+    if CONST.CHAMBER_ESTIMATOR:
+        temperature_interval = get_chamber_estimator().interval("Temperature")
+        humidity_interval = get_chamber_estimator().interval("Humidity")
+    if now is None:
+        now = time.time()
+    commands = controller.step(
+        Readings(
             temp_quorum_code,
             chamber_temperature,
             humidity_quorum_code,
             chamber_humidity,
-        ) = get_sensor_data()
-
-        # Check for quorum events in temp or humidity.
-        if (temp_quorum_code != "Good") or (humidity_quorum_code != "Good"):
-            state_change = 1
-
-        # Check for PANIC condition
-        if (
-            chamber_temperature > CONST.PANIC_HOT
-            or chamber_temperature < CONST.PANIC_COLD
-        ):
-
-            time.sleep(10)
-
-            (
-                last_sensor_read_time,
-                chamber_temperature,
-                chamber_humidity,
-            ) = get_sensor_data()
-
-            if (
-                chamber_temperature > CONST.PANIC_HOT
-                or chamber_temperature < CONST.PANIC_COLD
-            ):
-
-                print("Temperature Panic : ", chamber_temperature)
-                send_alert(
-                    "Picuterie Temperature Panic",
-                    "Chamber TEMP at" + chamber_temperature,
-                )
-                write_logs(
-                    chamber_temperature,
-                    chamber_humidity,
-                    "Temperature Panic - Rebooting",
-                )
+            temperature_interval,
+            humidity_interval,
+        ),
+        now,
+    )
 
-                sys.stderr.write("Temperature Panic - rebooting\n")
-                sys.stderr.flush()
+    if commands.panic:
+        print("Temperature Panic : ", chamber_temperature)
+        sys.stderr.write("Temperature Panic - rebooting\n")
+        sys.stderr.flush()
+    for subject, body in commands.alerts:
+        send_alert(subject, body)
+    if commands.event is not None:
+        write_logs(chamber_temperature, chamber_humidity, commands.event)
+    for device, setting in commands.changes:
+        set_device_status(device, setting)
+    for device, seconds in commands.pulses.items():
+        # On now, a timer turns it off again
+        get_actuator_timers().pulse(device, seconds)
+
+    # Write every relay decision from this tick to the board at once
+    apply_device_status()
+    # set_device_status() keeps a locked out device off, make sure the controller knows
+    # so it asks again rather than believing the device is on
+    for device, setting in commands.changes:
+        if device_setting(device) != setting:
+            controller.correct(device, device_setting(device), now)
 
-                # Set all devices to off.
-                last_cool_time = set_device_status("cooling", "OFF")
-                last_heat_time = set_device_status("heating", "OFF")
-                last_humid_time = set_device_status("humidifier", "OFF")
-                last_humid_time = set_device_status("dehumidifier", "OFF")
-                # last_air_pump_off_time = set_device_status("air", "OFF")
-                # Shutdown and exit
-                sys.exit(0)
+    if CONST.DEBUG_STATUS:
+        print("I2C transactions this tick:", I2C.BUS_MANAGER.get_counters())
+        print("AHT20 conversion times:", sensor_registry.get_conversion_stats())
+        print("Sensor bias:", get_sensor_bias().summary())
+        if controller.model is not None:
+            print("Chamber model:", controller.model.summary())
+        if controller.arbiter.blocked:
+            print("Held by the arbiter:", controller.arbiter.blocked)
+        if CONST.CHAMBER_ESTIMATOR:
+            print("Chamber estimate:", get_chamber_estimator().estimates)
+    I2C.BUS_MANAGER.reset_counters()
+    return commands.panic
+
+
+def run_timers():
+    """
+    Run the actuator timers that are due and write any relay change they made.
+    Runs on the I2C executor, returns when the next timer is due.
+    """
+    if get_actuator_timers().scheduler.run_due():
+        apply_device_status()
+    return get_actuator_timers().scheduler.next_deadline()
 
-        """
-        # Commented this out until I get the air pump situation figured out
-        # Cycle the air pump
-        if air_pump_status == "OFF":
-            if time.time() - last_air_pump_off_time > AirPumpIdleTime:
-                last_air_pump_on_time = set_device_status("air", "ON")
-                air_pump_status = "ON"
-                state_change = 1
-
-                if AirPumpDuty < SLEEP_SECONDS:  # allow for short fresh air duties
-                    print("Wait for air pump...", AirPumpDuty, AirPumpIdleTime)
-                    time.sleep(float(AirPumpDuty))
-
-        if air_pump_status == "ON":
-            if time.time() - last_air_pump_on_time > AirPumpDuty:
-                last_air_pump_off_time = set_device_status("air", "OFF")
-                air_pump_status = "OFF"
-                state_change = 1
-        """
-        # #########################
-        # TEMPERATURE CONTROL LOGIC
-        # #########################
-
-        if chamber_temperature >= (
-            CurrentTempSetPoint + CurrentTempMaxOvershoot
-        ):  # (Heat setpoint + acceptable error) exceeded - Start steps to cool.
-
-            # Turn heat off, only if not in dehumidify cycle
-            if heat_status == "ON" and dehumidifier_status == "OFF":
-                last_heat_time = set_device_status("heating", "OFF")
-                heat_status = "OFF"
-                state_change = 1
-
-            if (
-                chamber_temperature >= CurrentTempSetPoint + CurrentTempMaxOvershoot
-            ):  # Heat setpoint significantly exceeded so active cool
-                # Turn cooler on
-
-                last_heat_time = set_device_status("heating", "OFF")
-                heat_status = "OFF"
-
-                if (
-                    time.time() - last_cool_time > CONST.COMPRESSOR_IDLE_TIME
-                ) and cool_status == "OFF":
-                    last_cool_time = set_device_status("cooling", "ON")
-                    cool_status = "ON"
-                    state_change = 1
-
-        if (
-            chamber_temperature <= (CurrentTempSetPoint - CurrentTempMaxOvershoot)
-            and chamber_temperature > CurrentTempSetPoint - CurrentTempMaxOvershoot
-        ):
-            # Heat setpoint - acceptable error exceeded .. mainly to avoid overshoot
-            # but allow to drift down a little if dehumidifier is on
-            if dehumidifier_status == "OFF":
-
-                if cool_status == "ON":
-
-                    last_cool_time = set_device_status("cooling", "OFF")
-                    cool_status = "OFF"
-                    state_change = 1
-
-            if dehumidifier_status == "ON" and heat_status == "OFF":
-
-                last_heat_time = set_device_status("heating", "ON")
-                heat_status = "ON"
-
-        if (
-            chamber_temperature <= CurrentTempSetPoint - CurrentTempMaxOvershoot
-        ):  # Heat setpoint significantly exceeded so active heat and turn off cooling
-            if time.time() - last_heat_time > CONST.HEAT_IDLE_TIME:
-
-                if heat_status == "OFF":
-                    last_heat_time = set_device_status("heating", "ON")
-                    heat_status = "ON"
-                if cool_status == "ON":
-                    last_cool_time = set_device_status("cooling", "OFF")
-                    cool_status = "OFF"
-                    dehumidifier_status = "OFF"
-                    state_change = 1
-
-        # #########################
-        # HUMIDITY CONTROL LOGIC
-        # #########################
-
-        if (
-            chamber_humidity >= (CurrentHumiditySetpoint + CurrentHumidityMaxOvershoot)
-            and ControlHumidity == "YES"
-        ):
-
-            # unlikely as humidifier is now on its own timer
-            if humidifier_status == "ON":
-                last_humid_time = set_device_status("humidifier", "OFF")
-                humidifier_status = "OFF"
-                state_change = 1
-
-            # heating and cooling at same time to lower humidity
-            if (
-                chamber_humidity
-                >= CurrentHumiditySetpoint + CurrentHumidityMaxOvershoot
-            ):
-
-                if time.time() - last_cool_time > CONST.COMPRESSOR_IDLE_TIME:
-                    last_heat_time = set_device_status("heating", "ON")
-                    last_cool_time = set_device_status("cooling", "ON")
-                    cool_status = "ON"
-                    heat_status = "ON"
-
-                dehumidifier_status = "ON"  # only if exceeds DELTA
-
-        if (
-            chamber_humidity <= (CurrentHumiditySetpoint - CurrentHumidityMaxOvershoot)
-            and ControlHumidity == "YES"
-        ):
-
-            if cool_status == "ON":
-                last_cool_time = set_device_status("cooling", "OFF")
-                cool_status = "OFF"
-                dehumidifier_status = "OFF"
-
-                state_change = 1
-            else:
-                if chamber_humidity <= (
-                    CurrentHumiditySetpoint - CurrentHumidityMaxOvershoot
-                ):  # Need to humidfy if control delta is crossed
-                    if time.time() - last_humid_time >= CONST.HUMIDIFIER_IDLE_TIME:
-
-                        last_humid_time = set_device_status("humidifier", "ON")
-                        humidifier_status = "ON"
-
-                        time.sleep(CONST.HUMIDIFIER_DUTY)
-
-                        last_humid_time = set_device_status("humidifier", "OFF")
-
-                        state_change = 1
-
-            # Write status to log
-            # Only if something changed
-
-        if (
-            state_change == 1
-            or chamber_temperature != last_chamber_temperature
-            or chamber_humidity != last_chamber_humidity
-        ):
-
-            event = "State:"
-            if cool_status == "ON":
-                event = event + "Cooling, "
-            if heat_status == "ON":
-                event = event + "Heating, "
-            if humidifier_status == "ON":
-                event = event + "Humidifying, "
-            if dehumidifier_status == "ON":
-                event = event + "Dehumidifying, "
-            # if air_pump_status == "ON":
-            #     event = event + "Flushing "
-            event = event + "TempQuorum" + temp_quorum_code + ", "
-            event = event + "HumiQuorum" + humidity_quorum_code + ", "
-            write_logs(chamber_temperature, chamber_humidity, event)
-
-            if (temp_quorum_code == "No Sensors Agree") or (
-                humidity_quorum_code == "No Sensors Agree"
-            ):
-                body = (
-                    "Temp Quorum Code is "
-                    + temp_quorum_code
-                    + "\nHumidity Quorum Code is "
-                    + humidity_quorum_code
+
+async def run_controller(controller):
+    """
+    The controller as independent tasks:
+        sensing   reads the AHT20s every SLEEP_SECONDS (sooner to confirm a panic),
+                  a failed read skips the tick, SENSOR_FAILURE_LIMIT in a row stop us
+        control   turns each reading into relay decisions
+        timers    runs humidifier pulses, the air pump cycle, etc. when due
+        logging   flushes queued log rows to SQLite
+        sensor bias  saves the per sensor bias/drift statistics
+        alerts    notes alert delivery trouble in the event log
+        softdog   pats the watchdog while control decisions keep coming
+    I2C work runs on one executor thread and SQLite work on another, so neither a
+    log flush nor a slow mail server can hold up a relay decision.  Whichever way
+    the tasks stop, every device is turned off on the way out.
+    """
+    runtime = Runtime()
+    readings = asyncio.Queue(maxsize=1)
+    last_control = [time.time()]  # When a control decision last completed, for the softdog
+    sensor_failures = [0]  # Failed sensor reads in a row
+
+    async def sense():
+        try:
+            reading = await runtime.run_io(get_sensor_data)
+        except Exception as e:
+            # One bad read (a bus glitch, a CRC that failed its retries) shouldn't stop the
+            # chamber, the relays hold until the next tick.  A run of them means we are blind.
+            sensor_failures[0] += 1
+            sys.stderr.write(
+                "Sensor read failed ({} in a row): {}\n".format(sensor_failures[0], e)
+            )
+            if sensor_failures[0] == 1:
+                send_alert("Picuterie sensor read failed", repr(e))
+            if sensor_failures[0] >= CONST.SENSOR_FAILURE_LIMIT:
+                raise
+            return
+        sensor_failures[0] = 0
+        if readings.full():  # Control fell behind, it only wants the newest reading
+            readings.get_nowait()
+        readings.put_nowait((time.time(), reading))
+
+    async def control():
+        while True:
+            read_at, reading = await readings.get()
+            runtime.record_lag("control", time.time() - read_at)
+            # Edits (or a switch of active profile) committed to the DB apply on the next
+            # reading, the check is a single PRAGMA unless something actually changed.
+            if await runtime.run_db(get_settings_cache().refresh):
+                await runtime.run_io(load_settings, controller)
+                print("Settings reloaded, profile:", controller.settings["ProfileLabel"])
+            if await runtime.run_io(control_step, controller, reading):
+                sys.exit(0)
+            last_control[0] = time.time()
+            if controller.panic_since is not None:
+                runtime.wake_at(
+                    "sensing", controller.panic_since + CONST.PANIC_CONFIRM_TIME
                 )
-                send_alert("Chamber Environmental Sensors Disagree", body)
+            if CONST.DEBUG_STATUS:
+                print("Task lag:", runtime.get_lag())
+
+    async def timers():
+        next_deadline = await runtime.run_io(run_timers)
+        if next_deadline is not None:
+            runtime.wake_at("timers", next_deadline)
+
+    async def flush_logs():
+        await runtime.run_db(get_log_writer().maybe_flush)
+
+    async def save_sensor_bias():
+        await runtime.run_db(get_sensor_bias().save)
+
+    alert_failures = [0]
+
+    async def check_alerts():
+        if alert_dispatcher is None:
+            return
+        failed = alert_dispatcher.get_counters()["failed"]
+        if failed > alert_failures[0]:
+            get_log_writer().log_event(
+                "Alert delivery failing, {} alerts not sent".format(failed)
+            )
+            alert_failures[0] = failed
+
+    async def softdog():
+        # Only pat the dog while decisions are being made, a hung control task should get us restarted
+        if time.time() - last_control[0] < CONST.SOFTDOG_MAX_STALL:
+            await runtime.run_db(touch, CONST.SOFTDOG_FILE)
+
+    # Timers wake their task whenever one is scheduled, from any thread
+    get_actuator_timers().scheduler.notify = lambda deadline: runtime.wake_at(
+        "timers", deadline
+    )
+    runtime.every("sensing", float(CONST.SLEEP_SECONDS), sense)
+    runtime.add_task("control", control)
+    runtime.every("timers", 60, timers)
+    runtime.every("logging", CONST.LOG_TASK_INTERVAL, flush_logs, critical=False)
+    runtime.every(
+        "sensor bias", CONST.SENSOR_BIAS_SAVE_INTERVAL, save_sensor_bias, critical=False
+    )
+    runtime.every("alerts", CONST.ALERT_CHECK_INTERVAL, check_alerts, critical=False)
+    runtime.every("softdog", CONST.SOFTDOG_INTERVAL, softdog, critical=False)
+    try:
+        await runtime.run()
+    finally:
+        get_actuator_timers().scheduler.notify = None
+        # The executors are shut down by now, so this is the only thing on the bus
+        shutdown_devices()
+
+
+def shutdown_devices():
+    """
+    Turn every device off.
+    """
+    last_cool_time = set_device_status("cooling", "OFF")
+    set_device_status("heating", "OFF")
+    set_device_status("humidifier", "OFF")
+    set_device_status("dehumidifier", "OFF")
+    # set_device_status("air", "OFF")
+    apply_device_status()
+    return last_cool_time
+
+
+# #######################################################################################
+#     Main loop
+# #######################################################################################
 
-            state_change = 0
+# Everything below only runs when started as the controller, so the functions above
+# can be imported (i.e. by the benchmark harness against the fake I2C bus).
+if __name__ == "__main__":
+    # only allow one instance
+    try:
+        import socket
 
-            # change status after writing to sheet, otherwise won't show up.
-            # Not following the logic here for any of the "won't show up" items. Verify.....
-            humidifier_status = "OFF"
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-        last_chamber_temperature = chamber_temperature
-        last_chamber_humidity = chamber_humidity
+        # Create an abstract socket, by prefixing it with null.
+        s.bind("\0postconnect_gateway_notify_lock")
+    except socket.error as e:
+        error_code = e.args[0]
+        error_string = e.args[1]
+        print("Process already running (%d:%s ). Exiting" % (error_code, error_string))
+        send_alert("Picuterie Startup failed, already running", error_string)
+        sys.exit(0)
 
-        time.sleep(float(CONST.SLEEP_SECONDS))
+    # Make sure queued log rows reach the DB however we exit
+    atexit.register(close_logs)
+    atexit.register(stop_alerts)
+
+    # Keep the logs from growing without bound, a few ms of work at a time in the background
+    if CONST.RETENTION_ENABLED:
+        retention = RetentionEngine(
+            get_log_writer(),
+            raw_retention=CONST.RAW_LOG_RETENTION_DAYS * 86400,
+            minute_rollup_retention=CONST.MINUTE_ROLLUP_RETENTION_DAYS * 86400,
+            event_compact_age=CONST.EVENT_COMPACT_AFTER_DAYS * 86400,
+            slice_budget=CONST.RETENTION_SLICE_BUDGET,
+        )
+        # A DB made before retention existed can't give pages back until it is switched
+        # to incremental auto vacuum, a one off full VACUUM that is a no-op afterwards
+        retention.enable_incremental_vacuum()
+        retention.start(interval=CONST.RETENTION_INTERVAL)
+        # atexit runs last registered first, so the thread is done before close_logs()
+        atexit.register(retention.stop)
+
+    # OK, Start up
+    current_time_this_cure = datetime.datetime.now()
+    print("Starting SBCuterie at " + time.strftime("%c"))
+    send_alert("Picuterie Startup", "System startup triggered at" + time.strftime("%c"))
+
+    # Bring up the sensors once, the control loop reuses them from here on
+    sensor_registry.initialize_all(CONST.AHT20_MUX_CHANS)
+
+    # Ensure everything is OFF
+    shutdown_devices()
+    # We may have just come back from a power cut, so give guarded devices (the
+    # compressor) their full minimum off time before they can start.
+    for device, seconds in CONST.MINIMUM_OFF_TIME.items():
+        get_actuator_timers().lock_out(device, seconds)
+
+    # Read Initial Data
+    # In a basic setup system will only be using one batch of settings at a time,
+    # the active profile (ACTIVEPROFILE table, DEFAULT_PROFILE_ID on a new DB).
+    controller = load_settings()
+
+    # Write our first set of values into the DB.
+    (
+        last_sensor_read_time,
+        temp_quorum_code,
+        chamber_temperature,
+        humidity_quorum_code,
+        chamber_humidity,
+    ) = get_sensor_data()
+    write_logs(chamber_temperature, chamber_humidity, "Picuterie Startup")
+
+    print("Main")
+
+    try:
+        asyncio.run(run_controller(controller))
 
     except KeyboardInterrupt:
 
         print("Quit - Cleaning up devices.")
         # Turn everything OFF
-        last_cool_time = set_device_status("cooling", "OFF")
-        last_heat_time = set_device_status("heating", "OFF")
-        last_humid_time = set_device_status("humidifier", "OFF")
-        last_humid_time = set_device_status("dehumidifier", "OFF")
-        # last_air_pump_off_time = set_device_status("air", "OFF")
+        last_cool_time = shutdown_devices()
+        I2C.BUS_MANAGER.close_all()
 
         send_alert(
             "Picuterie Shutdown FROM CONSOLE",
-            "Shutdown all controls at " + last_cool_time,
+            "Shutdown all controls at " + time.strftime("%c", time.localtime(last_cool_time)),
         )
 
         sys.exit(0)
@@ -3,15 +3,13 @@ This is copied from "https://github.com/Chouffy/python_sensor_aht20" and will be
 from this codebase if it ever becomes available via pip.
 Modified from that codebase to support arbitrary I2C bus in initialization as not everything
 is I2C bus 1 (Specifically Rock Pi 4).
+All transactions go through the shared bus handle from i2c_bus rather than opening
+a new SMBus each time.
 """
 
-from smbus2 import SMBus
 import time
 
-
-def get_normalized_bit(value, bit_index):
-    # Return only one bit from value indicated in bit_index
-    return (value >> bit_index) & 1
+from .i2c_bus import get_bus
 
 
 AHT20_I2CADDR = 0x38
@@ -22,47 +20,186 @@ AHT20_STATUSBIT_BUSY = 7  # The 7th bit is the Busy indication bit. 1 = Busy, 0
 AHT20_STATUSBIT_CALIBRATED = (
     3  # The 3rd bit is the CAL (calibration) Enable bit. 1 = Calibrated, 0 = not
 )
+AHT20_CRC_POLYNOMIAL = 0x31
+AHT20_CRC_INIT = 0xFF
+
+AHT20_POLL_INITIAL_WAIT = 0.04  # Typical conversions are done well before the 80 ms worst case
+AHT20_POLL_INTERVAL = 0.005  # Status byte poll interval once the initial wait is over
+AHT20_POLL_TIMEOUT = 0.5  # Give up on a conversion that is still busy after this long
+AHT20_CALIBRATION_TIMEOUT = 0.5  # Give up on a sensor that won't report calibrated after this long
+
+
+def get_normalized_bit(value, bit_index):
+    # Return only one bit from value indicated in bit_index
+    return (value >> bit_index) & 1
+
+
+def crc8_byte(crc):
+    # Run one byte worth of bits through the CRC-8 shift register
+    for _ in range(8):
+        if crc & 0x80:
+            crc = ((crc << 1) ^ AHT20_CRC_POLYNOMIAL) & 0xFF
+        else:
+            crc = (crc << 1) & 0xFF
+    return crc
+
+
+AHT20_CRC_TABLE = [crc8_byte(value) for value in range(256)]
+
+
+def crc8(data):
+    # CRC-8 as used by the AHT20: polynomial 0x31 (x^8 + x^5 + x^4 + 1), init 0xFF
+    crc = AHT20_CRC_INIT
+    for byte in data:
+        crc = AHT20_CRC_TABLE[crc ^ byte]
+    return crc
+
+
+def decode_temperature(measure):
+    # Select the temperature bytes out of a 7 byte measure frame, return degrees C
+    measure = ((measure[3] & 0xF) << 16) | (measure[4] << 8) | measure[5]
+    return measure / (pow(2, 20)) * 200 - 50
+
+
+def decode_humidity(measure):
+    # Select the humidity bytes out of a 7 byte measure frame, return %RH
+    measure = (measure[1] << 12) | (measure[2] << 4) | (measure[3] >> 4)
+    return measure * 100 / pow(2, 20)
+
+
+class AHT20CRCError(Exception):
+    # Raised when the CRC byte of a measure frame does not match its data
+
+    def __init__(self, measure, crc):
+        self.measure = measure
+        self.crc = crc
+        super().__init__(
+            "AHT20 CRC mismatch: got 0x{:02X}, calculated 0x{:02X}".format(
+                measure[6], crc
+            )
+        )
+
+
+class AHT20TimeoutError(Exception):
+    # Raised when the sensor stays busy (or uncalibrated) past the poll timeout
+    pass
+
+
+class AHT20PollStrategy:
+    # How to wait for the sensor: sleep initial_wait after the trigger, then check the
+    # status byte every poll_interval until it is ready or timeout has passed.
+
+    def __init__(
+        self,
+        initial_wait=AHT20_POLL_INITIAL_WAIT,
+        poll_interval=AHT20_POLL_INTERVAL,
+        timeout=AHT20_POLL_TIMEOUT,
+    ):
+        self.initial_wait = initial_wait
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def wait_until(self, ready, started, what="measure"):
+        # Wait out the initial period counted from started, then poll ready() until it is true
+        remaining = self.initial_wait - (time.monotonic() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+        while not ready():
+            if time.monotonic() - started > self.timeout:
+                raise AHT20TimeoutError(
+                    "AHT20 {} not ready after {:.3f} s".format(what, self.timeout)
+                )
+            time.sleep(self.poll_interval)
+        return time.monotonic() - started
+
+
+class AHT20ConversionStats:
+    # Running count/min/max/mean of the time from trigger until the sensor was seen idle
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.mean += (seconds - self.mean) / self.count
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {"count": self.count, "min": self.min, "max": self.max, "mean": self.mean}
 
 
 class AHT20:
     # I2C communication driver for AHT20, using only smbus2
 
-    def __init__(self, I2CBusNum=1):
-        # Initialize AHT20
+    def __init__(self, I2CBusNum=1, i2c_bus=None, poll_strategy=None):
+        # Initialize AHT20, use the shared handle for this bus number unless handed one
         self.I2CBusNum = I2CBusNum
+        self.i2c_bus = i2c_bus if i2c_bus is not None else get_bus(I2CBusNum)
+        self.poll_strategy = (
+            poll_strategy if poll_strategy is not None else AHT20PollStrategy()
+        )
+        self.conversion_stats = AHT20ConversionStats()
+        self.measure_started = None  # monotonic time of the last trigger_measure()
+        self.measure_timed = False  # Its conversion time is already in conversion_stats
+        self.calibrated = False  # Cached CAL bit from the last initialize()
+        self.last_initialized = None  # monotonic time of the last initialize()
+        self.initialize()
+
+    def initialize(self):
+        # Soft reset, then check for calibration, if not done then do and poll every 10 ms
+        # until the timeout.  Only needed once per power up or after the sensor misbehaves.
+        self.calibrated = False
         self.cmd_soft_reset()
 
-        # Check for calibration, if not done then do and wait 10 ms
-        if not self.get_status_calibrated == 1:
+        if not self.get_status_calibrated() == 1:
             self.cmd_initialize()
-            while not self.get_status_calibrated() == 1:
-                time.sleep(0.01)
+            calibration_poll = AHT20PollStrategy(
+                initial_wait=0, poll_interval=0.01, timeout=AHT20_CALIBRATION_TIMEOUT
+            )
+            calibration_poll.wait_until(
+                lambda: self.get_status_calibrated() == 1,
+                time.monotonic(),
+                "calibration",
+            )
+        self.calibrated = True
+        self.last_initialized = time.monotonic()
+        return True
 
     def cmd_soft_reset(self):
         # Send the command to soft reset
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_SOFTRESET)
+        self.i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_SOFTRESET)
         time.sleep(0.04)  # Wait 40 ms after poweron
         return True
 
     def cmd_initialize(self):
         # Send the command to initialize (calibrate)
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_INITIALIZE)
+        self.i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_INITIALIZE)
         return True
 
     def cmd_measure(self):
-        # Send the command to measure
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_MEASURE)
-        time.sleep(0.08)  # Wait 80 ms after measure
+        # Send the command to measure and wait until the conversion is done, polling the
+        # busy bit like collect_measure() rather than sleeping the worst case
+        self.trigger_measure()
+        self.wait_measure()
+        return True
+
+    def trigger_measure(self):
+        # Send the command to measure and return straight away so other sensors can be
+        # started while this one converts.  Pick the result up later with collect().
+        self.i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_MEASURE)
+        self.measure_started = time.monotonic()
+        self.measure_timed = False
         return True
 
     def get_status(self):
         # Get the full status byte
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            return i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 1)[0]
-        return True
+        return self.i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 1)[0]
 
     def get_status_calibrated(self):
         # Get the calibrated bit
@@ -76,28 +213,52 @@ class AHT20:
         # Get the full measure
 
         # Command a measure
-        self.cmd_measure()
+        self.trigger_measure()
+
+        return self.collect_measure()
+
+    def wait_measure(self):
+        # Wait for the busy bit to clear.  The initial wait counts from the trigger so any
+        # time already spent on other sensors is not waited again.
+        conversion_time = self.poll_strategy.wait_until(
+            lambda: self.get_status_busy() == 0, self.measure_started
+        )
+        if not self.measure_timed:
+            # A re-read after a CRC error waits on the same conversion, it isn't a new sample
+            self.conversion_stats.add(conversion_time)
+            self.measure_timed = True
+        return conversion_time
+
+    def collect_measure(self):
+        # Get the full measure started by trigger_measure()
+
+        self.wait_measure()
 
-        # Check if busy bit = 0, otherwise wait 80 ms and retry
-        while self.get_status_busy() == 1:
-            time.sleep(0.08)  # Wait 80 ns
+        # Read data, check the CRC byte over the status and data bytes and return it
+        measure = self.i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 7)
+        crc = crc8(measure[:6])
+        if crc != measure[6]:
+            raise AHT20CRCError(measure, crc)
+        return measure
 
-        # TODO: do CRC check
+    def read(self):
+        # One conversion, both values decoded from the same frame.
+        # Returns (temperature, humidity), raises AHT20CRCError on a corrupt frame.
+        measure = self.get_measure()
+        return decode_temperature(measure), decode_humidity(measure)
 
-        # Read data and return it
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            return i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 7)
+    def collect(self):
+        # Same as read() but for a conversion already started with trigger_measure().
+        # Calling it again after a CRC error re-reads the same conversion.
+        measure = self.collect_measure()
+        return decode_temperature(measure), decode_humidity(measure)
 
     def get_temperature(self):
         # Get a measure, select proper bytes, return converted data
-        measure = self.get_measure()
-        measure = ((measure[3] & 0xF) << 16) | (measure[4] << 8) | measure[5]
-        measure = measure / (pow(2, 20)) * 200 - 50
-        return measure
+        # Use read() when you want humidity too, this costs a full conversion
+        return decode_temperature(self.get_measure())
 
     def get_humidity(self):
         # Get a measure, select proper bytes, return converted data
-        measure = self.get_measure()
-        measure = (measure[1] << 12) | (measure[2] << 4) | (measure[3] >> 4)
-        measure = measure * 100 / pow(2, 20)
-        return measure
+        # Use read() when you want temperature too, this costs a full conversion
+        return decode_humidity(self.get_measure())
@@ -3,10 +3,11 @@ Module to handle TCA9548A I2C Multiplexer via SMBus calls
 requires SMBus2 to be installed
 """
 
-from smbus2 import SMBus
 import time
 import sys
 
+from .i2c_bus import get_bus
+
 # Define the command to set each channel, 1 through 8
 mux_channel_array = [
     0b00000001,
@@ -20,14 +21,102 @@ mux_channel_array = [
 ]
 
 
+MUX_SETTLE_TIME = 0.01  # Seconds to let the bus settle after switching channels
+
+
+class TCA9548A:
+    # Stateful driver for one multiplexer.  Remembers the channel mask it last wrote so
+    # selecting the channel we are already on costs no bus write and no settle delay.
+
+    def __init__(
+        self,
+        I2CBus=1,
+        multiplexer_addr=0x70,
+        settle_time=MUX_SETTLE_TIME,
+        debug_status=False,
+        i2c_bus=None,
+    ):
+        self.I2CBusNum = I2CBus
+        self.i2c_bus = i2c_bus if i2c_bus is not None else get_bus(I2CBus)
+        self.multiplexer_addr = multiplexer_addr
+        self.settle_time = settle_time
+        self.debug = debug_status
+        self.channel_mask = None  # None means we don't know what the mux is set to
+        self.switch_count = 0  # Actual channel writes, skipped no-op selects are not counted
+
+    def select(self, *channels):
+        # Select one or more channels (0 through 7) at once, all others are disabled
+        mask = 0
+        for channel in channels:
+            if not isinstance(channel, int) or not 0 <= channel < len(mux_channel_array):
+                raise ValueError("Invalid mux channel: {}".format(channel))
+            mask |= mux_channel_array[channel]
+        return self.select_mask(mask)
+
+    def select_mask(self, mask):
+        # Write a raw channel mask unless the mux is already set to it
+        with self.i2c_bus:
+            if mask == self.channel_mask:
+                return False
+            try:
+                self.i2c_bus.write_byte(self.multiplexer_addr, mask)
+            except OSError:
+                # The write may or may not have landed, force a write or resync next time
+                self.channel_mask = None
+                raise
+            self.channel_mask = mask
+            self.switch_count += 1
+            if self.settle_time:
+                time.sleep(self.settle_time)
+            if self.debug:
+                print("TCA9548A I2C channel status:", bin(mask))
+        return True
+
+    def disable_all(self):
+        # Disconnect every downstream channel
+        return self.select_mask(0)
+
+    def invalidate(self):
+        # Forget the cached mask so the next select always writes
+        self.channel_mask = None
+
+    def resync(self):
+        # Read the mask back from the mux after a bus error, i.e. if the mux was reset
+        # under us.  Leaves the cache unknown (None) if the readback fails too.
+        with self.i2c_bus:
+            try:
+                self.channel_mask = self.i2c_bus.read_byte(self.multiplexer_addr)
+            except OSError:
+                self.channel_mask = None
+        return self.channel_mask
+
+
+# One stateful mux object per (bus, address) so every caller shares the cached mask
+mux_registry = {}
+
+
+def get_mux(I2CBus=1, multiplexer_addr=0x70, debug_status=False, i2c_bus=None):
+    key = (I2CBus, multiplexer_addr)
+    if key not in mux_registry:
+        mux_registry[key] = TCA9548A(
+            I2CBus=I2CBus,
+            multiplexer_addr=multiplexer_addr,
+            debug_status=debug_status,
+            i2c_bus=i2c_bus,
+        )
+    return mux_registry[key]
+
+
 def i2c_mux_channel(
-    I2CBus=1, multiplexer_addr=0x70, i2c_channel_setup=1, debug_status=False
+    I2CBus=1,
+    multiplexer_addr=0x70,
+    i2c_channel_setup=1,
+    debug_status=False,
+    i2c_bus=None,
 ):
+    # Kept for older callers, switches through the shared stateful mux object
     if isinstance(i2c_channel_setup, int):
-        bus = SMBus(I2CBus)
-        bus.write_byte(multiplexer_addr, mux_channel_array[i2c_channel_setup])
-        time.sleep(0.01)
-        if debug_status:
-            print("TCA9548A I2C channel status:", bin(bus.read_byte(multiplexer_addr)))
+        mux = get_mux(I2CBus, multiplexer_addr, debug_status, i2c_bus)
+        mux.select(i2c_channel_setup)
     else:
         print("Channel specification must be integer.")
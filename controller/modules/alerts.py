@@ -0,0 +1,224 @@
+"""
+Module to send alert emails from a background thread
+
+send_alert() used to connect, STARTTLS and log in to the SMTP server inside the control
+loop, so a dead network held the relays for a whole TCP timeout, and alerts like
+"Sensors Disagree" went out again on every tick.  The AlertDispatcher:
+  - only puts the alert on a bounded queue, send() never blocks.  When the queue is
+    full the alert is dropped and counted rather than stalling the loop,
+  - drains the queue on a worker thread which keeps one logged in connection and
+    reuses it, closing it after idle_timeout seconds without mail,
+  - retries a failed send with exponential backoff, giving up after max_retries,
+  - sends the first alert with a given recipient and subject straight away and only
+    counts repeats within dedup_window seconds.  When the window closes a single
+    "repeated N times" message carries the count and the latest body.
+smtp_factory, use_tls and a None password let it run against a plain local SMTP
+stand-in, see tests/alerts.py.
+"""
+
+import email.message
+import queue
+import smtplib
+import ssl
+import threading
+import time
+
+
+class AlertDispatcher:
+    # Bounded alert queue plus the worker thread that mails it out
+
+    def __init__(
+        self,
+        smtp_server,
+        smtp_port,
+        sender,
+        password=None,
+        use_tls=True,
+        queue_size=100,
+        dedup_window=600,
+        max_retries=5,
+        backoff_initial=1,
+        backoff_max=300,
+        idle_timeout=300,
+        timeout=30,
+        smtp_factory=smtplib.SMTP,
+        clock=time.time,
+    ):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender = sender
+        self.password = password  # None skips the login
+        self.use_tls = use_tls
+        self.dedup_window = dedup_window  # Seconds repeats of one alert are folded together
+        self.max_retries = max_retries
+        self.backoff_initial = backoff_initial  # Seconds before the first retry, doubled each time
+        self.backoff_max = backoff_max
+        self.idle_timeout = idle_timeout  # Seconds an unused connection is kept open
+        self.timeout = timeout  # Socket timeout for the SMTP connection
+        self.smtp_factory = smtp_factory
+        self.clock = clock
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.windows = {}  # (to, subject) -> [window start, repeats, latest body]
+        self.server = None
+        self.last_used = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.counters = dict.fromkeys(
+            ["queued", "sent", "failed", "dropped", "suppressed", "connects"], 0
+        )
+
+    def send(self, subject, body, to):
+        """
+        Queue an alert, returns straight away.  False if it was dropped because
+        the queue is full, a repeat folded into an open window counts as queued.
+        """
+        key = (to, subject)
+        now = self.clock()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is not None and now - window[0] < self.dedup_window:
+                window[1] += 1
+                window[2] = body
+                self.counters["suppressed"] += 1
+                return True
+            self.flush_window(key)
+            self.windows[key] = [now, 0, body]
+        return self.enqueue(subject, body, to)
+
+    def enqueue(self, subject, body, to):
+        try:
+            self.queue.put_nowait((subject, body, to))
+        except queue.Full:
+            with self.lock:
+                self.counters["dropped"] += 1
+            return False
+        with self.lock:
+            self.counters["queued"] += 1
+        return True
+
+    def flush_window(self, key):
+        # Close a dedup window, queueing the summary if anything was folded into it.
+        # Called with the lock held.
+        window = self.windows.pop(key, None)
+        if window is None or window[1] == 0:
+            return
+        to, subject = key
+        body = "{}\n\n(repeated {} times in the {} s after {})".format(
+            window[2],
+            window[1],
+            self.dedup_window,
+            time.strftime("%c", time.localtime(window[0])),
+        )
+        try:
+            self.queue.put_nowait((subject, body, to))
+            self.counters["queued"] += 1
+        except queue.Full:
+            self.counters["dropped"] += 1
+
+    def flush_expired(self):
+        # Close every dedup window that has run its course
+        now = self.clock()
+        with self.lock:
+            for key, window in list(self.windows.items()):
+                if now - window[0] >= self.dedup_window:
+                    self.flush_window(key)
+
+    def build_message(self, subject, body, to):
+        msg = email.message.EmailMessage()
+        msg["From"] = self.sender
+        msg["To"] = to
+        msg["Subject"] = subject
+        msg.set_content(body)
+        return msg
+
+    def connect(self):
+        # Open and log in a connection if we don't have one
+        if self.server is None:
+            server = self.smtp_factory(
+                self.smtp_server, self.smtp_port, timeout=self.timeout
+            )
+            try:
+                if self.use_tls:
+                    server.starttls(context=ssl.create_default_context())
+                if self.password is not None:
+                    server.login(self.sender, self.password)
+            except Exception:
+                server.close()
+                raise
+            self.server = server
+            with self.lock:
+                self.counters["connects"] += 1
+        return self.server
+
+    def disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                self.server.close()
+            finally:
+                self.server = None
+
+    def deliver(self, subject, body, to):
+        # Send one message, retrying with backoff.  True once it has gone.
+        msg = self.build_message(subject, body, to)
+        backoff = self.backoff_initial
+        for attempt in range(self.max_retries + 1):
+            reused = self.server is not None
+            try:
+                self.connect().send_message(msg)
+                self.last_used = self.clock()
+                with self.lock:
+                    self.counters["sent"] += 1
+                return True
+            except (OSError, smtplib.SMTPException) as e:
+                self.disconnect()
+                if reused:
+                    continue  # Most likely the server dropped an idle connection, redial now
+                if attempt == self.max_retries or self.stop_event.wait(backoff):
+                    print("Alert not sent:", subject, e)
+                    break
+                backoff = min(backoff * 2, self.backoff_max)
+        with self.lock:
+            self.counters["failed"] += 1
+        return False
+
+    def run_worker(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self.deliver(*item)
+                self.queue.task_done()
+            self.flush_expired()
+            if self.server is not None and self.clock() - self.last_used > self.idle_timeout:
+                self.disconnect()
+            if self.stop_event.is_set() and self.queue.empty():
+                break
+        self.disconnect()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run_worker, name="alerts", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self, timeout=10):
+        # Send what is queued, including open repeat counts, without waiting out
+        # retry backoffs, and stop the worker
+        with self.lock:
+            for key in list(self.windows):
+                self.flush_window(key)
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def get_counters(self):
+        with self.lock:
+            counters = dict(self.counters)
+        counters["pending"] = self.queue.qsize()
+        return counters
@@ -0,0 +1,150 @@
+"""
+Module to settle what every relay does each tick from the demands of the control logic
+
+The temperature and humidity logic used to set heating and cooling from separate if
+blocks, so whichever ran last won and the compressor idle time was only checked on some
+paths.  Now each block posts a Demand with a priority to the ActuatorArbiter and
+resolve() decides once per tick:
+  - the highest priority demand for a device wins, a later demand wins a tie,
+  - a device that is off stays off for its minimum off time and is not started more
+    than its maximum starts in any hour,
+  - a device that is on stays on for its minimum on time, unless the demand to turn it
+    off is a safety one (i.e. a panic),
+and returns the relay changes for the tick, all at once, so one consistent mask is
+written to the board.  Pulsed devices (the humidifier) are left to the actuator timers.
+The hardware side keeps its own minimum off lockout (see timers), stamped when the mask
+is actually written, a moment after the decision.  Handing that lockout in as lockout
+makes the arbiter refuse a start the board would refuse, and correct() takes the
+board's word for anything it still didn't carry out, so relays is what the board has.
+"""
+
+import collections
+import time
+
+PRIORITY_HUMIDITY = 10
+PRIORITY_TEMPERATURE = 20
+PRIORITY_SAFETY = 100  # Ignores minimum on times, only ever used to turn things off
+
+# One request for a device setting, source says which logic asked for it
+Demand = collections.namedtuple("Demand", ["device", "setting", "priority", "source"])
+
+
+class ActuatorArbiter:
+    # Relay state and protection limits for every device, see resolve()
+
+    def __init__(
+        self,
+        devices,
+        minimum_on_time=None,
+        minimum_off_time=None,
+        max_starts_per_hour=None,
+        lockout=None,
+        clock=time.time,
+    ):
+        self.devices = list(devices)
+        self.minimum_on_time = dict(minimum_on_time or {})  # device -> seconds
+        self.minimum_off_time = dict(minimum_off_time or {})  # device -> seconds
+        self.max_starts_per_hour = dict(max_starts_per_hour or {})  # device -> starts
+        self.lockout = lockout  # device -> True while the hardware holds it off, or None
+        self.clock = clock
+        self.reset()
+
+    def reset(self, now=None):
+        # Everything off as of now, guarded devices wait out their minimum off time
+        # (we may have just come back from a power cut)
+        if now is None:
+            now = self.clock()
+        self.relays = dict.fromkeys(self.devices, "OFF")
+        self.changed_at = dict.fromkeys(self.devices, now)
+        self.starts = {device: collections.deque() for device in self.devices}
+        self.demands = []
+        self.blocked = {}  # device -> why its winning demand was not carried out last tick
+        self.undo = {}  # device -> (setting, changed_at) before the last resolve() changed it
+
+    def demand(self, device, setting, priority, source=None):
+        self.demands.append(Demand(device, setting, priority, source))
+
+    def locked_out(self, device, now):
+        # Still inside its minimum off time, by our clock or the hardware's
+        return self.relays[device] == "OFF" and (
+            now - self.changed_at[device] < self.minimum_off_time.get(device, 0)
+            or (self.lockout is not None and self.lockout(device))
+        )
+
+    def starts_last_hour(self, device, now):
+        starts = self.starts[device]
+        while starts and starts[0] <= now - 3600:
+            starts.popleft()
+        return len(starts)
+
+    def refuse(self, demand, now):
+        # Why demand can't be carried out right now, None if it can
+        device = demand.device
+        if demand.setting == self.relays[device]:
+            return None
+        held = now - self.changed_at[device]
+        if demand.setting == "ON":
+            if held < self.minimum_off_time.get(device, 0):
+                return "minimum off time"
+            if self.lockout is not None and self.lockout(device):
+                return "minimum off time"
+            limit = self.max_starts_per_hour.get(device)
+            if limit is not None and self.starts_last_hour(device, now) >= limit:
+                return "max starts per hour"
+        elif demand.priority < PRIORITY_SAFETY:
+            if held < self.minimum_on_time.get(device, 0):
+                return "minimum on time"
+        return None
+
+    def resolve(self, now=None):
+        """
+        Settle this tick's demands and return the relay changes as a list of
+        (device, "ON"/"OFF"), in device order.  Devices nobody asked about
+        keep their setting.
+        """
+        if now is None:
+            now = self.clock()
+        winners = {}
+        for demand in self.demands:
+            current = winners.get(demand.device)
+            if current is None or demand.priority >= current.priority:
+                winners[demand.device] = demand
+        self.demands = []
+        self.blocked = {}
+        self.undo = {}
+        changes = []
+        for device in self.devices:
+            demand = winners.get(device)
+            if demand is None or demand.setting == self.relays[device]:
+                continue
+            reason = self.refuse(demand, now)
+            if reason is not None:
+                self.blocked[device] = reason
+                continue
+            self.undo[device] = (self.relays[device], self.changed_at[device])
+            self.relays[device] = demand.setting
+            self.changed_at[device] = now
+            if demand.setting == "ON":
+                self.starts[device].append(now)
+            changes.append((device, demand.setting))
+        return changes
+
+    def correct(self, device, setting, now=None):
+        """
+        The board has device at setting, not what the last resolve() said:
+        put it back as it was before that change (a start that never
+        happened isn't counted), so the demand is settled again next tick.
+        """
+        if now is None:
+            now = self.clock()
+        if self.relays[device] == setting:
+            return
+        previous = self.undo.pop(device, None)
+        if previous is not None and previous[0] == setting:
+            starts = self.starts[device]
+            if setting == "OFF" and starts and starts[-1] == self.changed_at[device]:
+                starts.pop()
+            self.relays[device], self.changed_at[device] = previous
+        else:
+            self.relays[device] = setting
+            self.changed_at[device] = now
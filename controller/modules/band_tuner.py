@@ -0,0 +1,241 @@
+"""
+Module to pick the hysteresis bands from how the chamber has actually been cycling
+
+CurrentTempMaxOvershoot and CurrentHumidityMaxOvershoot used to be picked by hand: too
+narrow and the compressor short cycles, too wide and the meat sees big swings.  With
+the rates of heating and cooling roughly fixed, the temperature swings by the band plus
+a bit more (the coil keeps cooling after the compressor stops, the sensors lag), and a
+cycle takes time in proportion to the swing:
+
+    swing = 2 * band + overshoot          starts per hour * swing = k
+
+update_tuning() reduces each finished day to one BANDTUNING row from the hour rollups
+(ENVIROLOG_1H) and duty buckets (RELAYDUTY_1H), taking the median over the hours the
+compressor cycled of the swing (TempMax - TempMin), of the swing past 2 * band and of
+starts * swing.  It only reads the days since its last run, 24 rows per table per day,
+so it is cheap enough to run every night.  recommend() combines the last few days
+(each day carries the band it ran with, so days before a band change still count) and
+solves for the band that gives the target starts per hour, held to the largest
+setpoint error allowed and moved at most max_step of the way per run.  If the
+temperature doesn't swing across most of the band, something else (the humidity
+logic, the compressor's minimum off time) sets the cycles and the band is left alone.
+The minimum off time also stretches the cycles as the band narrows, so the first
+recommendation undershoots the target a little and the next nights close the gap.
+The humidity swing mostly follows the compressor cycles, so its band is set to cover
+that swing instead, within its own limits.  days_since_applied() counts the days of
+history the bands in force have had, from the EVENTLOG row of the last change applied.
+"""
+
+import collections
+
+DAY = 86400
+HOUR = 3600
+FULL_SWING = 0.8  # Swings under this fraction of the band width mean the band isn't what cycles
+EVENT_PREFIX = "Band tuner:"  # Starts the EVENTLOG row of every change applied
+
+# What recommend() comes up with, bands are None if there was nothing to go on
+Recommendation = collections.namedtuple(
+    "Recommendation",
+    [
+        "temp_band",
+        "humidity_band",
+        "observed_starts",  # Compressor starts per hour over the days used
+        "predicted_starts",  # at temp_band, by the model above
+        "predicted_error",  # Largest setpoint error expected at temp_band, C
+        "days",
+        "note",  # Why the target couldn't be met, None if it could
+    ],
+)
+
+
+def create_tuning_table(conn):
+    # One row per analysed day, only created if missing
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS BANDTUNING
+        (Day INT PRIMARY KEY NOT NULL,
+        Hours INT NOT NULL,
+        CyclingHours INT NOT NULL,
+        Starts INT NOT NULL,
+        TempBand REAL NOT NULL,
+        HumBand REAL NOT NULL,
+        TempSwing REAL,
+        TempOvershoot REAL,
+        SwingStarts REAL,
+        HumSwing REAL);"""
+    )
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarise_day(hours, starts, temp_band, sample_interval):
+    """
+    Reduce one day to a BANDTUNING row (less the Day and bands).  hours is
+    the day's (Bucket, Count, TempMin, TempMax, HumMin, HumMax) hour rollups,
+    starts maps bucket -> compressor starts.  Hours with under 80% of their
+    samples (the controller was down) are left out.
+    """
+    expected = HOUR / sample_interval
+    complete = [row for row in hours if row[1] >= 0.8 * expected]
+    cycling = [row for row in complete if starts.get(row[0], 0) > 0]
+    swings = [row[3] - row[2] for row in cycling]
+    return (
+        len(complete),
+        len(cycling),
+        sum(starts.get(row[0], 0) for row in complete),
+        median(swings),
+        median([swing - 2 * temp_band for swing in swings]),
+        median([starts[row[0]] * (row[3] - row[2]) for row in cycling]),
+        median([row[5] - row[4] for row in complete]),
+    )
+
+
+def update_tuning(conn, temp_band, humidity_band, now, history_days=7, sample_interval=30):
+    """
+    Add a BANDTUNING row for every finished day since the last run, going
+    back at most history_days, recorded as run with the bands given (the
+    ones in force now, so run it at least once a day).  Returns the number
+    of days added.  Call inside a transaction.
+    """
+    create_tuning_table(conn)
+    today = int(now // DAY) * DAY
+    last = conn.execute("SELECT MAX(Day) FROM BANDTUNING").fetchone()[0]
+    start = today - history_days * DAY
+    if last is not None:
+        start = max(start, last + DAY)
+    if start >= today:
+        return 0
+    days = collections.defaultdict(list)
+    for row in conn.execute(
+        "SELECT Bucket, Count, TempMin, TempMax, HumMin, HumMax FROM ENVIROLOG_1H "
+        "WHERE Bucket >= ? AND Bucket < ? ORDER BY Bucket",
+        (start, today),
+    ):
+        days[int(row[0] // DAY) * DAY].append(row)
+    starts = dict(
+        conn.execute(
+            "SELECT Bucket, Starts FROM RELAYDUTY_1H "
+            "WHERE Device = 'cooling' AND Bucket >= ? AND Bucket < ?",
+            (start, today),
+        )
+    )
+    rows = []
+    for day, hours in sorted(days.items()):
+        summary = summarise_day(hours, starts, temp_band, sample_interval)
+        rows.append((day,) + summary[:3] + (temp_band, humidity_band) + summary[3:])
+    conn.executemany(
+        "INSERT OR REPLACE INTO BANDTUNING (Day, Hours, CyclingHours, Starts, TempBand, "
+        "HumBand, TempSwing, TempOvershoot, SwingStarts, HumSwing) "
+        "VALUES (?,?,?,?,?,?,?,?,?,?)",
+        rows,
+    )
+    return len(rows)
+
+
+def days_since_applied(conn):
+    """
+    The number of BANDTUNING days from the day the last band change was
+    applied (its EVENTLOG row) on, i.e. how much the bands now in force have
+    been seen running.  Every day counts if no change was ever applied.
+    """
+    applied = conn.execute(
+        "SELECT MAX(Time) FROM EVENTLOG WHERE Event LIKE ?", (EVENT_PREFIX + "%",)
+    ).fetchone()[0]
+    if applied is None:
+        return conn.execute("SELECT COUNT(*) FROM BANDTUNING").fetchone()[0]
+    return conn.execute(
+        "SELECT COUNT(*) FROM BANDTUNING WHERE Day >= ?", (int(applied // DAY) * DAY,)
+    ).fetchone()[0]
+
+
+def limit(value, current, max_step, lowest, highest):
+    # value moved at most max_step (a fraction) away from current, within lowest..highest
+    if current > 0:
+        value = min(max(value, current * (1 - max_step)), current * (1 + max_step))
+    return round(min(max(value, lowest), highest), 1)
+
+
+def recommend(
+    conn,
+    temp_band,
+    humidity_band,
+    now,
+    target_starts=3.0,
+    max_temp_error=3.0,
+    max_humidity_error=8.0,
+    min_temp_band=0.3,
+    min_humidity_band=1.0,
+    max_step=0.5,
+    history_days=7,
+    min_cycle=0,
+):
+    """
+    Bands for the target compressor starts per hour from the BANDTUNING rows
+    of the last history_days, see the module docstring.  The temperature is
+    never expected to stray more than max_temp_error from the setpoint, a
+    wider band than that allows is not recommended whatever the start rate.
+    min_cycle is the compressor's minimum on plus off time in seconds, no
+    band gets it to start more often than that allows.
+    """
+    rows = conn.execute(
+        "SELECT Hours, Starts, TempOvershoot, SwingStarts, HumSwing, TempSwing / TempBand "
+        "FROM BANDTUNING "
+        "WHERE Day >= ? AND SwingStarts IS NOT NULL ORDER BY Day",
+        (int(now // DAY) * DAY - history_days * DAY,),
+    ).fetchall()
+    if not rows:
+        return Recommendation(
+            None, None, None, None, None, 0, "no days with the compressor cycling yet"
+        )
+    hours = sum(row[0] for row in rows)
+    observed = sum(row[1] for row in rows) / hours if hours else None
+    overshoot = max(median([row[2] for row in rows]), 0.0)
+    swing_starts = median([row[3] for row in rows])
+
+    note = None
+    if min_cycle and target_starts > HOUR / min_cycle:
+        target_starts = HOUR / min_cycle
+        note = "the minimum on/off times allow {:.2f} starts per hour at most".format(
+            target_starts
+        )
+    band = (swing_starts / target_starts - overshoot) / 2
+    if median([row[5] for row in rows]) < 2 * FULL_SWING:
+        # The compressor stops well inside the band, something else (the humidity logic,
+        # the minimum off time) is setting the cycles and the band won't change them
+        band = temp_band
+        note = "the temperature doesn't swing across the band, the cycles are set elsewhere"
+    elif band + overshoot > max_temp_error:
+        band = max_temp_error - overshoot
+        note = "held to the largest setpoint error, {} C".format(max_temp_error)
+    if band < min_temp_band:
+        band = min_temp_band
+        note = "the chamber already cycles less than the target at the narrowest band"
+    new_temp_band = limit(band, temp_band, max_step, min_temp_band, max_temp_error)
+    predicted = swing_starts / (2 * new_temp_band + overshoot)
+    if new_temp_band == temp_band and observed is not None:
+        predicted = observed
+    if note is None and abs(new_temp_band - round(band, 1)) > 0.05:
+        note = "moved at most {:.0%} this run".format(max_step)
+
+    humidity_swing = median([row[4] for row in rows if row[4] is not None])
+    new_humidity_band = humidity_band
+    if humidity_swing is not None:
+        new_humidity_band = limit(
+            humidity_swing / 2, humidity_band, max_step, min_humidity_band, max_humidity_error
+        )
+    return Recommendation(
+        new_temp_band,
+        new_humidity_band,
+        observed,
+        predicted,
+        new_temp_band + overshoot,
+        len(rows),
+        note,
+    )
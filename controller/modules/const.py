@@ -7,9 +7,17 @@ I2C_MUX_ADDR = 0x70  # I2C address for the I2C multiplexer to switch channels to
 AHTX_MUX_CHAN = 1  # I2C MUX address for the X channel ATH20
 AHTY_MUX_CHAN = 5  # I2C MUX address for the X channel ATH20
 AHTZ_MUX_CHAN = 3  # I2C MUX address for the X channel ATH20
+AHT20_MUX_CHANS = [AHTX_MUX_CHAN, AHTY_MUX_CHAN, AHTZ_MUX_CHAN]  # Every AHT20 in the chamber, add a 4th/5th here
+AHT20_SENSOR_NAMES = ["X", "Y", "Z"]  # Names for the sensors above, in the same order
 OUT1_MUX_CHAN = 0  # I2C MUX address for the first output connector
 OUT2_MUX_CHAN = 2  # I2C MUX address for the second  output connector
 RELAY_DEV_ADDRESS = 0x11  # I2C Address for relay module
+AHT20_PIPELINED_SAMPLING = True  # Start all sensor conversions, then collect them, instead of one after the other
+AHT20_POLL_INITIAL_WAIT = 0.04  # Seconds to wait after starting a conversion before checking the busy bit
+AHT20_POLL_INTERVAL = 0.005  # Seconds between busy bit checks after the initial wait
+AHT20_POLL_TIMEOUT = 0.5  # Seconds before a sensor that is still busy is treated as hung
+AHT20_CRC_RETRIES = 1  # How many times to re-read a sensor whose measure frame fails its CRC check
+AHT20_RESET_INTERVAL = 86400  # Seconds between routine soft resets of each sensor, 0 to only reset after errors
 # Block below can be adjusted to fit how you have connected things, doesn't have to match this.
 RELAY_NUM = {
     "heating": 1,
@@ -34,6 +42,16 @@ MAX_HUMI_SENSOR_DRIFT = (
     4  # How much will we allow sensors to differ from each other before system alerts.
 )
 CURRENT_HUMI_MAX_OVERSHOOT = 3
+QUORUM_MAD_THRESHOLD = None  # Also accept sensors within this many MADs of the median, None for the fixed drifts only
+SENSOR_BIAS_APPLY_OFFSETS = False  # Take each sensor's learned bias off its readings before the quorum check
+SENSOR_BIAS_HALF_LIFE = 6 * 3600  # Seconds, how quickly the learned bias follows a sensor
+SENSOR_DRIFT_HALF_LIFE = 7 * 86400  # Seconds of history the drift per day is fitted over
+SENSOR_DRIFT_HORIZON = 7  # Days, warn if a sensor's drift would take it past the drift limit this soon
+SENSOR_BIAS_SAVE_INTERVAL = 3600  # Seconds between saves of the bias statistics to the DB
+CHAMBER_ESTIMATOR = False  # Control on the filtered estimate of all the sensors (modules/estimator.py) instead of the raw quorum average
+ESTIMATOR_SENSOR_NOISE = {"Temperature": 0.1, "Humidity": 0.3}  # Rated noise std of one sensor, the least each is assumed to have
+ESTIMATOR_PROCESS_NOISE = {"Temperature": 1e-7, "Humidity": 1e-5}  # How quickly the rate of change can wander, units^2/s^3, larger follows faster
+ESTIMATOR_CONFIDENCE = 1.96  # Confidence interval half width in standard deviations
 
 SLEEP_SECONDS = 30  # How long between runs through our control loop
 
@@ -43,15 +61,65 @@ HEAT_IDLE_TIME = 1  # wait number seconds before cycling heat
 HUMIDIFIER_DUTY = 4  # number of seconds to switch humidifier on each loop
 HUMIDIFIER_IDLE_TIME = 60  # wait number seconds before cycling humidifier
 
+# Devices that must stay off this many seconds after switching off, enforced by the
+# actuator timers (see modules/timers.py) and applied at startup too.
+MINIMUM_OFF_TIME = {"cooling": COMPRESSOR_IDLE_TIME}
+# Devices that must stay on this many seconds once started (a panic still turns them off),
+# and the most times a device may start in any hour, enforced by the actuator arbiter
+# (see modules/arbiter.py).  A compressor wants a few minutes running to return its oil.
+MINIMUM_ON_TIME = {"cooling": 180}
+MAX_STARTS_PER_HOUR = {"cooling": 6}
+
+# "hysteresis" switches the compressor at the band edges.  "predictive" learns a model of
+# the chamber (modules/thermal_model.py) from the log history and every tick, and starts
+# and stops the compressor early so the temperature turns at the band edges instead of
+# overshooting them, and stops the heater once the chamber would coast to the middle of
+# the band.  It runs as hysteresis until the model has THERMAL_MODEL_MIN_SAMPLES.
+CONTROL_MODE = "hysteresis"
+PREDICTION_HORIZON = 1800  # Seconds ahead the model is run
+THERMAL_MODEL_HALF_LIFE = 2 * 86400  # Seconds, older samples count for less as the chamber changes
+THERMAL_MODEL_MIN_SAMPLES = 240  # Ticks before the model is trusted
+THERMAL_MODEL_HISTORY_DAYS = 3  # Days of ENVIROLOG/RELAYLOG the model is seeded from at startup
+
 # Circulation fan controls from PorkPi removed.  Assumption is that fan runs all the time and speed/airflow is tuned to appropriate levels
 
 PANIC_HOT = 30  # exit if temp too high or too low, these values are set in C
 PANIC_COLD = 4
+PANIC_CONFIRM_TIME = 10  # seconds the temperature must stay out of range before we panic
+SENSOR_FAILURE_LIMIT = 10  # Sensor reads in a row that can fail (skipped, with an alert) before we shut down
 
 # Location of the software watchdog file.
 # Set the following variable to point to the appropriate path for where your script is running
 # During development this is running in a venv so very local.
 SOFTDOG_FILE = "PiCuterie.softdog"
+SOFTDOG_INTERVAL = 10  # Seconds between pats
+SOFTDOG_MAX_STALL = 3 * SLEEP_SECONDS  # Stop patting if no control decision for this long
+
+# Local SQLite DB holding settings and logs.
+DB_FILE = "SBCuterieDB.db"
+DEFAULT_PROFILE_ID = 1  # Settings profile made active on a new DB, switch with the ACTIVEPROFILE table
+SCHEDULE_RAMP_STEP = 60  # Seconds between setpoint updates while a schedule is ramping
+LOG_FLUSH_ROWS = 100  # Write queued log rows once this many are waiting
+LOG_FLUSH_INTERVAL = 300  # and at least this often (seconds) so not much is lost on a power cut
+LOG_SYNCHRONOUS = "NORMAL"  # SQLite synchronous setting for the log connection, NORMAL is safe with WAL
+LOG_TASK_INTERVAL = 5  # Seconds between checks of the flush thresholds by the logging task
+
+# Log retention, run in the background in slices of at most RETENTION_SLICE_BUDGET seconds.
+RETENTION_ENABLED = True
+RAW_LOG_RETENTION_DAYS = 30  # Raw ENVIROLOG rows older than this are dropped, the rollups keep the history
+MINUTE_ROLLUP_RETENTION_DAYS = 180  # Minute rollups older than this are dropped, hour/day are kept
+EVENT_COMPACT_AFTER_DAYS = 1  # Repeated "State:" events older than this are dropped
+RETENTION_SLICE_BUDGET = 0.005  # Seconds of DB work per slice
+RETENTION_INTERVAL = 60  # Seconds between slices once caught up
+
+# Band tuner (tune_bands.py, see modules/band_tuner.py), run nightly from cron.
+BAND_TUNER_HISTORY_DAYS = 7  # Days of hour rollups the recommendation is made from
+BAND_TUNER_TARGET_STARTS = 3.0  # Compressor starts per hour to aim for
+BAND_TUNER_MAX_TEMP_ERROR = 3.0  # C, never widen the band so far the chamber strays further than this
+BAND_TUNER_MAX_HUMIDITY_ERROR = 8.0  # %RH, the same for the humidity band
+BAND_TUNER_MIN_TEMP_BAND = 0.3  # C, narrowest temperature band recommended
+BAND_TUNER_MIN_HUMIDITY_BAND = 1.0  # %RH, narrowest humidity band recommended
+BAND_TUNER_MAX_STEP = 0.5  # Largest change per run, as a fraction of the current band
 
 # Email info to allow sending of Alerts via default channel.
 # Setting defaults to gmail due to the odds.
@@ -59,3 +127,9 @@ SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587  # for TLS
 SENDER_EMAIL = "my@gmail.com"
 EMAIL_PASSWORD = "you be careful with this"
+
+# Alerts are queued and mailed from a background thread, see modules/alerts.py.
+ALERT_QUEUE_SIZE = 100  # Alerts waiting to be sent, more are dropped rather than blocking the loop
+ALERT_DEDUP_WINDOW = 600  # Seconds repeats of the same alert are folded into one "repeated N times" mail
+ALERT_MAX_RETRIES = 5  # Send attempts after the first, with backoff doubling from 1 s up to 5 min
+ALERT_CHECK_INTERVAL = 60  # Seconds between checks for failed alert deliveries
@@ -0,0 +1,469 @@
+"""
+Module holding the chamber control decisions as a state machine with no I/O
+
+ChamberController is the temperature/humidity logic that used to live in the main loop
+of SBCuterie.py.  step() takes one set of readings and the time, and returns Commands
+saying what to do: relay changes, humidifier pulses, what to log and what to alert.
+It never touches the relays, the DB or the clock itself (now is passed in, or taken
+from the injectable clock), so the same decisions can be unit tested, replayed over
+ENVIROLOG as fast as the CPU allows (see replay.py) or run against a simulator.
+
+Heating and cooling demands go through an ActuatorArbiter (see arbiter) that enforces
+the minimum on/off times and maximum starts per hour and settles conflicts between the
+temperature and humidity logic.  Pulses are tracked here from the decisions themselves.
+The actuator timers (see timers) still enforce the minimum off time on the hardware side.
+In the "predictive" control mode the compressor is started and stopped, and the heater
+stopped, ahead of the band edges by a model of the chamber learned as it runs
+(see thermal_model).  When the readings are a filtered estimate (see estimator) the
+hysteresis edges are only acted on once the whole confidence interval is past them,
+so noise inside the interval doesn't start the compressor, see beyond().
+"""
+
+import collections
+import time
+
+from .arbiter import (
+    PRIORITY_HUMIDITY,
+    PRIORITY_SAFETY,
+    PRIORITY_TEMPERATURE,
+    ActuatorArbiter,
+)
+from .thermal_model import ChamberModelFit
+
+# What the sensors said: quorum codes and values, as from get_sensor_data(), and the
+# confidence interval half widths when the values are a filtered estimate (None if not)
+Readings = collections.namedtuple(
+    "Readings",
+    [
+        "temp_quorum_code",
+        "temperature",
+        "humidity_quorum_code",
+        "humidity",
+        "temperature_interval",
+        "humidity_interval",
+    ],
+    defaults=[None, None],
+)
+
+DEVICES = ["heating", "cooling", "humidifier", "dehumidifier"]
+
+
+class Commands:
+    # Everything one step() decided, in the order the main loop used to do it
+
+    def __init__(self):
+        self.changes = []  # (device, "ON"/"OFF") relay changes, in order
+        self.pulses = {}  # device -> seconds on, the off is left to a timer
+        self.event = None  # Event text to log with the readings, None if nothing to log
+        self.alerts = []  # (subject, body)
+        self.panic = False  # Everything is off, the controller has to exit
+
+    def __repr__(self):
+        return "Commands(changes={}, pulses={}, event={!r}, alerts={}, panic={})".format(
+            self.changes, self.pulses, self.event, self.alerts, self.panic
+        )
+
+
+class ChamberController:
+    # Hysteresis control of one chamber, see step()
+
+    def __init__(
+        self,
+        settings,
+        schedule=None,
+        heat_idle_time=1,
+        humidifier_duty=4,
+        humidifier_idle_time=60,
+        minimum_off_time=None,
+        minimum_on_time=None,
+        max_starts_per_hour=None,
+        model=None,
+        control_mode="hysteresis",
+        prediction_horizon=1800,
+        panic_hot=30,
+        panic_cold=4,
+        panic_confirm_time=10,
+        lockout=None,
+        clock=time.time,
+    ):
+        self.heat_idle_time = heat_idle_time  # Seconds before cycling heat
+        self.humidifier_duty = humidifier_duty  # Seconds the humidifier runs per pulse
+        self.humidifier_idle_time = humidifier_idle_time  # Seconds between pulses
+        self.minimum_off_time = dict(minimum_off_time or {})  # device -> seconds
+        self.panic_hot = panic_hot
+        self.panic_cold = panic_cold
+        self.panic_confirm_time = panic_confirm_time  # Seconds out of range before we panic
+        self.clock = clock
+        self.model = model  # A ChamberModelFit fed every step, None to not learn one
+        self.control_mode = control_mode  # "hysteresis", or "predictive" to run the compressor off the model
+        self.prediction_horizon = prediction_horizon  # Seconds ahead the model is run
+        self.arbiter = ActuatorArbiter(
+            DEVICES,
+            minimum_on_time=minimum_on_time,
+            minimum_off_time=self.minimum_off_time,
+            max_starts_per_hour=max_starts_per_hour,
+            lockout=lockout,  # The hardware side's minimum off lockout, see ActuatorArbiter
+            clock=clock,
+        )
+        self.held = collections.Counter()  # quantity -> ticks an edge was inside the interval
+        self.update_settings(settings, schedule)
+        self.reset()
+
+    def update_settings(self, settings, schedule=None):
+        """
+        Take a settings dict (as load_db_values() returns) and optionally the
+        compiled schedule to follow.  The schedule is applied on the next step.
+        """
+        self.settings = dict(settings)
+        self.temp_setpoint = settings["CurrentTempSetPoint"]
+        self.temp_overshoot = settings["CurrentTempMaxOvershoot"]
+        self.humidity_setpoint = settings["CurrentHumiditySetpoint"]
+        self.humidity_overshoot = settings["CurrentHumidityMaxOvershoot"]
+        self.control_humidity = settings["ControlHumidity"]
+        self.schedule = schedule
+        self.next_schedule_change = 0
+
+    def reset(self, now=None):
+        # Start over with everything off, as the controller does at startup
+        if now is None:
+            now = self.clock()
+        self.cool_status = "OFF"
+        self.heat_status = "OFF"
+        self.humidifier_status = "OFF"
+        self.dehumidifier_status = "OFF"
+        self.last_heat_time = now
+        self.last_humid_time = now
+        self.state_change = 1  # make sure status gets written
+        self.panic_since = None  # When the temperature first went out of the panic range
+        self.last_temperature = None
+        self.last_humidity = None
+        self.pulse_until = {}  # device -> when its current pulse ends
+        self.on_since_last = {}  # device -> fraction of the last tick it was on, for the model
+        self.arbiter.reset(now)
+
+    @property
+    def relays(self):
+        # What we last told each relay
+        return self.arbiter.relays
+
+    def locked_out(self, device, now):
+        return self.arbiter.locked_out(device, now)
+
+    def pulsing(self, device, now):
+        return now < self.pulse_until.get(device, 0)
+
+    def set(self, device, setting, now, priority):
+        # Ask the arbiter for a relay setting, returns now like set_device_status() does
+        self.arbiter.demand(device, setting, priority)
+        return now
+
+    def pulse(self, commands, device, seconds, now):
+        commands.pulses[device] = seconds
+        self.pulse_until[device] = now + seconds
+        return now
+
+    def beyond(self, quantity, value, edge, interval, above):
+        # True if value is past the band edge (above it, or below it), by more than the
+        # confidence interval when there is one.  Past the edge but not the interval is
+        # counted in held, nothing is switched for it.
+        if not (value >= edge if above else value <= edge):
+            return False
+        if interval and (value - interval < edge if above else value + interval > edge):
+            self.held[quantity] += 1
+            return False
+        return True
+
+    def predictive_cooling(self, temperature, temp_high, temp_low, now):
+        """
+        Start the compressor once starting it now would still see the
+        temperature peak at the top of the band, and stop it once the coast
+        after stopping would bottom out at the bottom of the band, by the
+        model.  It is only stopped early if the chamber would then stay below
+        the top of the band for the whole minimum off time, so stopping never
+        forces a lockout right when cooling is needed again.  Past the band
+        it falls back to the hysteresis rules, and inside the band humidity
+        demands still get their say as they do there.  The arbiter has the
+        last word on minimum on/off times and starts per hour.
+        """
+        horizon = self.prediction_horizon
+        if self.relays["cooling"] == "OFF":
+            peak = max(self.model.trajectory({"cooling": 1.0}, horizon))
+            if temperature >= temp_high or (temperature > temp_low and peak >= temp_high):
+                self.set("cooling", "ON", now, PRIORITY_TEMPERATURE)
+                if not self.locked_out("cooling", now):
+                    self.cool_status = "ON"
+            return
+        if temperature <= temp_low:
+            self.set("cooling", "OFF", now, PRIORITY_TEMPERATURE)
+            return
+        coast = self.model.trajectory({}, max(horizon, self.minimum_off_time.get("cooling", 0)))
+        lockout_steps = int(self.minimum_off_time.get("cooling", 0) / self.model.sample_interval)
+        if min(coast[: int(horizon / self.model.sample_interval)]) <= temp_low and (
+            max(coast[:lockout_steps] or [temperature]) < temp_high
+        ):
+            self.set("cooling", "OFF", now, PRIORITY_TEMPERATURE)
+        elif temperature >= temp_high:
+            # As in hysteresis, a humidity demand doesn't get to stop it above the band
+            self.set("cooling", "ON", now, PRIORITY_TEMPERATURE)
+
+    def predictive_heating(self, temperature, temp_high, temp_low, now):
+        """
+        Stop the heater once the model says the chamber would carry on to the
+        middle of the band without it, rather than heating all the way to the
+        top and handing over to the compressor.  Past the top of the band it
+        is always stopped.
+        """
+        if self.heat_status != "ON":
+            return
+        middle = (temp_high + temp_low) / 2.0
+        on = {"cooling": 1.0} if self.cool_status == "ON" else {}
+        horizon = self.prediction_horizon
+        if temperature >= temp_high or (
+            temperature > temp_low and max(self.model.trajectory(on, horizon)) >= middle
+        ):
+            self.last_heat_time = self.set("heating", "OFF", now, PRIORITY_TEMPERATURE)
+            self.heat_status = "OFF"
+
+    def resolve(self, commands, now):
+        # Let the arbiter settle this tick's demands and bring our view of the relays in line
+        commands.changes = self.arbiter.resolve(now)
+        if commands.changes:
+            self.state_change = 1
+        self.cool_status = self.arbiter.relays["cooling"]
+        self.heat_status = self.arbiter.relays["heating"]
+        # What the model will see as on until the next step
+        self.on_since_last = {
+            device: 1.0 for device, setting in self.arbiter.relays.items() if setting == "ON"
+        }
+        if self.model is not None:
+            for device, seconds in commands.pulses.items():
+                self.on_since_last[device] = min(seconds / self.model.sample_interval, 1.0)
+
+    def correct(self, device, setting, now):
+        # The board didn't carry out a change from the last step, see ActuatorArbiter.correct()
+        self.arbiter.correct(device, setting, now)
+        self.cool_status = self.arbiter.relays["cooling"]
+        self.heat_status = self.arbiter.relays["heating"]
+        if setting == "OFF":
+            self.on_since_last.pop(device, None)
+        else:
+            self.on_since_last[device] = 1.0
+
+    def apply_schedule(self, now):
+        # The setpoints only get recomputed when the schedule says they change:
+        # at the next step, or every ramp step on a ramp.
+        if self.schedule is None or self.next_schedule_change is None:
+            return
+        if now >= self.next_schedule_change:
+            setpoint = self.schedule.setpoint_at(now)
+            if setpoint is not None:
+                self.temp_setpoint, self.humidity_setpoint = setpoint
+            self.next_schedule_change = self.schedule.next_change(now)
+
+    def step(self, readings, now=None):
+        """
+        Make the control decisions for one set of Readings at time now and
+        return them as Commands.
+
+        Main control loop the below state table is identical for humidity
+
+        		Heat delta to cool	-----------------------------		Turn Cooler On
+        		Temp error upper	------------  	Turn Heater Off
+        		Temp Setpoint 		------------<<
+        		Temp error lower	------------  	Turn Cooler Off
+        		Cool delta to Heat	-----------------------------		Turn Heater On
+
+        Temperature and humidity post what they want to the arbiter, temperature
+        outranks humidity where they disagree, and the arbiter decides the relays.
+        """
+        if now is None:
+            now = self.clock()
+        temp_quorum_code, temperature, humidity_quorum_code, humidity = readings[:4]
+        temp_interval = readings.temperature_interval
+        humidity_interval = readings.humidity_interval
+        commands = Commands()
+        self.apply_schedule(now)
+        temp_high = self.temp_setpoint + self.temp_overshoot
+        temp_low = self.temp_setpoint - self.temp_overshoot
+        humidity_high = self.humidity_setpoint + self.humidity_overshoot
+        humidity_low = self.humidity_setpoint - self.humidity_overshoot
+
+        # Check for quorum events in temp or humidity.
+        if (temp_quorum_code != "Good") or (humidity_quorum_code != "Good"):
+            self.state_change = 1
+
+        # Check for PANIC condition
+        # The temperature has to still be out of range panic_confirm_time later.
+        if temperature > self.panic_hot or temperature < self.panic_cold:
+            if self.panic_since is None:
+                self.panic_since = now
+
+            elif now - self.panic_since >= self.panic_confirm_time:
+                commands.alerts.append(
+                    ("Picuterie Temperature Panic", "Chamber TEMP at " + str(temperature))
+                )
+                commands.event = "Temperature Panic - Rebooting"
+                # Set all devices to off, whatever their minimum on times.
+                for device in DEVICES:
+                    self.set(device, "OFF", now, PRIORITY_SAFETY)
+                self.resolve(commands, now)
+                # Pulsed devices aren't the arbiter's, so every relay is told to go off
+                commands.changes = [(device, "OFF") for device in DEVICES]
+                commands.panic = True
+                return commands
+        else:
+            self.panic_since = None
+
+        if self.model is not None:
+            self.model.observe(now, temperature, humidity, self.on_since_last)
+        predictive = self.control_mode == "predictive" and self.model is not None
+        predictive = predictive and self.model.ready()
+
+        # #########################
+        # TEMPERATURE CONTROL LOGIC
+        # #########################
+
+        if predictive:
+            self.predictive_cooling(temperature, temp_high, temp_low, now)
+            self.predictive_heating(temperature, temp_high, temp_low, now)
+
+        elif self.beyond("Temperature", temperature, temp_high, temp_interval, True):
+            # (Heat setpoint + acceptable error) exceeded - heat off and active cool.
+            # Asked every tick so a humidity demand can't switch the cooling off.
+            self.last_heat_time = self.set("heating", "OFF", now, PRIORITY_TEMPERATURE)
+            self.heat_status = "OFF"
+            self.set("cooling", "ON", now, PRIORITY_TEMPERATURE)
+            if not self.locked_out("cooling", now):
+                self.cool_status = "ON"
+
+        # (The old "mainly to avoid overshoot" branch tested t <= low and t > low at
+        # once, so it could never run and is gone.)
+
+        if self.beyond("Temperature", temperature, temp_low, temp_interval, False):
+            # Heat setpoint significantly exceeded so active heat and turn off cooling
+            if now - self.last_heat_time > self.heat_idle_time:
+                if self.heat_status == "OFF":
+                    self.last_heat_time = now
+                self.set("heating", "ON", now, PRIORITY_TEMPERATURE)
+                self.heat_status = "ON"
+                self.set("cooling", "OFF", now, PRIORITY_TEMPERATURE)
+                if self.cool_status == "ON":
+                    self.cool_status = "OFF"
+                    self.dehumidifier_status = "OFF"
+
+        # #########################
+        # HUMIDITY CONTROL LOGIC
+        # #########################
+
+        if self.control_humidity == "YES" and self.beyond(
+            "Humidity", humidity, humidity_high, humidity_interval, True
+        ):
+
+            # unlikely as humidifier is now on its own timer
+            if self.humidifier_status == "ON":
+                self.last_humid_time = self.set(
+                    "humidifier", "OFF", now, PRIORITY_HUMIDITY
+                )
+                self.humidifier_status = "OFF"
+                self.state_change = 1
+
+            # heating and cooling at same time to lower humidity
+            if not self.locked_out("cooling", now):
+                self.last_heat_time = self.set("heating", "ON", now, PRIORITY_HUMIDITY)
+                self.set("cooling", "ON", now, PRIORITY_HUMIDITY)
+
+            self.dehumidifier_status = "ON"  # only if exceeds DELTA
+
+        if self.control_humidity == "YES" and self.beyond(
+            "Humidity", humidity, humidity_low, humidity_interval, False
+        ):
+
+            if self.cool_status == "ON":
+                self.set("cooling", "OFF", now, PRIORITY_HUMIDITY)
+                self.dehumidifier_status = "OFF"
+                self.state_change = 1
+
+            # Need to humidfy if control delta is crossed
+            elif (
+                now - self.last_humid_time >= self.humidifier_idle_time
+                and not self.pulsing("humidifier", now)
+            ):
+                # On now, a timer turns it off humidifier_duty seconds later
+                self.last_humid_time = self.pulse(
+                    commands, "humidifier", self.humidifier_duty, now
+                )
+                self.humidifier_status = "ON"
+                self.state_change = 1
+
+        # One decision per relay for the whole tick
+        self.resolve(commands, now)
+
+        # Write status to log
+        # Only if something changed
+        if (
+            self.state_change == 1
+            or temperature != self.last_temperature
+            or humidity != self.last_humidity
+        ):
+            event = "State:"
+            if self.cool_status == "ON":
+                event = event + "Cooling, "
+            if self.heat_status == "ON":
+                event = event + "Heating, "
+            if self.humidifier_status == "ON":
+                event = event + "Humidifying, "
+            if self.dehumidifier_status == "ON":
+                event = event + "Dehumidifying, "
+            event = event + "TempQuorum" + temp_quorum_code + ", "
+            event = event + "HumiQuorum" + humidity_quorum_code + ", "
+            commands.event = event
+
+            if (temp_quorum_code == "No Sensors Agree") or (
+                humidity_quorum_code == "No Sensors Agree"
+            ):
+                body = (
+                    "Temp Quorum Code is "
+                    + temp_quorum_code
+                    + "\nHumidity Quorum Code is "
+                    + humidity_quorum_code
+                )
+                commands.alerts.append(("Chamber Environmental Sensors Disagree", body))
+
+            self.state_change = 0
+
+            # change status after writing to sheet, otherwise won't show up.
+            self.humidifier_status = "OFF"
+
+        self.last_temperature = temperature
+        self.last_humidity = humidity
+        return commands
+
+
+def build_controller(CONST, settings, schedule=None, clock=time.time, lockout=None):
+    # A ChamberController with the tunables from const.py, learning a model if it is to use one.
+    # lockout is the hardware side's minimum off lockout when there is hardware, see arbiter.
+    model = None
+    if CONST.CONTROL_MODE == "predictive":
+        model = ChamberModelFit(
+            sample_interval=CONST.SLEEP_SECONDS,
+            half_life=CONST.THERMAL_MODEL_HALF_LIFE,
+            min_samples=CONST.THERMAL_MODEL_MIN_SAMPLES,
+        )
+    return ChamberController(
+        settings,
+        schedule=schedule,
+        heat_idle_time=CONST.HEAT_IDLE_TIME,
+        humidifier_duty=CONST.HUMIDIFIER_DUTY,
+        humidifier_idle_time=CONST.HUMIDIFIER_IDLE_TIME,
+        minimum_off_time=CONST.MINIMUM_OFF_TIME,
+        minimum_on_time=CONST.MINIMUM_ON_TIME,
+        max_starts_per_hour=CONST.MAX_STARTS_PER_HOUR,
+        model=model,
+        control_mode=CONST.CONTROL_MODE,
+        prediction_horizon=CONST.PREDICTION_HORIZON,
+        panic_hot=CONST.PANIC_HOT,
+        panic_cold=CONST.PANIC_COLD,
+        panic_confirm_time=CONST.PANIC_CONFIRM_TIME,
+        lockout=lockout,
+        clock=clock,
+    )
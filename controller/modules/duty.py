@@ -0,0 +1,137 @@
+"""
+Module to account relay on time and starts per hour and per day as the relays switch
+
+"How long did the compressor run today" used to mean scanning EVENTLOG strings.  Every
+relay transition is now written as a compact (Time, Device, State) row to RELAYLOG, and
+in the same transaction (see log_writer) the on time and starts of each device are
+added to per hour and per day buckets:
+  - a start counts in the bucket it happened in,
+  - on time is split across every bucket the on period covers,
+  - a device still on is credited up to the end of each batch and its open period
+    carried in RELAYSTATE, so a crash only loses the time since the last flush.
+query_duty() reads the buckets, so a query costs O(buckets) whatever the number of
+transitions.  Buckets are aligned to the unix epoch like the ENVIROLOG rollups.
+"""
+
+# (table, bucket width in seconds), finest first
+DUTY_RESOLUTIONS = [
+    ("RELAYDUTY_1H", 3600),
+    ("RELAYDUTY_1D", 86400),
+]
+
+
+def create_duty_tables(conn):
+    # Create the tables if missing.  Open periods left by a crash were already credited
+    # up to the last flush and the relays are all switched off at startup, so they go.
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS RELAYLOG
+        (Time REAL NOT NULL,
+        Device TEXT NOT NULL,
+        State INT NOT NULL);"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS RELAYLOG_TIME ON RELAYLOG (Time)")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS RELAYSTATE
+        (Device TEXT PRIMARY KEY NOT NULL,
+        OnSince REAL NOT NULL);"""
+    )
+    conn.execute("DELETE FROM RELAYSTATE")
+    for table, resolution in DUTY_RESOLUTIONS:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS {}
+            (Bucket INT NOT NULL,
+            Device TEXT NOT NULL,
+            OnSeconds REAL NOT NULL,
+            Starts INT NOT NULL,
+            PRIMARY KEY (Bucket, Device));""".format(table)
+        )
+
+
+def split(start, end, resolution):
+    # (bucket, seconds) for every bucket start..end covers
+    while start < end:
+        bucket = int(start // resolution) * resolution
+        stop = min(end, bucket + resolution)
+        yield bucket, stop - start
+        start = stop
+
+
+def update_duty(conn, rows, now):
+    """
+    Add a batch of (timestamp, device, on) transitions, in time order, to the
+    duty buckets and credit devices still on up to now.  Call inside the
+    batch transaction.
+    """
+    open_since = dict(conn.execute("SELECT Device, OnSince FROM RELAYSTATE"))
+    changes = {}  # (bucket width, bucket, device) -> [on seconds, starts]
+
+    def credit(device, start, end):
+        for _, resolution in DUTY_RESOLUTIONS:
+            for bucket, seconds in split(start, end, resolution):
+                changes.setdefault((resolution, bucket, device), [0.0, 0])[0] += seconds
+
+    for timestamp, device, on in rows:
+        if on and device not in open_since:
+            open_since[device] = timestamp
+            for _, resolution in DUTY_RESOLUTIONS:
+                bucket = int(timestamp // resolution) * resolution
+                changes.setdefault((resolution, bucket, device), [0.0, 0])[1] += 1
+        elif not on and device in open_since:
+            credit(device, open_since.pop(device), timestamp)
+    for device, since in open_since.items():
+        if now > since:
+            credit(device, since, now)
+            open_since[device] = now
+
+    for table, resolution in DUTY_RESOLUTIONS:
+        conn.executemany(
+            "INSERT INTO {} (Bucket, Device, OnSeconds, Starts) VALUES (?,?,?,?) "
+            "ON CONFLICT(Bucket, Device) DO UPDATE SET "
+            "OnSeconds = OnSeconds + excluded.OnSeconds, "
+            "Starts = Starts + excluded.Starts".format(table),
+            [
+                (bucket, device, seconds, starts)
+                for (width, bucket, device), (seconds, starts) in changes.items()
+                if width == resolution
+            ],
+        )
+    conn.execute("DELETE FROM RELAYSTATE")
+    conn.executemany(
+        "INSERT INTO RELAYSTATE (Device, OnSince) VALUES (?,?)", open_since.items()
+    )
+
+
+def query_duty(conn, start, end, resolution=3600, device=None, now=None):
+    """
+    On time and starts between two unix timestamps, one row per bucket of
+    resolution seconds (3600 or 86400) and device, as
+    (Bucket, Device, OnSeconds, Starts, DutyFraction), ordered by bucket then
+    device.  Buckets are whole, start is rounded down to the bucket it is in.
+    With now given, a device that is still on has its time since the last
+    flush added as well.
+    """
+    table = dict((width, name) for name, width in DUTY_RESOLUTIONS)[resolution]
+    first = int(start // resolution) * resolution
+    where = "Bucket >= ? AND Bucket < ?"
+    params = [first, end]
+    if device is not None:
+        where += " AND Device = ?"
+        params.append(device)
+    totals = {
+        (bucket, name): [seconds, starts]
+        for bucket, name, seconds, starts in conn.execute(
+            "SELECT Bucket, Device, OnSeconds, Starts FROM {} WHERE {}".format(table, where),
+            params,
+        )
+    }
+    if now is not None:
+        for name, since in conn.execute("SELECT Device, OnSince FROM RELAYSTATE"):
+            if device is not None and name != device:
+                continue
+            for bucket, seconds in split(max(since, first), min(now, end), resolution):
+                totals.setdefault((bucket, name), [0.0, 0])[0] += seconds
+    return [
+        (bucket, name, seconds, starts, seconds / resolution)
+        for (bucket, name), (seconds, starts) in sorted(totals.items())
+    ]
+
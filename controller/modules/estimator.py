@@ -0,0 +1,132 @@
+"""
+Module to estimate the chamber temperature and humidity from all the sensors over time
+
+The control logic compared the raw quorum average of each reading against the
+setpoint bands, so sensor noise right at a band edge turned into extra on/off
+decisions.  ChamberEstimator sits between get_sensor_data() and the controller.  For
+each quantity it:
+  - fuses the sensors quorum kept, weighting each by the inverse of its noise
+    variance (as learned by sensor_bias, never below the sensor's rated noise),
+  - runs the fused value through a two state Kalman filter (level and rate of
+    change per second) so the level is smoothed without lagging a steady ramp,
+  - returns an Estimate with the smoothed value, the rate and a confidence
+    interval half width.
+A reading after a long gap (i.e. a restart) starts the filter over from that reading.
+"""
+
+import collections
+import math
+import time
+
+# value and rate (per second) of one quantity, stddev of the value, interval the
+# half width of the confidence interval around it
+Estimate = collections.namedtuple("Estimate", ["value", "rate", "stddev", "interval"])
+
+
+class TrendFilter:
+    # Kalman filter of a level that changes at a slowly wandering rate
+
+    def __init__(self, process_noise, initial_rate_variance=1e-4):
+        self.process_noise = process_noise  # Spectral density of changes in rate, units^2/s^3
+        self.initial_rate_variance = initial_rate_variance  # (units/s)^2
+        self.level = None
+        self.rate = 0.0
+        self.p = None  # Covariance [[level, cross], [cross, rate]] as p00, p01, p11
+        self.last_time = None
+
+    def reset(self, measurement, variance, now):
+        self.level = measurement
+        self.rate = 0.0
+        self.p = [variance, 0.0, self.initial_rate_variance]
+        self.last_time = now
+
+    def update(self, measurement, variance, now):
+        # Fold in one measurement with the given variance, taken at now
+        dt = now - self.last_time
+        p00, p01, p11 = self.p
+        if dt > 0:
+            # Predict: the level moves on at the current rate and the rate may have changed
+            q = self.process_noise
+            self.level += self.rate * dt
+            p00 += dt * (2 * p01 + dt * p11) + q * dt ** 3 / 3
+            p01 += dt * p11 + q * dt ** 2 / 2
+            p11 += q * dt
+            self.last_time = now
+        # Correct with the measurement
+        innovation = measurement - self.level
+        s = p00 + variance
+        k0 = p00 / s
+        k1 = p01 / s
+        self.level += k0 * innovation
+        self.rate += k1 * innovation
+        self.p = [(1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01]
+
+
+class ChamberEstimator:
+    # A TrendFilter per quantity, fed with the sensors quorum kept
+
+    def __init__(
+        self,
+        sensor_noise,
+        process_noise,
+        confidence=1.96,
+        max_gap=600,
+        clock=time.time,
+    ):
+        self.sensor_noise = dict(sensor_noise)  # quantity -> rated noise std of one sensor
+        self.process_noise = dict(process_noise)  # quantity -> TrendFilter process noise
+        self.confidence = confidence  # Interval half width in standard deviations, 1.96 is 95 %
+        self.max_gap = max_gap  # Seconds without a reading before the filter starts over
+        self.clock = clock
+        self.filters = {}  # quantity -> TrendFilter
+        self.estimates = {}  # quantity -> latest Estimate
+
+    def reset(self):
+        # Forget everything, the next reading starts each filter over
+        self.filters = {}
+        self.estimates = {}
+
+    def fuse(self, quantity, values, inliers, noise=None):
+        """
+        Inverse variance weighted mean of the inlier values and its variance.
+        noise gives each sensor's noise std (None where unknown), it is never
+        taken as less than the rated sensor noise.
+        """
+        floor = self.sensor_noise[quantity]
+        total = 0.0
+        weights = 0.0
+        for index, (value, inlier) in enumerate(zip(values, inliers)):
+            if not inlier:
+                continue
+            std = floor
+            if noise is not None and noise[index] is not None:
+                std = max(std, noise[index])
+            weight = 1 / (std * std)
+            total += weight * value
+            weights += weight
+        return total / weights, 1 / weights
+
+    def update(self, quantity, values, inliers, noise=None, now=None):
+        """
+        Add one set of sensor values (inliers marks the ones quorum kept) and
+        return the new Estimate for the quantity.
+        """
+        if now is None:
+            now = self.clock()
+        measurement, variance = self.fuse(quantity, values, inliers, noise)
+        trend = self.filters.get(quantity)
+        if trend is None:
+            trend = self.filters[quantity] = TrendFilter(self.process_noise[quantity])
+        if trend.last_time is None or now - trend.last_time > self.max_gap:
+            trend.reset(measurement, variance, now)
+        else:
+            trend.update(measurement, variance, now)
+        stddev = math.sqrt(max(trend.p[0], 0.0))
+        estimate = Estimate(trend.level, trend.rate, stddev, self.confidence * stddev)
+        self.estimates[quantity] = estimate
+        return estimate
+
+    def interval(self, quantity):
+        # Confidence interval half width of the latest estimate, None before the first one
+        estimate = self.estimates.get(quantity)
+        return None if estimate is None else estimate.interval
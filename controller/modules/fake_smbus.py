@@ -0,0 +1,287 @@
+"""
+Module to stand in for smbus2.SMBus without any I2C hardware
+
+Emulates the parts of the AHT20, TCA9548A and Grove I2C relay board that the
+SBCuterie drivers talk to, so the drivers, get_sensor_data() and set_device_status()
+can all run (and be benchmarked) on a laptop.  Plug it in with
+    i2c_bus.BUS_MANAGER.set_bus_factory(network.get_bus_factory())
+or hand a SharedI2CBus(bus_factory=network.get_bus_factory()) to a driver directly.
+
+Devices answer the same way the real ones would, including an OSError (121, Remote
+I/O error) when nothing acknowledges an address.
+"""
+
+import errno
+import random
+import time
+
+from .AHT20 import (
+    AHT20_CMD_INITIALIZE,
+    AHT20_CMD_MEASURE,
+    AHT20_CMD_SOFTRESET,
+    AHT20_I2CADDR,
+    AHT20_STATUSBIT_BUSY,
+    AHT20_STATUSBIT_CALIBRATED,
+    crc8,
+)
+from .grove_i2c_relay_regular import CMD_CHANNEL_CONTROL, CMD_READ_FIRMWARE_VER
+
+
+def no_ack(i2c_addr):
+    return OSError(
+        errno.EREMOTEIO, "Remote I/O error (no ACK from 0x{:02X})".format(i2c_addr)
+    )
+
+
+class FakeAHT20:
+    # AHT20 that returns configurable temperature/humidity values in real 7 byte frames
+
+    def __init__(
+        self,
+        temperature=13.0,
+        humidity=85.0,
+        noise=0.0,
+        conversion_time=0.075,
+        crc_error_rate=0.0,
+        calibrated=True,
+        clock=time.monotonic,
+        seed=None,
+    ):
+        self.temperature = temperature  # degrees C, the simulator sets these as it runs
+        self.humidity = humidity  # %RH
+        self.temperature_offset = 0.0  # Added to what the sensor reports, i.e. to make one drift
+        self.humidity_offset = 0.0
+        self.noise = noise  # Standard deviation of gaussian noise added to both values
+        self.conversion_time = conversion_time  # Seconds the busy bit stays set
+        self.crc_error_rate = crc_error_rate  # Fraction of frames sent with a bad CRC byte
+        self.calibrated = calibrated
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.measure_started = None
+        self.frame = [0] * 6
+        self.measure_count = 0
+        self.reset_count = 0
+
+    def busy(self):
+        if self.measure_started is None:
+            return False
+        return self.clock() - self.measure_started < self.conversion_time
+
+    def status(self):
+        status = 0
+        if self.busy():
+            status |= 1 << AHT20_STATUSBIT_BUSY
+        if self.calibrated:
+            status |= 1 << AHT20_STATUSBIT_CALIBRATED
+        return status
+
+    def encode_frame(self):
+        # Latch a frame the same way the sensor does at the end of a conversion
+        temperature = self.temperature + self.temperature_offset
+        humidity = self.humidity + self.humidity_offset
+        temperature += self.random.gauss(0, self.noise)
+        humidity += self.random.gauss(0, self.noise)
+        humidity = min(max(humidity, 0.0), 100.0)
+        raw_hum = min(int(humidity / 100 * pow(2, 20)), pow(2, 20) - 1)
+        raw_temp = int((temperature + 50) / 200 * pow(2, 20))
+        raw_temp = min(max(raw_temp, 0), pow(2, 20) - 1)
+        return [
+            0,
+            (raw_hum >> 12) & 0xFF,
+            (raw_hum >> 4) & 0xFF,
+            ((raw_hum & 0xF) << 4) | ((raw_temp >> 16) & 0xF),
+            (raw_temp >> 8) & 0xFF,
+            raw_temp & 0xFF,
+        ]
+
+    def write_i2c_block_data(self, register, data):
+        command = list(data)
+        if command == AHT20_CMD_SOFTRESET:
+            self.measure_started = None
+            self.reset_count += 1
+        elif command == AHT20_CMD_INITIALIZE:
+            self.calibrated = True
+        elif command == AHT20_CMD_MEASURE:
+            self.measure_started = self.clock()
+            self.frame = self.encode_frame()
+            self.measure_count += 1
+
+    def read_i2c_block_data(self, register, length):
+        frame = [self.status()] + self.frame[1:]
+        frame.append(crc8(frame))
+        if length == 7 and self.random.random() < self.crc_error_rate:
+            frame[6] ^= 0xFF
+        return frame[:length]
+
+
+class FakeGroveRelay:
+    # Grove 4/8 channel I2C relay board, keeps the channel mask and counts relay toggles
+
+    def __init__(self, num_relays=4, firmware_version=0x01, clock=time.monotonic):
+        self.num_relays = num_relays
+        self.firmware_version = firmware_version
+        self.clock = clock
+        self.channel_state = 0x00
+        self.register = 0
+        self.write_count = 0
+        self.toggle_count = [0] * num_relays
+        self.listeners = []  # Called with (old_state, new_state) on every mask write
+
+    def is_on(self, relay_num):
+        return bool(self.channel_state & (1 << (relay_num - 1)))
+
+    def write_byte_data(self, register, value):
+        if register == CMD_CHANNEL_CONTROL:
+            old_state = self.channel_state
+            self.channel_state = value & ((1 << self.num_relays) - 1)
+            self.write_count += 1
+            for relay in range(self.num_relays):
+                if (old_state ^ self.channel_state) & (1 << relay):
+                    self.toggle_count[relay] += 1
+            for listener in self.listeners:
+                listener(old_state, self.channel_state)
+        else:
+            self.register = value
+
+    def read_byte_data(self, register):
+        if self.register == CMD_READ_FIRMWARE_VER:
+            return self.firmware_version
+        return self.channel_state
+
+
+class FakeTCA9548A:
+    # TCA9548A mux, devices are attached to its downstream channels (0 through 7)
+
+    def __init__(self):
+        self.channel_mask = 0x00
+        self.channels = [dict() for _ in range(8)]
+        self.write_count = 0
+
+    def attach(self, channel, i2c_addr, device):
+        self.channels[channel][i2c_addr] = device
+        return device
+
+    def downstream(self, i2c_addr):
+        # Every device at i2c_addr on a currently enabled channel
+        return [
+            devices[i2c_addr]
+            for channel, devices in enumerate(self.channels)
+            if self.channel_mask & (1 << channel) and i2c_addr in devices
+        ]
+
+    def write_byte(self, value):
+        self.channel_mask = value & 0xFF
+        self.write_count += 1
+
+    def read_byte(self):
+        return self.channel_mask
+
+
+class FakeI2CNetwork:
+    # Everything hanging off the buses, keyed by bus number then address.
+
+    def __init__(self):
+        self.buses = {}
+        self.muxes = {}  # (bus number, address) -> FakeTCA9548A
+        self.fail_next = 0  # Make the next n transactions raise an OSError, for error paths
+
+    def attach(self, I2CBusNum, i2c_addr, device):
+        self.buses.setdefault(I2CBusNum, {})[i2c_addr] = device
+        if isinstance(device, FakeTCA9548A):
+            self.muxes[(I2CBusNum, i2c_addr)] = device
+        return device
+
+    def find(self, I2CBusNum, i2c_addr):
+        devices = self.buses.get(I2CBusNum, {})
+        if i2c_addr in devices:
+            return devices[i2c_addr]
+        found = []
+        for (bus_num, _), mux in self.muxes.items():
+            if bus_num == I2CBusNum:
+                found.extend(mux.downstream(i2c_addr))
+        if len(found) != 1:
+            # Nobody answered, or two identical devices answered at once and garbled it
+            raise no_ack(i2c_addr)
+        return found[0]
+
+    def get_bus_factory(self):
+        # Drop in replacement for the SMBus class
+        return lambda I2CBusNum: FakeSMBus(I2CBusNum, self)
+
+
+class FakeSMBus:
+    # The subset of the smbus2.SMBus API used by the drivers
+
+    def __init__(self, bus, network):
+        self.I2CBusNum = bus
+        self.network = network
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.closed = True
+
+    def device(self, i2c_addr):
+        if self.closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        if self.network.fail_next > 0:
+            self.network.fail_next -= 1
+            raise no_ack(i2c_addr)
+        return self.network.find(self.I2CBusNum, i2c_addr)
+
+    def write_byte(self, i2c_addr, value):
+        self.device(i2c_addr).write_byte(value)
+
+    def read_byte(self, i2c_addr):
+        return self.device(i2c_addr).read_byte()
+
+    def write_byte_data(self, i2c_addr, register, value):
+        self.device(i2c_addr).write_byte_data(register, value)
+
+    def read_byte_data(self, i2c_addr, register):
+        return self.device(i2c_addr).read_byte_data(register)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        self.device(i2c_addr).write_i2c_block_data(register, data)
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        return self.device(i2c_addr).read_i2c_block_data(register, length)
+
+
+def build_chamber_network(
+    CONST,
+    temperature=13.0,
+    humidity=85.0,
+    noise=0.0,
+    conversion_time=0.075,
+    clock=time.monotonic,
+    seed=None,
+):
+    """
+    Fake network wired the way const.py says the chamber is: a mux on I2C_BUS with
+    an AHT20 on each of the AHT20_MUX_CHANS sensor channels and the relay board on OUT1.
+    Returns the network plus the sensors (in AHT20_MUX_CHANS order) and relay board.
+    """
+    network = FakeI2CNetwork()
+    mux = network.attach(CONST.I2C_BUS, CONST.I2C_MUX_ADDR, FakeTCA9548A())
+    sensors = []
+    for index, channel in enumerate(CONST.AHT20_MUX_CHANS):
+        sensor = FakeAHT20(
+            temperature=temperature,
+            humidity=humidity,
+            noise=noise,
+            conversion_time=conversion_time,
+            clock=clock,
+            seed=None if seed is None else seed + index,
+        )
+        sensors.append(mux.attach(channel, AHT20_I2CADDR, sensor))
+    relay = mux.attach(
+        CONST.OUT1_MUX_CHAN, CONST.RELAY_DEV_ADDRESS, FakeGroveRelay(clock=clock)
+    )
+    return network, sensors, relay
@@ -9,11 +9,13 @@
  to support Python on linux SBCs and this specific relay board family.
  _regular version is for a "typical" python sbc environment i.e.
  not requireing circuitpython but leveraging SMBus calls
+ through the shared bus handle from i2c_bus
 """
 
-from smbus2 import SMBus
 import time
 
+from .i2c_bus import get_bus
+
 # Globals for the object
 CMD_CHANNEL_CONTROL = 0x10
 CMD_SAVE_I2C_ADDR = 0x11
@@ -38,52 +40,87 @@ class RELAY:
         device_address=0x11,
         num_relays=4,
         debug_action=False,
+        i2c_bus=None,
     ):
 
         self.I2CBusNum = i2cbus
+        self.i2c_bus = i2c_bus if i2c_bus is not None else get_bus(i2cbus)
         self.DEVICE_ADDRESS = device_address
         self.NUM_RELAY_PORTS = num_relays  # 4 or 8 are really the only allowed numbers
         self.channel_state = 0x00
+        self.pending_state = 0x00  # Shadow mask staged by stage_channel(), written by commit()
+        self.write_count = 0  # Number of mask writes commit() has actually made
+        self.settle_time = 0.05  # Seconds channel_control() waits for the relays to switch
 
         if debug_action:
             print("Enabling action_output mode")
 
         self.debug = debug_action
 
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_byte_data(
-                self.DEVICE_ADDRESS,
-                CMD_CHANNEL_CONTROL,
-                self.channel_state,
-            )
+        self.i2c_bus.write_byte_data(
+            self.DEVICE_ADDRESS,
+            CMD_CHANNEL_CONTROL,
+            self.channel_state,
+        )
 
     # If you have address conflicts on your I2C bus you can use this function to reset the relay module address
     # Remember to change your address in your code for future instantiations of this object
 
     def change_i2c_address(self, old_address, new_address):
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_i2c_byte_data(
-                self.DEVICE_ADDRESS,
-                CMD_SAVE_I2C_ADDR,
-                new_address,
-            )
-            self.DEVICE_ADDRESS = new_address
+        self.i2c_bus.write_byte_data(
+            self.DEVICE_ADDRESS,
+            CMD_SAVE_I2C_ADDR,
+            new_address,
+        )
+        self.DEVICE_ADDRESS = new_address
         return True
 
     # This function is for when your code keeps track of the full state of all relays and you just want to toggle directly.
     def channel_control(self, state):
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_i2c_byte_data(
-                self.DEVICE_ADDRESS,
-                CMD_CHANNEL_CONTROL,
-                state,
-            )
-            self.channel_state = state
+        self.i2c_bus.write_byte_data(
+            self.DEVICE_ADDRESS,
+            CMD_CHANNEL_CONTROL,
+            state,
+        )
+        self.channel_state = state
+        self.pending_state = state
+        if self.settle_time:
             time.sleep(
-                0.05
+                self.settle_time
             )  # Wait 50ms for activation, probably not needed but fine anyways
         return True
 
+    # Stage a single channel change in the shadow mask.  Nothing is written until commit(),
+    # so a whole control tick worth of on/off decisions ends up as one bus write.
+    def stage_channel(self, relay_num, on):
+        if isinstance(relay_num, int):  # Check that not getting garbage
+            if 0 < relay_num <= self.NUM_RELAY_PORTS:  # check for valid relay number
+                if on:
+                    self.pending_state |= 1 << (relay_num - 1)
+                else:
+                    self.pending_state &= ~(1 << (relay_num - 1))
+                return True
+            else:
+                print("Invalid relay: #{}".format(relay_num))
+                return False
+        else:
+            print("Relay number must be an Integer value")
+            return False
+
+    # Write the staged mask to the board, only if it differs from what the board already has.
+    def commit(self):
+        if self.pending_state == self.channel_state:
+            return False
+        if self.debug:
+            print(
+                "Relay mask {} -> {}".format(
+                    bin(self.channel_state), bin(self.pending_state)
+                )
+            )
+        self.channel_control(self.pending_state)
+        self.write_count += 1
+        return True
+
     # Turn on a single channel
     def channel_on(self, relay_num):
         if isinstance(relay_num, int):  # Check that not getting garbage
@@ -91,12 +128,12 @@ class RELAY:
                 if self.debug:
                     print("Turning relay {} on".format(relay_num))
                 self.channel_state |= 1 << (relay_num - 1)
-                with SMBus(self.I2CBusNum) as i2c_bus:
-                    i2c_bus.write_byte_data(
-                        self.DEVICE_ADDRESS,
-                        CMD_CHANNEL_CONTROL,
-                        self.channel_state,
-                    )
+                self.pending_state = self.channel_state
+                self.i2c_bus.write_byte_data(
+                    self.DEVICE_ADDRESS,
+                    CMD_CHANNEL_CONTROL,
+                    self.channel_state,
+                )
                 return True
             else:
                 print("Invalid relay: #{}".format(relay_num))
@@ -112,12 +149,12 @@ class RELAY:
                 if self.debug:
                     print("Turning relay {} off".format(relay_num))
                 self.channel_state &= ~(1 << (relay_num - 1))
-                with SMBus(self.I2CBusNum) as i2c_bus:
-                    i2c_bus.write_byte_data(
-                        self.DEVICE_ADDRESS,
-                        CMD_CHANNEL_CONTROL,
-                        self.channel_state,
-                    )
+                self.pending_state = self.channel_state
+                self.i2c_bus.write_byte_data(
+                    self.DEVICE_ADDRESS,
+                    CMD_CHANNEL_CONTROL,
+                    self.channel_state,
+                )
                 return True
             else:
                 print("Invalid relay: #{}".format(relay_num))
@@ -131,12 +168,12 @@ class RELAY:
         if self.debug:
             print("Turning all relays ON")
         self.channel_state |= 0xF << 0
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_byte_data(
-                self.DEVICE_ADDRESS,
-                CMD_CHANNEL_CONTROL,
-                int(self.channel_state),
-            )
+        self.pending_state = self.channel_state
+        self.i2c_bus.write_byte_data(
+            self.DEVICE_ADDRESS,
+            CMD_CHANNEL_CONTROL,
+            int(self.channel_state),
+        )
         return True
 
     # Turn off all channels at once.
@@ -144,12 +181,12 @@ class RELAY:
         if self.debug:
             print("Turning all relays OFF")
         self.channel_state &= ~(0xF << 0)
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_byte_data(
-                self.DEVICE_ADDRESS,
-                CMD_CHANNEL_CONTROL,
-                int(self.channel_state),
-            )
+        self.pending_state = self.channel_state
+        self.i2c_bus.write_byte_data(
+            self.DEVICE_ADDRESS,
+            CMD_CHANNEL_CONTROL,
+            int(self.channel_state),
+        )
         return True
 
     # Toggle state for a single relay.  On -> Off, Off -> On
@@ -196,7 +233,7 @@ class RELAY:
     # Query the board and get the current firmware version.
     # 99% of the time people won't need this I suspect but copied as it was part of Arduino ref lib
     def get_firmware_version(self):
-        with SMBus(self.I2CBusNum) as i2c_bus:
-            i2c_bus.write_byte_data(self.DEVICE_ADDRESS, 0, CMD_READ_FIRMWARE_VER)
-            ver = i2c_bus.read_byte_data(self.DEVICE_ADDRESS, 0)
+        with self.i2c_bus:  # Hold the bus so nothing sneaks in between the request and the read
+            self.i2c_bus.write_byte_data(self.DEVICE_ADDRESS, 0, CMD_READ_FIRMWARE_VER)
+            ver = self.i2c_bus.read_byte_data(self.DEVICE_ADDRESS, 0)
         return ver
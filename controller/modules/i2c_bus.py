@@ -0,0 +1,163 @@
+"""
+Module to share long-lived I2C bus handles between the SBCuterie drivers
+requires SMBus2 to be installed
+
+The AHT20, TCA9548A and RELAY drivers used to open a fresh SMBus for every single
+transaction (and the mux never closed its handle at all).  This keeps one persistent
+handle per bus number, serializes access to it with a lock and counts every
+transaction so the I2C cost of a control loop tick can be watched.
+"""
+
+import threading
+
+try:
+    from smbus2 import SMBus
+except ImportError:  # Only a stand-in backend (see fake_smbus) can be used without smbus2
+    SMBus = None
+
+# Transaction types we count, one per SMBus call the drivers make.
+TRANSACTION_TYPES = [
+    "write_byte",
+    "read_byte",
+    "write_byte_data",
+    "read_byte_data",
+    "write_i2c_block_data",
+    "read_i2c_block_data",
+]
+
+
+class SharedI2CBus:
+    # One persistent SMBus handle for a bus number, shared by every driver on that bus.
+    # Use "with bus:" to hold the lock across multi step sequences (i.e. mux switch + sensor read).
+
+    def __init__(self, I2CBusNum=1, bus_factory=SMBus):
+        self.I2CBusNum = I2CBusNum
+        self.bus_factory = bus_factory
+        self.lock = threading.RLock()
+        self.handle = None
+        self.counters = {}
+        self.reset_counters()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+        return False
+
+    def reset_counters(self):
+        # Zero the transaction counters, handle opens and errors are kept in the same dict
+        with self.lock:
+            self.counters = dict.fromkeys(TRANSACTION_TYPES, 0)
+            self.counters["opens"] = 0
+            self.counters["errors"] = 0
+
+    def get_counters(self):
+        # Return a copy of the counters plus the total number of transactions
+        with self.lock:
+            counters = dict(self.counters)
+        counters["transactions"] = sum(counters[name] for name in TRANSACTION_TYPES)
+        return counters
+
+    def open(self):
+        # Open the underlying handle if it is not already open
+        with self.lock:
+            if self.handle is None:
+                if self.bus_factory is None:
+                    raise ImportError("smbus2 is required to talk to a real I2C bus")
+                self.handle = self.bus_factory(self.I2CBusNum)
+                self.counters["opens"] += 1
+            return self.handle
+
+    def close(self):
+        # Close the underlying handle, the next transaction will reopen it
+        with self.lock:
+            if self.handle is not None:
+                try:
+                    self.handle.close()
+                finally:
+                    self.handle = None
+
+    def _transaction(self, name, *args):
+        # Run one SMBus call under the lock.  On a bus error the handle is dropped
+        # so a wedged file descriptor gets replaced on the next call.
+        with self.lock:
+            handle = self.open()
+            self.counters[name] += 1
+            try:
+                return getattr(handle, name)(*args)
+            except OSError:
+                self.counters["errors"] += 1
+                self.close()
+                raise
+
+    def write_byte(self, i2c_addr, value):
+        return self._transaction("write_byte", i2c_addr, value)
+
+    def read_byte(self, i2c_addr):
+        return self._transaction("read_byte", i2c_addr)
+
+    def write_byte_data(self, i2c_addr, register, value):
+        return self._transaction("write_byte_data", i2c_addr, register, value)
+
+    def read_byte_data(self, i2c_addr, register):
+        return self._transaction("read_byte_data", i2c_addr, register)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        return self._transaction("write_i2c_block_data", i2c_addr, register, data)
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        return self._transaction("read_i2c_block_data", i2c_addr, register, length)
+
+
+class I2CBusManager:
+    # Owns one SharedI2CBus per bus number and hands the same one to every driver.
+
+    def __init__(self, bus_factory=SMBus):
+        self.bus_factory = bus_factory
+        self.lock = threading.Lock()
+        self.buses = {}
+
+    def get_bus(self, I2CBusNum=1):
+        with self.lock:
+            if I2CBusNum not in self.buses:
+                self.buses[I2CBusNum] = SharedI2CBus(I2CBusNum, self.bus_factory)
+            return self.buses[I2CBusNum]
+
+    def set_bus_factory(self, bus_factory):
+        # Swap the backend, i.e. to fake_smbus for running without hardware.  Buses
+        # already handed to drivers are switched over too, they reopen on next use.
+        with self.lock:
+            self.bus_factory = bus_factory
+            buses = list(self.buses.values())
+        for bus in buses:
+            with bus.lock:
+                bus.close()
+                bus.bus_factory = bus_factory
+
+    def get_counters(self):
+        # Counters for every bus we have handed out, keyed by bus number
+        with self.lock:
+            buses = list(self.buses.values())
+        return {bus.I2CBusNum: bus.get_counters() for bus in buses}
+
+    def reset_counters(self):
+        with self.lock:
+            buses = list(self.buses.values())
+        for bus in buses:
+            bus.reset_counters()
+
+    def close_all(self):
+        with self.lock:
+            buses = list(self.buses.values())
+        for bus in buses:
+            bus.close()
+
+
+# Process wide manager used by the drivers unless they are handed a bus explicitly.
+BUS_MANAGER = I2CBusManager()
+
+
+def get_bus(I2CBusNum=1):
+    return BUS_MANAGER.get_bus(I2CBusNum)
@@ -0,0 +1,190 @@
+"""
+Module to buffer ENVIROLOG/EVENTLOG rows and write them to the local SQLite DB in batches
+
+write_logs() used to open a new connection for every row pair and never committed.
+The LogWriter holds one connection in WAL mode, queues rows in memory and writes them
+in a single transaction once enough rows are waiting, enough time has passed, or at
+shutdown.  Fewer, larger transactions mean far less write amplification on an SD card.
+The minute/hour/day rollups (see rollups) are updated in the same transaction, as
+are the relay transitions and their hourly/daily duty buckets (see duty).
+Queueing a row only takes queue_lock, so it never waits behind a flush in progress.
+With auto_flush off nothing is written until the owner calls maybe_flush()/flush(),
+i.e. from the logging task rather than in the middle of a control decision.
+"""
+
+import sqlite3
+import threading
+import time
+
+from .duty import create_duty_tables, query_duty, update_duty
+from .rollups import create_rollup_tables, query_history, update_rollups
+
+ENVIROLOG_INSERT = "INSERT INTO ENVIROLOG (Time, Temperature, Humidity) VALUES (?,?,?)"
+EVENTLOG_INSERT = "INSERT INTO EVENTLOG (Time, Event) VALUES (?,?)"
+RELAYLOG_INSERT = "INSERT INTO RELAYLOG (Time, Device, State) VALUES (?,?,?)"
+
+
+class LogWriter:
+    # One long-lived connection plus an in-memory queue per log table.
+
+    def __init__(
+        self,
+        db_file,
+        flush_rows=100,
+        flush_interval=300,
+        synchronous="NORMAL",
+        clock=time.time,
+        auto_flush=True,
+    ):
+        self.db_file = db_file
+        self.flush_rows = flush_rows  # Flush once this many rows are queued across all the tables
+        self.flush_interval = flush_interval  # Seconds, flush at least this often if anything is queued
+        self.clock = clock
+        self.auto_flush = auto_flush  # Flush from log_*/write() once a threshold is crossed
+        self.lock = threading.RLock()  # Serializes every use of the connection
+        self.queue_lock = threading.Lock()  # Guards the row queues only
+        self.envirolog_rows = []
+        self.eventlog_rows = []
+        self.relaylog_rows = []
+        self.last_flush = clock()
+        self.rows_written = 0
+        self.flush_count = 0
+
+        # check_same_thread is off as the lock above serializes every use of the connection
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        # Only takes effect on a new DB, lets retention give freed pages back bit by bit
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is safe with WAL (a power cut can lose the last commit, never corrupt the DB)
+        self.conn.execute("PRAGMA synchronous=" + synchronous)
+        self.create_tables()
+
+    def create_tables(self):
+        # Same layout as database/initializedb.py, only created if missing
+        with self.lock:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS ENVIROLOG
+                (Time INT NOT NULL,
+                Temperature REAL NOT NULL,
+                Humidity REAL NOT NULL);"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS EVENTLOG
+                (Time INT NOT NULL,
+                Event TEXT);"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ENVIROLOG_TIME ON ENVIROLOG (Time)"
+            )
+            create_rollup_tables(self.conn)
+            create_duty_tables(self.conn)
+            self.conn.commit()
+
+    def pending(self):
+        return len(self.envirolog_rows) + len(self.eventlog_rows) + len(self.relaylog_rows)
+
+    def log_environment(self, temperature, humidity, timestamp=None, devices_on=None):
+        # devices_on is the set of relay device names that were on, for the duty rollups
+        if timestamp is None:
+            timestamp = self.clock()
+        with self.queue_lock:
+            self.envirolog_rows.append((timestamp, temperature, humidity, devices_on))
+        if self.auto_flush:
+            self.maybe_flush()
+
+    def log_event(self, event, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        with self.queue_lock:
+            self.eventlog_rows.append((timestamp, event))
+        if self.auto_flush:
+            self.maybe_flush()
+
+    def log_relay(self, device, on, timestamp=None):
+        # A relay transition, for the duty cycle accounting
+        if timestamp is None:
+            timestamp = self.clock()
+        with self.queue_lock:
+            self.relaylog_rows.append((timestamp, device, 1 if on else 0))
+        if self.auto_flush:
+            self.maybe_flush()
+
+    def write(self, temperature, humidity, event, timestamp=None, devices_on=None):
+        # Queue a matching ENVIROLOG and EVENTLOG row, the same pair write_logs() has always written
+        if timestamp is None:
+            timestamp = self.clock()
+        with self.queue_lock:
+            self.envirolog_rows.append((timestamp, temperature, humidity, devices_on))
+            self.eventlog_rows.append((timestamp, event))
+        if self.auto_flush:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        # Flush if the size or time threshold has been crossed
+        pending = self.pending()
+        if pending >= self.flush_rows or (
+            pending and self.clock() - self.last_flush >= self.flush_interval
+        ):
+            return self.flush()
+        return 0
+
+    def flush(self):
+        # Write everything queued in one transaction, returns the number of rows written
+        with self.lock:
+            with self.queue_lock:
+                envirolog_rows = self.envirolog_rows
+                eventlog_rows = self.eventlog_rows
+                relaylog_rows = self.relaylog_rows
+                self.envirolog_rows = []
+                self.eventlog_rows = []
+                self.relaylog_rows = []
+            self.last_flush = self.clock()
+            if not envirolog_rows and not eventlog_rows and not relaylog_rows:
+                return 0
+            try:
+                with self.conn:  # Commits on success, rolls back on error
+                    self.write_batch(envirolog_rows, eventlog_rows, relaylog_rows)
+            except Exception:
+                # Put the rows back in front of anything queued since, for the next flush
+                with self.queue_lock:
+                    self.envirolog_rows[:0] = envirolog_rows
+                    self.eventlog_rows[:0] = eventlog_rows
+                    self.relaylog_rows[:0] = relaylog_rows
+                raise
+            rows = len(envirolog_rows) + len(eventlog_rows) + len(relaylog_rows)
+            self.rows_written += rows
+            self.flush_count += 1
+            return rows
+
+    def write_batch(self, envirolog_rows, eventlog_rows, relaylog_rows=()):
+        # Runs inside the flush transaction
+        self.conn.executemany(ENVIROLOG_INSERT, [row[:3] for row in envirolog_rows])
+        self.conn.executemany(EVENTLOG_INSERT, eventlog_rows)
+        self.conn.executemany(RELAYLOG_INSERT, relaylog_rows)
+        update_rollups(self.conn, envirolog_rows)
+        update_duty(self.conn, relaylog_rows, self.last_flush)
+
+    def query_history(self, start, end, max_points=500, raw_interval=30):
+        # History at the best resolution that fits max_points, see rollups.query_history().
+        # Flushes first so queued rows are included.
+        with self.lock:
+            self.flush()
+            return query_history(self.conn, start, end, max_points, raw_interval)
+
+    def query_duty(self, start, end, resolution=3600, device=None):
+        # Relay on time and starts per hour or day, see duty.query_duty().
+        # Flushes first so queued transitions are included.
+        with self.lock:
+            self.flush()
+            return query_duty(self.conn, start, end, resolution, device, now=self.clock())
+
+    def close(self):
+        # Flush whatever is left and close the connection, safe to call more than once
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                self.flush()
+            finally:
+                self.conn.close()
+                self.conn = None
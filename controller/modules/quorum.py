@@ -0,0 +1,162 @@
+"""
+Module to find the reading a set of sensors agree on
+uses NumPy when it is installed, plain Python otherwise
+
+quorum_check() used to take exactly three values and walk a hand written table of
+which pairs agreed.  quorum() takes any number of sensors: a sensor is an inlier if it
+is within delta_max of the median of all of them, and there is a quorum when more than
+half are inliers.  For three sensors this gives exactly the old answers.  With
+mad_threshold set the tolerance also widens to that many (normal scaled) median
+absolute deviations, for arrays of noisy sensors where a fixed delta is too tight.
+
+Pass one reading per sensor for one result, or a 2-D batch (one row per sample, one
+column per sensor) to check a whole history in one call.  With NumPy the batch is
+done in array operations, without it the rows are done one at a time.
+reading() turns one result into the code string and value the controller logs.
+"""
+
+import collections
+import math
+import statistics
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # The pure Python path below gives the same results, only slower on batches
+    np = None
+
+QUORUM_GOOD = 0  # Every sensor agrees with every other
+QUORUM_DISAGREES = 1  # Quorum, but one or more sensors are outliers, see inliers
+QUORUM_NO_AGREEMENT = 2  # No majority agrees, there is no usable value
+QUORUM_LARGE_SPREAD = 3  # No outliers, but the ends of the spread disagree with each other
+
+MAD_SCALE = 1.4826  # Makes the MAD comparable to a standard deviation for normal noise
+
+# value is the mean of the inliers (nan without a quorum), inliers says which sensors
+# count, spread is the range across all the sensors, median/mad are what inliers came from.
+QuorumResult = collections.namedtuple(
+    "QuorumResult", ["code", "value", "inliers", "spread", "median", "mad"]
+)
+
+
+def quorum(values, delta_max, mad_threshold=None):
+    """
+    Check the sensor values against each other.  values is a list of one
+    reading per sensor or a 2-D batch of them (rows are samples).  Returns a
+    QuorumResult, of scalars for a single sample or of arrays (lists without
+    NumPy) with one entry per row for a batch.
+    """
+    if np is not None:
+        return quorum_numpy(values, delta_max, mad_threshold)
+    if values and isinstance(values[0], (list, tuple)):
+        results = [quorum_row(row, delta_max, mad_threshold) for row in values]
+        return QuorumResult(*(list(column) for column in zip(*results)))
+    return quorum_row(values, delta_max, mad_threshold)
+
+
+def classify(inlier_count, sensors, inliers_agree):
+    if inlier_count * 2 <= sensors:
+        return QUORUM_NO_AGREEMENT
+    if inlier_count < sensors:
+        return QUORUM_DISAGREES
+    if inliers_agree:
+        return QUORUM_GOOD
+    return QUORUM_LARGE_SPREAD
+
+
+def quorum_row(values, delta_max, mad_threshold=None):
+    # One sample, plain Python
+    median = statistics.median(values)
+    deviations = [abs(value - median) for value in values]
+    mad = statistics.median(deviations)
+    tolerance = delta_max
+    if mad_threshold is not None:
+        tolerance = max(tolerance, mad_threshold * MAD_SCALE * mad)
+    inliers = [deviation <= tolerance for deviation in deviations]
+    kept = [value for value, inlier in zip(values, inliers) if inlier]
+    # Every pair of inliers within delta_max of each other, i.e. so is their range
+    inliers_agree = not kept or max(kept) - min(kept) <= delta_max
+    code = classify(len(kept), len(values), inliers_agree)
+    value = math.nan if code == QUORUM_NO_AGREEMENT else sum(kept) / len(kept)
+    return QuorumResult(code, value, inliers, max(values) - min(values), median, mad)
+
+
+def quorum_numpy(values, delta_max, mad_threshold=None):
+    # Any number of samples at once, NumPy
+    values = np.asarray(values, dtype=float)
+    single = values.ndim == 1
+    values = np.atleast_2d(values)
+    sensors = values.shape[1]
+
+    median = np.median(values, axis=1)
+    deviations = np.abs(values - median[:, None])
+    mad = np.median(deviations, axis=1)
+    tolerance = np.full(len(values), float(delta_max))
+    if mad_threshold is not None:
+        tolerance = np.maximum(tolerance, mad_threshold * MAD_SCALE * mad)
+    inliers = deviations <= tolerance[:, None]
+    inlier_count = inliers.sum(axis=1)
+
+    # Pairwise agreement between every two inliers, (samples, sensors, sensors)
+    pairs = np.abs(values[:, :, None] - values[:, None, :]) <= delta_max
+    both = inliers[:, :, None] & inliers[:, None, :]
+    inliers_agree = np.all(pairs | ~both, axis=(1, 2))
+
+    code = np.select(
+        [
+            inlier_count * 2 <= sensors,
+            inlier_count < sensors,
+            inliers_agree,
+        ],
+        [QUORUM_NO_AGREEMENT, QUORUM_DISAGREES, QUORUM_GOOD],
+        QUORUM_LARGE_SPREAD,
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        value = np.where(inliers, values, 0.0).sum(axis=1) / inlier_count
+    value = np.where(code == QUORUM_NO_AGREEMENT, np.nan, value)
+    spread = values.max(axis=1) - values.min(axis=1)
+
+    if single:
+        return QuorumResult(
+            int(code[0]),
+            float(value[0]),
+            inliers[0].tolist(),
+            float(spread[0]),
+            float(median[0]),
+            float(mad[0]),
+        )
+    return QuorumResult(code, value, inliers, spread, median, mad)
+
+
+def describe(result, names):
+    """
+    The quorum code string the controller logs and checks for one result, i.e.
+    "Good", "Sensor X Disagrees", "Sensors X, Z Disagree", "No Sensors Agree"
+    or "Large Spread".  names labels the sensors in order.
+    """
+    if result.code == QUORUM_GOOD:
+        return "Good"
+    if result.code == QUORUM_NO_AGREEMENT:
+        return "No Sensors Agree"
+    if result.code == QUORUM_LARGE_SPREAD:
+        return "Large Spread"
+    outliers = [name for name, inlier in zip(names, result.inliers) if not inlier]
+    if len(outliers) == 1:
+        return "Sensor " + outliers[0] + " Disagrees"
+    return "Sensors " + ", ".join(outliers) + " Disagree"
+
+
+def reading(name, result, names, values):
+    """
+    The (code string, value) to log for one result of quantity name, e.g.
+    "Temperature", with what went wrong written to stderr.  Without a quorum
+    the value is 0, as the controller has always logged it, not nan.  values
+    are the raw readings, for the message.
+    """
+    code = describe(result, names)
+    if result.code == QUORUM_NO_AGREEMENT:
+        sys.stderr.write("None of the " + name + " Sensors agree.\n")
+        return code, 0
+    if result.code != QUORUM_GOOD:
+        sys.stderr.write(name + " quorum: " + code + ", readings " + str(values) + "\n")
+    return code, round(result.value, 1)
@@ -0,0 +1,189 @@
+"""
+Module to age out and compact the SQLite logs a few milliseconds at a time
+
+Without retention ENVIROLOG and EVENTLOG grow for as long as the system runs, which on
+a small SD card eventually makes queries and backups slow.  The RetentionEngine:
+  - deletes raw ENVIROLOG and RELAYLOG rows older than the raw retention, they are
+    already covered by the rollups (see rollups) and duty buckets (see duty),
+  - deletes minute rollups older than their own retention, hour/day rollups are kept,
+  - drops repeats from EVENTLOG, a "State:" event identical to the one before it adds
+    nothing once it is older than the compaction age,
+  - gives the freed pages back with PRAGMA incremental_vacuum.
+Every piece of work is done in small batches inside run_slice(), which stops once its
+time budget is spent, and shares the LogWriter connection and lock.
+"""
+
+import threading
+import time
+
+DAY = 86400
+
+
+class RetentionEngine:
+    # Time-bounded retention/compaction for the log tables behind one LogWriter
+
+    def __init__(
+        self,
+        log_writer,
+        raw_retention=30 * DAY,
+        minute_rollup_retention=180 * DAY,
+        event_compact_age=DAY,
+        slice_budget=0.005,
+        vacuum_pages=64,
+        clock=time.time,
+    ):
+        self.log_writer = log_writer
+        self.raw_retention = raw_retention  # Seconds, None to keep raw rows forever
+        self.minute_rollup_retention = minute_rollup_retention  # Seconds, None to keep forever
+        self.event_compact_age = event_compact_age  # Seconds, None to never compact
+        self.slice_budget = slice_budget  # Seconds of work per run_slice()
+        self.vacuum_pages = vacuum_pages  # Pages to free per incremental_vacuum step
+        self.clock = clock
+        self.batch_size = 200  # Rows per statement, adjusted to fit the budget
+        self.rows_deleted = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        with self.log_writer.lock:
+            self.log_writer.conn.execute(
+                """CREATE TABLE IF NOT EXISTS RETENTIONSTATE
+                (Key TEXT PRIMARY KEY NOT NULL,
+                Value);"""
+            )
+            self.log_writer.conn.commit()
+
+    def get_state(self, key, default=None):
+        row = self.log_writer.conn.execute(
+            "SELECT Value FROM RETENTIONSTATE WHERE Key = ?", (key,)
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        self.log_writer.conn.execute(
+            "INSERT OR REPLACE INTO RETENTIONSTATE (Key, Value) VALUES (?,?)",
+            (key, value),
+        )
+
+    def enable_incremental_vacuum(self):
+        """
+        Switch an existing DB to auto_vacuum=INCREMENTAL.  This needs one full
+        VACUUM, which can take a while on a big DB, so only call it at startup.
+        New DBs made by LogWriter or initializedb.py already have it.
+        """
+        with self.log_writer.lock:
+            if self.log_writer.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.log_writer.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self.log_writer.conn.execute("VACUUM")
+
+    def run_slice(self, budget=None):
+        """
+        Do up to budget seconds of retention work.  Returns True if there is
+        more to do, so a caller can come back sooner.
+        """
+        budget = self.slice_budget if budget is None else budget
+        deadline = time.perf_counter() + budget
+        now = self.clock()
+        steps = []
+        if self.raw_retention:
+            steps.append(
+                lambda: self.delete_older("ENVIROLOG", "Time", now - self.raw_retention)
+            )
+            # Raw relay transitions too, the duty buckets (see duty) keep their totals
+            steps.append(
+                lambda: self.delete_older("RELAYLOG", "Time", now - self.raw_retention)
+            )
+        if self.minute_rollup_retention:
+            steps.append(
+                lambda: self.delete_older(
+                    "ENVIROLOG_1M", "Bucket", now - self.minute_rollup_retention
+                )
+            )
+        if self.event_compact_age:
+            steps.append(lambda: self.compact_events(now - self.event_compact_age))
+        steps.append(self.vacuum_step)
+
+        for step in steps:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                with self.log_writer.lock:
+                    with self.log_writer.conn:
+                        more = step()
+                self.tune_batch(time.perf_counter() - started, budget)
+                if not more:
+                    break
+            else:
+                return True  # Out of time with this step unfinished
+        return False
+
+    def tune_batch(self, elapsed, budget):
+        # Keep each statement to a fraction of the budget so one batch can't blow through it
+        if elapsed > budget / 2:
+            self.batch_size = max(10, self.batch_size // 2)
+        elif elapsed < budget / 8:
+            self.batch_size = min(5000, self.batch_size * 2)
+
+    def delete_older(self, table, column, cutoff):
+        # Delete one batch of rows older than cutoff, True if a full batch went (maybe more left)
+        cursor = self.log_writer.conn.execute(
+            "DELETE FROM {0} WHERE rowid IN "
+            "(SELECT rowid FROM {0} WHERE {1} < ? LIMIT ?)".format(table, column),
+            (cutoff, self.batch_size),
+        )
+        self.rows_deleted += cursor.rowcount
+        return cursor.rowcount == self.batch_size
+
+    def compact_events(self, cutoff):
+        # Walk EVENTLOG in rowid order from where we left off, dropping "State:" events that
+        # repeat the event just before them.  Progress is kept in RETENTIONSTATE.
+        conn = self.log_writer.conn
+        last_rowid = self.get_state("EventCompactRowid", 0)
+        last_event = self.get_state("EventCompactLast")
+        rows = conn.execute(
+            "SELECT rowid, Event FROM EVENTLOG WHERE rowid > ? AND Time < ? "
+            "ORDER BY rowid LIMIT ?",
+            (last_rowid, cutoff, self.batch_size),
+        ).fetchall()
+        repeats = []
+        for rowid, event in rows:
+            if event == last_event and event is not None and event.startswith("State:"):
+                repeats.append((rowid,))
+            last_event = event
+            last_rowid = rowid
+        if repeats:
+            conn.executemany("DELETE FROM EVENTLOG WHERE rowid = ?", repeats)
+            self.rows_deleted += len(repeats)
+        self.set_state("EventCompactRowid", last_rowid)
+        self.set_state("EventCompactLast", last_event)
+        return len(rows) == self.batch_size
+
+    def vacuum_step(self):
+        # Hand a few free pages back to the filesystem, True while free pages remain
+        conn = self.log_writer.conn
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return False
+        if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+            return False
+        conn.execute("PRAGMA incremental_vacuum({})".format(self.vacuum_pages))
+        return conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+
+    def start(self, interval=60, busy_interval=1):
+        # Run slices on a background thread: every busy_interval seconds while there is
+        # work left, every interval seconds once caught up.
+        def run():
+            while not self.stop_event.is_set():
+                try:
+                    more = self.run_slice()
+                except Exception as e:
+                    more = False
+                    print("Retention slice failed:", e)
+                self.stop_event.wait(busy_interval if more else interval)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=run, name="retention", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,230 @@
+"""
+Module to keep minute/hour/day rollups of ENVIROLOG in step with the raw log
+
+ENVIROLOG gets a row every SLEEP_SECONDS for the whole cure, so charting any real
+span from it means reading hundreds of thousands of rows.  The rollup tables hold
+count/min/max/sum of temperature and humidity plus how many samples each relay was
+on for, per 1 minute, 1 hour and 1 day bucket.  They are updated incrementally in
+the same transaction that writes the raw rows (see log_writer), and
+query_history() reads whichever resolution fits the requested range and point budget.
+Retention (see retention) drops raw rows and then minute rollups after a while, so a
+source that no longer goes back to the start of the range is passed over for the next
+coarser one that does.
+
+Buckets are aligned to the unix epoch, so day buckets run midnight to midnight UTC.
+"""
+
+# (table, bucket width in seconds), finest first
+ROLLUP_RESOLUTIONS = [
+    ("ENVIROLOG_1M", 60),
+    ("ENVIROLOG_1H", 3600),
+    ("ENVIROLOG_1D", 86400),
+]
+
+# Devices we track duty for and the column holding their on sample count
+DEVICE_COLUMNS = {
+    "heating": "HeatingOn",
+    "cooling": "CoolingOn",
+    "humidifier": "HumidifierOn",
+    "dehumidifier": "DehumidifierOn",
+}
+
+ROLLUP_COLUMNS = [
+    "Bucket",
+    "Count",
+    "TempMin",
+    "TempMax",
+    "TempSum",
+    "HumMin",
+    "HumMax",
+    "HumSum",
+    "RelaySamples",
+] + list(DEVICE_COLUMNS.values())
+
+
+def create_rollup_tables(conn):
+    # Create the rollup tables if missing, and backfill them if the raw log predates them
+    missing = []
+    for table, resolution in ROLLUP_RESOLUTIONS:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if not exists:
+            missing.append(table)
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS {}
+            (Bucket INT PRIMARY KEY NOT NULL,
+            Count INT NOT NULL,
+            TempMin REAL NOT NULL,
+            TempMax REAL NOT NULL,
+            TempSum REAL NOT NULL,
+            HumMin REAL NOT NULL,
+            HumMax REAL NOT NULL,
+            HumSum REAL NOT NULL,
+            RelaySamples INT NOT NULL,
+            {} INT NOT NULL);""".format(
+                table, " INT NOT NULL,\n            ".join(DEVICE_COLUMNS.values())
+            )
+        )
+    if missing:
+        rebuild_rollups(conn, missing)
+
+
+def rebuild_rollups(conn, tables=None):
+    # Recompute rollups (all of them unless tables is given) from the raw ENVIROLOG.
+    # Relay duty isn't in the raw log so rebuilt buckets have RelaySamples = 0.
+    zero_devices = ", ".join("0" for _ in DEVICE_COLUMNS)
+    for table, resolution in ROLLUP_RESOLUTIONS:
+        if tables is not None and table not in tables:
+            continue
+        conn.execute("DELETE FROM " + table)
+        conn.execute(
+            """INSERT INTO {table} ({columns})
+            SELECT CAST(Time / {res} AS INT) * {res}, COUNT(*),
+                MIN(Temperature), MAX(Temperature), SUM(Temperature),
+                MIN(Humidity), MAX(Humidity), SUM(Humidity), 0, {zeros}
+            FROM ENVIROLOG GROUP BY CAST(Time / {res} AS INT)""".format(
+                table=table,
+                columns=", ".join(ROLLUP_COLUMNS),
+                res=resolution,
+                zeros=zero_devices,
+            )
+        )
+
+
+def aggregate(rows, resolution):
+    # Fold (timestamp, temperature, humidity, devices_on) rows into one row per bucket
+    buckets = {}
+    for timestamp, temperature, humidity, devices_on in rows:
+        bucket = int(timestamp // resolution) * resolution
+        agg = buckets.get(bucket)
+        if agg is None:
+            agg = [bucket, 0, temperature, temperature, 0.0, humidity, humidity, 0.0, 0]
+            agg += [0] * len(DEVICE_COLUMNS)
+            buckets[bucket] = agg
+        agg[1] += 1
+        agg[2] = min(agg[2], temperature)
+        agg[3] = max(agg[3], temperature)
+        agg[4] += temperature
+        agg[5] = min(agg[5], humidity)
+        agg[6] = max(agg[6], humidity)
+        agg[7] += humidity
+        if devices_on is not None:
+            agg[8] += 1
+            for index, device in enumerate(DEVICE_COLUMNS):
+                if device in devices_on:
+                    agg[9 + index] += 1
+    return list(buckets.values())
+
+
+def upsert_sql(table):
+    merge = [
+        "Count = Count + excluded.Count",
+        "TempMin = MIN(TempMin, excluded.TempMin)",
+        "TempMax = MAX(TempMax, excluded.TempMax)",
+        "TempSum = TempSum + excluded.TempSum",
+        "HumMin = MIN(HumMin, excluded.HumMin)",
+        "HumMax = MAX(HumMax, excluded.HumMax)",
+        "HumSum = HumSum + excluded.HumSum",
+        "RelaySamples = RelaySamples + excluded.RelaySamples",
+    ] + [
+        "{0} = {0} + excluded.{0}".format(column) for column in DEVICE_COLUMNS.values()
+    ]
+    return "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT(Bucket) DO UPDATE SET {}".format(
+        table,
+        ", ".join(ROLLUP_COLUMNS),
+        ",".join("?" for _ in ROLLUP_COLUMNS),
+        ", ".join(merge),
+    )
+
+
+def update_rollups(conn, rows):
+    # Merge a batch of raw rows into every rollup table, call inside the batch transaction
+    if not rows:
+        return
+    for table, resolution in ROLLUP_RESOLUTIONS:
+        conn.executemany(upsert_sql(table), aggregate(rows, resolution))
+
+
+def oldest_rows(conn, raw_interval):
+    # (table, time of its oldest row or None, bucket seconds) per source, finest first
+    sources = [("ENVIROLOG", raw_interval)] + ROLLUP_RESOLUTIONS
+    return [
+        (
+            table,
+            conn.execute(
+                "SELECT MIN({}) FROM {}".format(
+                    "Time" if table == "ENVIROLOG" else "Bucket", table
+                )
+            ).fetchone()[0],
+            resolution,
+        )
+        for table, resolution in sources
+    ]
+
+
+def aged_out(oldest, index, start):
+    # True if the source at oldest[index] has lost the start of the range to retention,
+    # i.e. a coarser source still has a whole bucket from before its oldest row
+    first = oldest[index][1]
+    if first is None or first <= start:
+        return False
+    return any(
+        coarser is not None and coarser + resolution <= first
+        for table, coarser, resolution in oldest[index + 1 :]
+    )
+
+
+def choose_resolution(start, end, max_points, raw_interval, oldest=None):
+    """
+    Pick the finest source that returns no more than max_points rows for
+    start..end.  Returns (table, bucket seconds), ENVIROLOG itself being the
+    finest with one row per raw_interval.  Falls back to the daily rollup.
+    oldest, from oldest_rows(), lets sources that retention has trimmed past
+    start be skipped.
+    """
+    span = max(end - start, 0)
+    sources = [("ENVIROLOG", raw_interval)] + ROLLUP_RESOLUTIONS
+    for index, (table, resolution) in enumerate(sources):
+        if span / resolution > max_points:
+            continue
+        if oldest is not None and aged_out(oldest, index, start):
+            continue
+        return table, resolution
+    return ROLLUP_RESOLUTIONS[-1]
+
+
+def query_history(conn, start, end, max_points=500, raw_interval=30):
+    """
+    History between two unix timestamps at the finest resolution that fits in
+    max_points, and that still goes back to start.  Returns (resolution
+    seconds, rows) where each row is
+    (Time, Count, TempMin, TempMax, TempMean, HumMin, HumMax, HumMean, duty...)
+    with one duty fraction per DEVICE_COLUMNS entry (None where unknown).
+    """
+    table, resolution = choose_resolution(
+        start, end, max_points, raw_interval, oldest_rows(conn, raw_interval)
+    )
+    if table == "ENVIROLOG":
+        nones = (None,) * len(DEVICE_COLUMNS)
+        rows = conn.execute(
+            "SELECT Time, Temperature, Humidity FROM ENVIROLOG "
+            "WHERE Time >= ? AND Time < ? ORDER BY Time",
+            (start, end),
+        )
+        return resolution, [
+            (time, 1, temp, temp, temp, hum, hum, hum) + nones
+            for time, temp, hum in rows
+        ]
+
+    duties = ", ".join(
+        "CASE WHEN RelaySamples > 0 THEN 1.0 * {} / RelaySamples END".format(column)
+        for column in DEVICE_COLUMNS.values()
+    )
+    rows = conn.execute(
+        "SELECT Bucket, Count, TempMin, TempMax, TempSum / Count, "
+        "HumMin, HumMax, HumSum / Count, {} FROM {} "
+        "WHERE Bucket >= ? AND Bucket < ? ORDER BY Bucket".format(duties, table),
+        (start - start % resolution, end),
+    )
+    return resolution, rows.fetchall()
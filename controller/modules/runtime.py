@@ -0,0 +1,150 @@
+"""
+Module to run the controller as independent asyncio tasks
+
+The controller used to be one while True loop, so a slow SMTP server, a big log flush
+or a long sleep held up everything behind it.  The Runtime runs each job as its own
+task on one event loop:
+  - periodic tasks (every()) are woken on a fixed schedule, or earlier through
+    wake_at(), i.e. sensing sooner to confirm a panic or the timers when one is due,
+  - blocking calls go to an executor.  There are two single thread executors, one
+    for the I2C bus and one for SQLite, so a log flush never queues up in front of a
+    relay write and calls on each resource stay in order,
+  - how late every task starts against when it was due is kept in TaskLag, which
+    shows the scheduling jitter on a busy SBC.
+"""
+
+import asyncio
+import concurrent.futures
+import time
+
+
+class TaskLag:
+    # Running stats of how late a task started, in seconds
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, lag):
+        self.count += 1
+        self.total += lag
+        self.max = max(self.max, lag)
+        self.last = lag
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "last": self.last,
+        }
+
+
+class Runtime:
+    # Named asyncio tasks plus the executors they hand blocking work to
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="i2c"
+        )
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sqlite"
+        )
+        self.loop = None
+        self.tasks = []  # (name, coroutine function)
+        self.lag = {}  # name -> TaskLag
+        self.wake_times = {}  # name -> earliest requested wake up
+        self.events = {}  # name -> asyncio.Event set by wake_at()
+
+    def run_io(self, func, *args):
+        # Run a blocking I2C call on the I2C executor, returns an awaitable
+        return self.loop.run_in_executor(self.io_executor, func, *args)
+
+    def run_db(self, func, *args):
+        # Run a blocking SQLite call on the SQLite executor, returns an awaitable
+        return self.loop.run_in_executor(self.db_executor, func, *args)
+
+    def record_lag(self, name, lag):
+        self.lag.setdefault(name, TaskLag()).add(max(lag, 0.0))
+
+    def get_lag(self):
+        return {name: lag.as_dict() for name, lag in self.lag.items()}
+
+    def add_task(self, name, coroutine_function):
+        # Run coroutine_function() as a task for the life of the runtime
+        self.tasks.append((name, coroutine_function))
+
+    def every(self, name, interval, func, critical=True):
+        """
+        Run the coroutine function func() every interval seconds, or earlier if
+        wake_at() asks for it.  An exception in a critical task stops the runtime,
+        anything else is printed and the task carries on.
+        """
+
+        async def periodic():
+            due = self.clock()
+            while True:
+                started = await self.sleep_until(name, due)
+                self.record_lag(name, self.clock() - started)
+                try:
+                    await func()
+                except Exception as e:
+                    if critical:
+                        raise
+                    print("Task", name, "failed:", e)
+                due = started + interval
+                if due < self.clock():  # Overran a whole interval, don't try to catch up
+                    due = self.clock()
+
+        self.add_task(name, periodic)
+
+    async def sleep_until(self, name, due):
+        # Wait until due or an earlier wake_at() time, returns the time we were due
+        event = self.events.setdefault(name, asyncio.Event())
+        while True:
+            target = min(due, self.wake_times.get(name, due))
+            delay = target - self.clock()
+            if delay <= 0:
+                self.wake_times.pop(name, None)
+                return target
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def wake_at(self, name, when):
+        # Have a periodic task run by when, callable from any thread
+        if self.loop is None:
+            return
+
+        def wake():
+            self.wake_times[name] = min(when, self.wake_times.get(name, when))
+            self.events.setdefault(name, asyncio.Event()).set()
+
+        self.loop.call_soon_threadsafe(wake)
+
+    async def run(self):
+        # Run every task until one fails (or we are cancelled), then wind everything down
+        self.loop = asyncio.get_running_loop()
+        tasks = [
+            asyncio.ensure_future(coroutine_function())
+            for name, coroutine_function in self.tasks
+        ]
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Let whatever is already on the bus or in the DB finish before cleanup
+            self.io_executor.shutdown(wait=True)
+            self.db_executor.shutdown(wait=True)
+            self.loop = None
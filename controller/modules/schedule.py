@@ -0,0 +1,124 @@
+"""
+Module to compile a SCHEDULE into an in-memory timeline of setpoints
+
+A schedule is the SCHEDULE rows sharing one SchedID, each holding the temperature and
+humidity setpoints from its StartTime on.  A row with Ramp set moves the setpoints in
+a straight line to the next row's values instead of stepping.  compile_schedule()
+reads the rows once into sorted lists, after which:
+  - setpoint_at(t) is a binary search (plus an interpolation on a ramp),
+  - next_change(t) says when the setpoint will next differ, so the control loop
+    only has to look again then.  On a ramp that is every ramp_step seconds.
+Nothing touches the DB again until the SCHEDULE rows change, which the
+SettingsCache notices through SCHEDULEVERSION (see settings_cache).
+
+StartTime is either unix seconds or local time text, i.e. datetime('now', 'localtime').
+"""
+
+import bisect
+import datetime
+
+
+def create_schedule_tables(conn):
+    # SCHEDULE (as in database/initializedb.py) plus the Ramp column, SCHEDULEVERSION
+    # and the triggers that bump it, only created if missing.  Caller commits.
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS SCHEDULE
+        (SchedID INT NOT NULL,
+        StartTime TEXT NOT NULL,
+        TempSetPoint REAL NOT NULL,
+        HumiditySetPoint REAL NOT NULL,
+        Ramp INT NOT NULL DEFAULT 0);"""
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(SCHEDULE)")]
+    if "Ramp" not in columns:
+        conn.execute("ALTER TABLE SCHEDULE ADD COLUMN Ramp INT NOT NULL DEFAULT 0")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS SCHEDULEVERSION
+        (SchedID INT PRIMARY KEY NOT NULL,
+        Version INT NOT NULL);"""
+    )
+    for action, row in [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]:
+        conn.execute(
+            """CREATE TRIGGER IF NOT EXISTS SCHEDULE_{action}_VERSION
+            AFTER {action} ON SCHEDULE
+            BEGIN
+                INSERT OR IGNORE INTO SCHEDULEVERSION (SchedID, Version) VALUES ({row}.SchedID, 0);
+                UPDATE SCHEDULEVERSION SET Version = Version + 1 WHERE SchedID = {row}.SchedID;
+            END;""".format(action=action, row=row)
+        )
+
+
+def parse_start_time(value):
+    # Unix seconds from a StartTime cell, numbers pass through, text is local time
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def schedule_enabled(schedule_status):
+    # ScheduleStatus has been stored as 0/1 and as YES/NO, accept either
+    return str(schedule_status).strip().upper() in ("1", "YES", "ON", "TRUE")
+
+
+class Schedule:
+    # Sorted setpoint timeline for one SchedID
+
+    def __init__(self, schedule_id, steps, ramp_step=60):
+        # steps are (start time, temperature, humidity, ramp) in any order
+        steps = sorted(steps)
+        self.schedule_id = schedule_id
+        self.ramp_step = ramp_step  # Seconds between setpoint updates on a ramp
+        self.times = [step[0] for step in steps]
+        self.temperatures = [step[1] for step in steps]
+        self.humidities = [step[2] for step in steps]
+        self.ramps = [bool(step[3]) for step in steps]
+
+    def __len__(self):
+        return len(self.times)
+
+    def ramping(self, index):
+        # Is step index a ramp with a following step to ramp to?
+        return self.ramps[index] and index + 1 < len(self.times)
+
+    def setpoint_at(self, t):
+        # (temperature, humidity) in force at t, None before the first step
+        index = bisect.bisect_right(self.times, t) - 1
+        if index < 0:
+            return None
+        if not self.ramping(index):
+            return self.temperatures[index], self.humidities[index]
+        start, end = self.times[index], self.times[index + 1]
+        fraction = (t - start) / (end - start)
+        return (
+            self.temperatures[index]
+            + fraction * (self.temperatures[index + 1] - self.temperatures[index]),
+            self.humidities[index]
+            + fraction * (self.humidities[index + 1] - self.humidities[index]),
+        )
+
+    def next_change(self, t):
+        # When setpoint_at() will next give a different answer, None if never
+        index = bisect.bisect_right(self.times, t) - 1
+        if index >= 0 and self.ramping(index):
+            return min(t + self.ramp_step, self.times[index + 1])
+        if index + 1 < len(self.times):
+            return self.times[index + 1]
+        return None
+
+
+def compile_schedule(conn, schedule_id, ramp_step=60):
+    # Read one schedule's rows into a Schedule, empty if there are none
+    rows = conn.execute(
+        "SELECT StartTime, TempSetPoint, HumiditySetPoint, Ramp FROM SCHEDULE "
+        "WHERE SchedID = ?",
+        (schedule_id,),
+    ).fetchall()
+    steps = [
+        (parse_start_time(start), temperature, humidity, ramp)
+        for start, temperature, humidity, ramp in rows
+    ]
+    return Schedule(schedule_id, steps, ramp_step)
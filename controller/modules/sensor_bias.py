@@ -0,0 +1,279 @@
+"""
+Module to track how far each sensor reads from the consensus, and whether that is getting worse
+
+The quorum check only sees one set of readings at a time, so a sensor that creeps away
+a few hundredths of a degree a day looks fine right up until it trips the drift limit.
+SensorBiasTracker follows every sensor's residual (its reading minus the median of all
+of them, which is what quorum measures it against) with fixed size running statistics,
+whatever the length of the cure:
+  - Welford mean/variance of the residual over the sensor's whole life,
+  - an exponentially weighted bias and variance, what the sensor is doing lately,
+  - an exponentially weighted least squares line through the residual over time,
+    the drift per day.
+A sensor is flagged as degrading when its bias, its drift projected a few days ahead,
+or its noise gets too close to the drift limit, well before quorum gives up on it.
+The learned bias can optionally be taken off each reading before the quorum check.
+The statistics are kept in the SENSORBIAS table through the LogWriter connection so
+they survive a restart.
+"""
+
+import math
+import time
+
+DAY = 86400
+
+# SENSORBIAS columns, after Sensor and Quantity, in BiasStats attribute order
+STATE_COLUMNS = [
+    "Count",
+    "Mean",
+    "M2",
+    "Bias",
+    "Variance",
+    "SumW",
+    "SumT",
+    "SumR",
+    "SumTT",
+    "SumTR",
+    "FirstTime",
+    "LastTime",
+]
+
+
+class BiasStats:
+    # Residual statistics of one sensor for one quantity, O(1) in size
+
+    __slots__ = [
+        "count",
+        "mean",
+        "m2",
+        "bias",
+        "variance",
+        "sum_w",
+        "sum_t",
+        "sum_r",
+        "sum_tt",
+        "sum_tr",
+        "first_time",
+        "last_time",
+        "reasons",
+    ]
+
+    def __init__(self, state=None):
+        if state is None:
+            state = [0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, None, None]
+        (
+            self.count,
+            self.mean,
+            self.m2,
+            self.bias,
+            self.variance,
+            self.sum_w,
+            self.sum_t,
+            self.sum_r,
+            self.sum_tt,
+            self.sum_tr,
+            self.first_time,
+            self.last_time,
+        ) = state
+        self.reasons = []  # Why the sensor is degrading, empty if it isn't
+
+    def state(self):
+        return [getattr(self, name) for name in self.__slots__[:-1]]
+
+    def add(self, residual, now, bias_half_life, drift_half_life):
+        if self.count == 0:
+            self.first_time = now
+            self.bias = residual
+        # Lifetime, Welford
+        self.count += 1
+        delta = residual - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (residual - self.mean)
+
+        # Lately, exponentially weighted with a half life in seconds
+        elapsed = max(now - (self.last_time if self.last_time is not None else now), 0)
+        alpha = 1 - 0.5 ** (elapsed / bias_half_life) if self.count > 1 else 1.0
+        delta = residual - self.bias
+        self.bias += alpha * delta
+        self.variance = (1 - alpha) * (self.variance + alpha * delta * delta)
+
+        # Drift, least squares of residual against days since first_time, older samples decayed
+        decay = 0.5 ** (elapsed / drift_half_life)
+        t = (now - self.first_time) / DAY
+        self.sum_w = self.sum_w * decay + 1
+        self.sum_t = self.sum_t * decay + t
+        self.sum_r = self.sum_r * decay + residual
+        self.sum_tt = self.sum_tt * decay + t * t
+        self.sum_tr = self.sum_tr * decay + t * residual
+        self.last_time = now
+
+    def drift(self):
+        # Residual change per day, 0 until there is a spread of times to fit
+        denominator = self.sum_w * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 1e-12 * max(self.sum_w * self.sum_tt, 1e-12):
+            return 0.0
+        return (self.sum_w * self.sum_tr - self.sum_t * self.sum_r) / denominator
+
+    def lifetime_std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class SensorBiasTracker:
+    # BiasStats for every (sensor, quantity), fed one quorum result at a time
+
+    def __init__(
+        self,
+        log_writer=None,
+        limits=None,
+        bias_half_life=6 * 3600,
+        drift_half_life=7 * DAY,
+        min_samples=120,
+        min_drift_span=DAY,
+        warn_fraction=0.5,
+        horizon=7,
+        apply_offsets=False,
+        clock=time.time,
+    ):
+        self.log_writer = log_writer  # Where the state is kept, None to keep it in memory only
+        self.limits = dict(limits or {})  # quantity -> drift limit, i.e. MAX_TEMP_SENSOR_DRIFT
+        self.bias_half_life = bias_half_life  # Seconds
+        self.drift_half_life = drift_half_life  # Seconds
+        self.min_samples = min_samples  # Readings before a sensor is judged or corrected
+        self.min_drift_span = min_drift_span  # Seconds of history before the drift is trusted
+        self.warn_fraction = warn_fraction  # Flag a bias or noise this fraction of the limit
+        self.horizon = horizon  # Days ahead the drift is projected
+        self.apply_offsets = apply_offsets
+        self.clock = clock
+        self.stats = {}  # (sensor, quantity) -> BiasStats
+        if log_writer is not None:
+            self.load()
+
+    def create_table(self, conn):
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS SENSORBIAS
+            (Sensor TEXT NOT NULL,
+            Quantity TEXT NOT NULL,
+            {},
+            PRIMARY KEY (Sensor, Quantity));""".format(
+                ",\n            ".join(column + " REAL" for column in STATE_COLUMNS)
+            )
+        )
+
+    def load(self):
+        with self.log_writer.lock:
+            conn = self.log_writer.conn
+            self.create_table(conn)
+            conn.commit()
+            rows = conn.execute(
+                "SELECT Sensor, Quantity, {} FROM SENSORBIAS".format(", ".join(STATE_COLUMNS))
+            ).fetchall()
+        for row in rows:
+            state = list(row[2:])
+            state[0] = int(state[0])
+            self.stats[(row[0], row[1])] = BiasStats(state)
+        for key in self.stats:
+            self.judge(key)
+        return len(rows)
+
+    def save(self):
+        # Write every sensor's statistics, a handful of rows
+        if self.log_writer is None:
+            return 0
+        rows = [key + tuple(stats.state()) for key, stats in list(self.stats.items())]
+        with self.log_writer.lock:
+            conn = self.log_writer.conn
+            self.create_table(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO SENSORBIAS (Sensor, Quantity, {}) VALUES ({})".format(
+                    ", ".join(STATE_COLUMNS), ", ".join("?" * (len(STATE_COLUMNS) + 2))
+                ),
+                rows,
+            )
+            conn.commit()
+        return len(rows)
+
+    def offset(self, sensor, quantity):
+        # What to take off this sensor's reading, 0 unless offsets are on and the sensor is trusted
+        if not self.apply_offsets:
+            return 0.0
+        stats = self.stats.get((sensor, quantity))
+        if stats is None or stats.count < self.min_samples or stats.reasons:
+            # A degrading sensor is left as it reads so the quorum check can reject it
+            return 0.0
+        return stats.bias
+
+    def correct(self, sensors, quantity, values):
+        return [value - self.offset(sensor, quantity) for sensor, value in zip(sensors, values)]
+
+    def noise(self, sensors, quantity):
+        # Each sensor's recent noise std around the median, None until it has min_samples readings
+        result = []
+        for sensor in sensors:
+            stats = self.stats.get((sensor, quantity))
+            if stats is None or stats.count < self.min_samples:
+                result.append(None)
+            else:
+                result.append(math.sqrt(stats.variance))
+        return result
+
+    def update(self, sensors, quantity, values, median, now=None):
+        """
+        Add one set of raw readings and the median quorum measured them
+        against.  Returns the sensors that have just started to look like they
+        are degrading.
+        """
+        if median is None or math.isnan(median):
+            return []  # Nothing to measure against
+        if now is None:
+            now = self.clock()
+        degrading = []
+        for sensor, value in zip(sensors, values):
+            key = (sensor, quantity)
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = BiasStats()
+            stats.add(value - median, now, self.bias_half_life, self.drift_half_life)
+            was_degrading = bool(stats.reasons)
+            if self.judge(key) and not was_degrading:
+                degrading.append(sensor)
+        return degrading
+
+    def judge(self, key):
+        # Work out (and keep) why a sensor is degrading, returns the reasons
+        stats = self.stats[key]
+        stats.reasons = []
+        limit = self.limits.get(key[1])
+        if limit is None or stats.count < self.min_samples:
+            return stats.reasons
+        warn = self.warn_fraction * limit
+        if abs(stats.bias) > warn:
+            stats.reasons.append("bias {:+.2f}".format(stats.bias))
+        if stats.last_time - stats.first_time >= self.min_drift_span:
+            drift = stats.drift()
+            if abs(stats.bias + drift * self.horizon) > limit:
+                stats.reasons.append(
+                    "drifting {:+.3f}/day, over the limit within {} days".format(
+                        drift, self.horizon
+                    )
+                )
+        if math.sqrt(stats.variance) > warn:
+            stats.reasons.append("noisy, std {:.2f}".format(math.sqrt(stats.variance)))
+        return stats.reasons
+
+    def summary(self):
+        # One dict per sensor and quantity, for display
+        return [
+            {
+                "sensor": sensor,
+                "quantity": quantity,
+                "count": stats.count,
+                "bias": stats.bias,
+                "drift_per_day": stats.drift(),
+                "std": math.sqrt(stats.variance),
+                "lifetime_mean": stats.mean,
+                "lifetime_std": stats.lifetime_std(),
+                "offset": self.offset(sensor, quantity),
+                "degrading": list(stats.reasons),
+            }
+            for (sensor, quantity), stats in sorted(self.stats.items())
+        ]
@@ -0,0 +1,84 @@
+"""
+Module to keep one initialized AHT20 per TCA9548A mux channel
+
+Building an AHT20 soft resets it (40 ms) and checks calibration, which the main loop
+used to pay for every sensor on every tick.  The registry does that once per sensor
+and then only again after the sensor has thrown an error, or when the optional
+reset interval has passed.
+"""
+
+import time
+
+from .AHT20 import AHT20
+
+
+class SensorRegistry:
+    # One AHT20 per mux channel, created on first use and re-initialized only when needed.
+
+    def __init__(
+        self,
+        mux,
+        I2CBusNum=1,
+        poll_strategy=None,
+        reset_interval=None,
+        debug_status=False,
+        i2c_bus=None,
+    ):
+        self.mux = mux
+        self.I2CBusNum = I2CBusNum
+        self.i2c_bus = i2c_bus if i2c_bus is not None else mux.i2c_bus
+        self.poll_strategy = poll_strategy
+        self.reset_interval = reset_interval  # Seconds, None or 0 to only reset after errors
+        self.debug = debug_status
+        self.sensors = {}
+        self.needs_reset = set()
+        self.reset_count = 0
+
+    def initialize_all(self, mux_channels):
+        # Bring up every sensor at startup so the first control tick doesn't pay for it
+        for mux_channel in mux_channels:
+            self.select(mux_channel)
+
+    def select(self, mux_channel):
+        # Switch the mux to the sensor's channel and return its AHT20, initializing it
+        # first if it is new, has had an error or is due a periodic reset.
+        with self.i2c_bus:
+            self.mux.select(mux_channel)
+            sensor = self.sensors.get(mux_channel)
+            if sensor is None:
+                sensor = AHT20(
+                    I2CBusNum=self.I2CBusNum,
+                    i2c_bus=self.i2c_bus,
+                    poll_strategy=self.poll_strategy,
+                )
+                self.sensors[mux_channel] = sensor
+                self.needs_reset.discard(mux_channel)
+                self.reset_count += 1
+            elif self.is_reset_due(mux_channel):
+                if self.debug:
+                    print("Re-initializing AHT20 on mux channel", mux_channel)
+                sensor.initialize()
+                self.needs_reset.discard(mux_channel)
+                self.reset_count += 1
+            return sensor
+
+    def is_reset_due(self, mux_channel):
+        if mux_channel in self.needs_reset:
+            return True
+        sensor = self.sensors[mux_channel]
+        if not sensor.calibrated:
+            return True
+        if self.reset_interval:
+            return time.monotonic() - sensor.last_initialized > self.reset_interval
+        return False
+
+    def mark_error(self, mux_channel):
+        # Flag a sensor that misbehaved so the next select() soft resets it
+        self.needs_reset.add(mux_channel)
+
+    def get_conversion_stats(self):
+        # Conversion time statistics for every sensor, keyed by mux channel
+        return {
+            mux_channel: sensor.conversion_stats.as_dict()
+            for mux_channel, sensor in self.sensors.items()
+        }
@@ -0,0 +1,198 @@
+"""
+Module to keep the CTRLSETTING/ENVSETTING profiles in memory and follow DB edits
+
+The controller used to reload profile 1 from scratch every 30 minutes, so a setpoint
+change could take half an hour to apply.  The SettingsCache holds every profile and
+checks for edits on each tick for the price of one PRAGMA data_version on its own
+long-lived connection:
+  - data_version only moves when another connection commits (the log writer, a UI,
+    the sqlite3 shell...), most ticks stop right there,
+  - when it moves, SETTINGSVERSION tells us which profiles changed.  Triggers on
+    both settings tables bump a profile's version on every insert/update/delete,
+  - only those profiles are reread, with the same parameterized statement so
+    sqlite3 reuses the prepared statement from its cache.
+The active profile lives in ACTIVEPROFILE, so switching it is one UPDATE and
+takes effect on the next tick without a restart.  Schedules are cached the same way,
+compiled on first use and recompiled when SCHEDULEVERSION says they changed.
+"""
+
+import sqlite3
+
+from .schedule import compile_schedule, create_schedule_tables
+
+SETTINGS_TABLES = ["CTRLSETTING", "ENVSETTING"]
+
+# Dict key -> (table, column) for everything the controller reads from a profile
+SETTINGS_COLUMNS = {
+    "ProfileLabel": ("CTRLSETTING", "ProfileLabel"),
+    "AirPumpDuty": ("CTRLSETTING", "AirPumpDuty"),
+    "AirPumpIdleTime": ("CTRLSETTING", "AirPumpIdleTime"),
+    "LogServerStatus": ("CTRLSETTING", "LogServerStatus"),
+    "NotificationEmail": ("CTRLSETTING", "NotificationEmail"),
+    "ReportingConfig": ("CTRLSETTING", "ReportingConfig"),
+    "ScheduleStatus": ("CTRLSETTING", "ScheduleStatus"),
+    "ScheduleID": ("CTRLSETTING", "ScheduleID"),
+    "CurrentTempSetPoint": ("ENVSETTING", "CurrentTempSetPoint"),
+    "CurrentTempMaxOvershoot": ("ENVSETTING", "CurrentTempMaxOvershoot"),
+    "CurrentHumiditySetpoint": ("ENVSETTING", "CurrentHumiditySetpoint"),
+    "CurrentHumidityMaxOvershoot": ("ENVSETTING", "CurrentHumidityMaxOvershoot"),
+    "ControlHumidity": ("ENVSETTING", "ControlHumidity"),
+}
+
+PROFILE_SELECT = (
+    "SELECT CTRLSETTING.ID, {} FROM CTRLSETTING "
+    "JOIN ENVSETTING ON ENVSETTING.ID = CTRLSETTING.ID".format(
+        ", ".join(
+            "{}.{}".format(table, column) for table, column in SETTINGS_COLUMNS.values()
+        )
+    )
+)
+PROFILE_SELECT_ONE = PROFILE_SELECT + " WHERE CTRLSETTING.ID = ?"
+
+
+class SettingsCache:
+    # Every settings profile in memory, refreshed from the DB only when it changed.
+
+    def __init__(self, db_file, default_profile=1, ramp_step=60):
+        self.db_file = db_file
+        self.ramp_step = ramp_step  # Seconds between setpoint updates on a schedule ramp
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.profiles = {}
+        self.versions = {}
+        self.schedules = {}  # SchedID -> compiled Schedule, filled on first use
+        self.schedule_versions = {}
+        self.active_profile = default_profile
+        self.data_version = None
+        self.reload_count = 0
+        self.create_tables(default_profile)
+        self.load_all()
+
+    def create_tables(self, default_profile):
+        # Version tables, their triggers and the active profile row, only created if missing
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS SETTINGSVERSION
+                (ID INT PRIMARY KEY NOT NULL,
+                Version INT NOT NULL);"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS ACTIVEPROFILE
+                (Singleton INT PRIMARY KEY NOT NULL CHECK (Singleton = 1),
+                ID INT NOT NULL);"""
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO ACTIVEPROFILE (Singleton, ID) VALUES (1, ?)",
+                (default_profile,),
+            )
+            for table in SETTINGS_TABLES:
+                for action, row in [
+                    ("INSERT", "NEW"),
+                    ("UPDATE", "NEW"),
+                    ("DELETE", "OLD"),
+                ]:
+                    self.conn.execute(
+                        """CREATE TRIGGER IF NOT EXISTS {table}_{action}_VERSION
+                        AFTER {action} ON {table}
+                        BEGIN
+                            INSERT OR IGNORE INTO SETTINGSVERSION (ID, Version) VALUES ({row}.ID, 0);
+                            UPDATE SETTINGSVERSION SET Version = Version + 1 WHERE ID = {row}.ID;
+                        END;""".format(table=table, action=action, row=row)
+                    )
+            create_schedule_tables(self.conn)
+
+    def load_all(self):
+        # Read every profile, the version table and the active profile
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.versions = dict(
+            self.conn.execute("SELECT ID, Version FROM SETTINGSVERSION").fetchall()
+        )
+        self.schedule_versions = dict(
+            self.conn.execute("SELECT SchedID, Version FROM SCHEDULEVERSION").fetchall()
+        )
+        self.schedules = {}
+        self.profiles = {
+            row[0]: self.to_dict(row) for row in self.conn.execute(PROFILE_SELECT)
+        }
+        self.active_profile = self.read_active_profile()
+        self.reload_count += 1
+
+    def to_dict(self, row):
+        return dict(zip(SETTINGS_COLUMNS, row[1:]))
+
+    def read_active_profile(self):
+        row = self.conn.execute(
+            "SELECT ID FROM ACTIVEPROFILE WHERE Singleton = 1"
+        ).fetchone()
+        return self.active_profile if row is None else row[0]
+
+    def reload_profile(self, profile_id):
+        # Reread one profile, dropping it if it no longer exists in both tables
+        row = self.conn.execute(PROFILE_SELECT_ONE, (profile_id,)).fetchone()
+        if row is None:
+            self.profiles.pop(profile_id, None)
+        else:
+            self.profiles[profile_id] = self.to_dict(row)
+        self.reload_count += 1
+
+    def refresh(self):
+        """
+        Pick up committed edits.  Cheap enough to call every tick, returns True
+        if the active profile's settings (or which profile is active) or the
+        schedule it runs changed.
+        """
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+
+        active_profile = self.read_active_profile()
+        changed = active_profile != self.active_profile
+        self.active_profile = active_profile
+        for profile_id, version in self.conn.execute(
+            "SELECT ID, Version FROM SETTINGSVERSION"
+        ).fetchall():
+            if self.versions.get(profile_id) != version:
+                self.versions[profile_id] = version
+                self.reload_profile(profile_id)
+                changed = changed or profile_id == active_profile
+        active_schedule = self.profiles.get(active_profile, {}).get("ScheduleID")
+        for schedule_id, version in self.conn.execute(
+            "SELECT SchedID, Version FROM SCHEDULEVERSION"
+        ).fetchall():
+            if self.schedule_versions.get(schedule_id) != version:
+                self.schedule_versions[schedule_id] = version
+                self.schedules.pop(schedule_id, None)
+                changed = changed or str(schedule_id) == str(active_schedule)
+        return changed
+
+    def get(self, profile_id=None):
+        # Settings dict for a profile (the active one by default), KeyError if unknown
+        if profile_id is None:
+            profile_id = self.active_profile
+        if profile_id not in self.profiles:
+            raise KeyError("No settings profile with ID {}".format(profile_id))
+        return dict(self.profiles[profile_id])
+
+    def get_schedule(self, schedule_id):
+        # Compiled Schedule for a SchedID, read from the DB only the first time after a change
+        schedule_id = int(schedule_id)  # Older DBs store ScheduleID as text
+        schedule = self.schedules.get(schedule_id)
+        if schedule is None:
+            schedule = compile_schedule(self.conn, schedule_id, self.ramp_step)
+            self.schedules[schedule_id] = schedule
+        return schedule
+
+    def set_active_profile(self, profile_id):
+        # Make another profile active, other processes can do the same UPDATE directly
+        if profile_id not in self.profiles:
+            raise KeyError("No settings profile with ID {}".format(profile_id))
+        with self.conn:
+            self.conn.execute(
+                "UPDATE ACTIVEPROFILE SET ID = ? WHERE Singleton = 1", (profile_id,)
+            )
+        self.active_profile = profile_id
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
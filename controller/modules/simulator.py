@@ -0,0 +1,272 @@
+"""
+Module to simulate the chamber so control changes can be tried without risking meat
+
+ChamberModel is a lumped model of a converted fridge: one thermal mass for the air and
+shelves, one for the product, coupled to each other and to the room, with the
+compressor, heater, humidifier and dehumidifier relays putting heat and moisture in or
+taking them out.  Humidity is tracked as water in the air (plus whatever the walls and
+product buffer), so it follows the temperature the way the real chamber does: heating
+dries the air, the evaporator coil condenses water out while the compressor runs, the
+product gives up moisture faster the drier the air, and door openings swap air with
+the room.
+
+ChamberSimulator runs the model on a virtual clock behind the fake I2C devices (see
+fake_smbus): its time() is the clock for the fake sensors and the actuator timers, and
+its sleep() integrates the model with whatever the fake relay board has switched on,
+then moves the sensors to the new values.  A loop that reads through
+get_sensor_data() and switches through set_device_status() and waits with
+TimerScheduler.run_until(sleep=simulator.sleep) runs the real control code against
+the model, a month of it in seconds.  RelayRecorder and ErrorStats keep the figures
+to judge a control strategy by.
+"""
+
+import math
+import random
+
+
+def saturation_humidity(temperature):
+    # Grams of water per m^3 of saturated air at temperature (C), Magnus formula
+    vapour_pressure = 6.112 * math.exp(17.62 * temperature / (243.12 + temperature))
+    return 216.7 * vapour_pressure / (temperature + 273.15)
+
+
+class ChamberModel:
+    # Lumped thermal and moisture model of the chamber, advanced by step()
+
+    def __init__(
+        self,
+        temperature=13.0,
+        humidity=80.0,
+        ambient_temperature=21.0,
+        ambient_humidity=50.0,
+        air_capacity=8000.0,
+        product_capacity=10000.0,
+        product_coupling=4.0,
+        wall_conductance=2.0,
+        cooling_power=60.0,
+        cooling_lag=0.0,
+        heating_power=40.0,
+        volume=0.3,
+        moisture_buffer=30.0,
+        air_changes=0.5,
+        humidifier_rate=0.05,
+        dehumidifier_rate=0.01,
+        condensation_rate=0.01,
+        drying_rate=0.0015,
+        door_openings_per_day=0.0,
+        door_open_time=30.0,
+        door_conductance=15.0,
+        door_air_exchange=0.01,
+        max_step=5.0,
+        seed=None,
+    ):
+        self.temperature = temperature  # Chamber air, C
+        self.product_temperature = temperature  # C
+        self.ambient_temperature = ambient_temperature
+        self.air_capacity = air_capacity  # J/K of the air, shelves and inner walls
+        self.product_capacity = product_capacity  # J/K, about 3 kg of meat
+        self.product_coupling = product_coupling  # W/K between product and air
+        self.wall_conductance = wall_conductance  # W/K through the cabinet to the room
+        self.cooling_power = cooling_power  # W the compressor takes out when running
+        # Seconds for the evaporator coil to get cold after a start (and warm after a stop),
+        # the thermal lag of a real fridge, 0 for cooling that acts at once
+        self.cooling_lag = cooling_lag
+        self.coil = 0.0  # Fraction of cooling_power the coil is taking out right now
+        self.heating_power = heating_power  # W the heater puts in
+        self.volume = volume  # m^3 of air in the chamber
+        # The walls and product soak up and give back moisture, which makes the chamber
+        # behave as if it held moisture_buffer times its volume of air.
+        self.moisture_buffer = moisture_buffer
+        self.air_changes = air_changes  # Leakage, chamber volumes per hour swapped with the room
+        self.humidifier_rate = humidifier_rate  # g/s of water while the humidifier runs
+        self.dehumidifier_rate = dehumidifier_rate  # g/s removed at 100 %RH by the dehumidifier
+        self.condensation_rate = condensation_rate  # g/s the coil removes at 100 %RH while cooling
+        self.drying_rate = drying_rate  # g/s the product would lose into bone dry air
+        self.door_openings_per_day = door_openings_per_day
+        self.door_open_time = door_open_time  # Seconds each opening lasts
+        self.door_conductance = door_conductance  # Extra W/K to the room while open
+        self.door_air_exchange = door_air_exchange  # m^3/s swapped with the room while open
+        self.max_step = max_step  # Longest integration step in seconds
+        self.random = random.Random(seed)
+        self.ambient_moisture = saturation_humidity(ambient_temperature) * ambient_humidity / 100
+        self.water = self.effective_volume() * saturation_humidity(temperature) * humidity / 100
+        self.door_open_for = 0.0  # Seconds left of the current door opening
+        self.door_openings = 0
+        self.product_loss = 0.0  # Grams of water the product has given up
+
+    def effective_volume(self):
+        return self.volume * self.moisture_buffer
+
+    @property
+    def humidity(self):
+        # %RH of the chamber air
+        moisture = self.water / self.effective_volume()
+        return min(100.0, 100 * moisture / saturation_humidity(self.temperature))
+
+    def step(self, seconds, on):
+        # Advance the model seconds with the devices in the set on running
+        while seconds > 0:
+            dt = min(seconds, self.max_step)
+            self.integrate(dt, on)
+            seconds -= dt
+
+    def integrate(self, dt, on):
+        # One Euler step of dt seconds
+        if self.door_open_for <= 0 and self.door_openings_per_day:
+            # Poisson door openings, one chance per step
+            if self.random.random() < self.door_openings_per_day * dt / 86400:
+                self.door_open_for = self.door_open_time
+                self.door_openings += 1
+        door_open = self.door_open_for > 0
+        self.door_open_for -= dt
+
+        target = 1.0 if "cooling" in on else 0.0
+        if self.cooling_lag > 0:
+            self.coil += (target - self.coil) * min(dt / self.cooling_lag, 1.0)
+        else:
+            self.coil = target
+        relative = self.humidity / 100
+        conductance = self.wall_conductance + (self.door_conductance if door_open else 0)
+        drying = self.drying_rate * (1 - relative)
+        air_heat = (
+            conductance * (self.ambient_temperature - self.temperature)
+            + self.product_coupling * (self.product_temperature - self.temperature)
+        )
+        if "heating" in on:
+            air_heat += self.heating_power
+        air_heat -= self.cooling_power * self.coil
+        product_heat = (
+            self.product_coupling * (self.temperature - self.product_temperature)
+            - drying * 2450  # Latent heat of what evaporates off the product, J/g
+        )
+
+        exchange = self.volume * self.air_changes / 3600
+        if door_open:
+            exchange += self.door_air_exchange
+        water = drying + exchange * (
+            self.ambient_moisture - self.water / self.effective_volume()
+        )
+        if "humidifier" in on:
+            water += self.humidifier_rate
+        if "dehumidifier" in on:
+            water -= self.dehumidifier_rate * relative
+        water -= self.condensation_rate * relative * self.coil
+
+        self.temperature += air_heat * dt / self.air_capacity
+        self.product_temperature += product_heat * dt / self.product_capacity
+        self.product_loss += drying * dt
+        # Anything over saturation condenses out on the walls
+        saturated = self.effective_volume() * saturation_humidity(self.temperature)
+        self.water = min(max(self.water + water * dt, 0.0), saturated)
+
+
+class ChamberSimulator:
+    # A ChamberModel on a virtual clock, read through fake AHT20s and switched by a fake relay board
+
+    def __init__(self, model, start=0.0):
+        self.model = model
+        self.now = start
+        self.sensors = []
+        self.relay_board = None
+        self.relay_num = {}
+
+    def time(self):
+        return self.now
+
+    def attach(self, sensors, relay_board, relay_num):
+        # Wire up the fake devices, relay_num maps device -> relay number as in const.py
+        self.sensors = sensors
+        self.relay_board = relay_board
+        self.relay_num = relay_num
+        self.update_sensors()
+
+    def devices_on(self):
+        if self.relay_board is None:
+            return set()
+        return {
+            device
+            for device, relay_num in self.relay_num.items()
+            if self.relay_board.is_on(relay_num)
+        }
+
+    def update_sensors(self):
+        for sensor in self.sensors:
+            sensor.temperature = self.model.temperature
+            sensor.humidity = self.model.humidity
+
+    def sleep(self, seconds):
+        # Let seconds pass: the chamber runs with the relays as they are now
+        if seconds <= 0:
+            return
+        self.model.step(seconds, self.devices_on())
+        self.now += seconds
+        self.update_sensors()
+
+
+class RelayRecorder:
+    # Relay starts, on time and the shortest off time per device, fed by FakeGroveRelay.listeners
+
+    def __init__(self, relay_num, clock):
+        self.relay_num = relay_num
+        self.clock = clock
+        self.starts = dict.fromkeys(relay_num, 0)
+        self.toggles = dict.fromkeys(relay_num, 0)
+        self.on_time = dict.fromkeys(relay_num, 0.0)
+        self.on_since = {}  # device -> when it came on
+        self.off_since = {}  # device -> when it went off
+        self.shortest_off = {}  # device -> shortest off time between two starts
+
+    def on_change(self, old_state, new_state):
+        now = self.clock()
+        for device, relay_num in self.relay_num.items():
+            bit = 1 << (relay_num - 1)
+            if not (old_state ^ new_state) & bit:
+                continue
+            self.toggles[device] += 1
+            if new_state & bit:
+                self.starts[device] += 1
+                self.on_since[device] = now
+                if device in self.off_since:
+                    off = now - self.off_since[device]
+                    self.shortest_off[device] = min(off, self.shortest_off.get(device, off))
+            else:
+                self.on_time[device] += now - self.on_since.pop(device, now)
+                self.off_since[device] = now
+
+    def finish(self):
+        # Count the on time of whatever is still on
+        now = self.clock()
+        for device, since in self.on_since.items():
+            self.on_time[device] += now - since
+            self.on_since[device] = now
+
+
+class ErrorStats:
+    # Setpoint error of one quantity, one sample per control tick
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_abs = 0.0
+        self.total_square = 0.0
+        self.max_abs = 0.0
+        self.in_band = 0
+
+    def add(self, value, setpoint, band):
+        error = value - setpoint
+        self.count += 1
+        self.total += error
+        self.total_abs += abs(error)
+        self.total_square += error * error
+        self.max_abs = max(self.max_abs, abs(error))
+        self.in_band += abs(error) <= band
+
+    def as_dict(self):
+        count = self.count or 1
+        return {
+            "mean": self.total / count,
+            "mean_abs": self.total_abs / count,
+            "rms": math.sqrt(self.total_square / count),
+            "max_abs": self.max_abs,
+            "in_band": self.in_band / count,
+        }
@@ -0,0 +1,282 @@
+"""
+Module to learn how the chamber responds to its relays and predict where it is heading
+
+The hysteresis logic only reacts once the temperature is already past the band, and a
+fridge keeps cooling for a while after the compressor stops (and takes a while to
+start cooling after it starts), so the chamber overshoots both ways.  RateModel fits
+a low order model of one quantity by recursive least squares:
+
+    rate[k] = c + a * value[k-1] + b . lagged inputs[k]
+
+where rate is the change per second over a sample and the inputs are each relay's on
+fraction, the compressor's passed through a first order lag with a fixed time constant
+(the evaporator coil takes a while to get cold, and stays cold for a while after).  The
+heater, humidifier and dehumidifier act at once.  Fitting the lag as a lagged output
+term instead would put the sensor noise on both sides of the fit and bias it, so each
+quantity has a small bank of RateModels with different lags.  Under closed loop control
+the chamber hardly leaves its band, so one step errors barely tell the lags apart;
+each model also runs open loop from the measurement for ANCHOR_STEPS samples at a time
+and the physically sensible model (drifts back towards the room, the compressor cools)
+that stays closest over those runs is used.  Each sample is an O(n^2) update per model
+(n is 4 to 6) with older samples slowly forgotten, so the model keeps up with the
+product drying out or the seasons changing.  ChamberModelFit holds a bank each for the
+temperature and the humidity, is fed every tick (see controller) and can be seeded
+from ENVIROLOG and RELAYLOG with fit_from_history().  trajectory() runs the temperature
+model forward for the predictive compressor control.
+"""
+
+import math
+
+DAY = 86400
+
+# Time constants, seconds, each RateModel bank tries
+LAGS = [0, 60, 120, 240, 480, 960]
+ANCHOR_STEPS = 20  # Samples each open loop run lasts before it restarts from the measurement
+
+
+class RateModel:
+    # Recursive least squares fit of the rate of change of one quantity
+
+    def __init__(
+        self,
+        inputs,
+        lag=0,
+        lagged=("cooling",),
+        half_life=2 * DAY,
+        initial_variance=1000.0,
+        max_trace=1e6,
+    ):
+        self.inputs = list(inputs)  # Device names the rate depends on
+        self.lag = lag  # Seconds, time constant of the lagged inputs' effect
+        self.lagged = set(lagged)  # The inputs that lag
+        self.size = 2 + len(self.inputs)  # c, a, b...
+        self.theta = [0.0] * self.size
+        self.p = [
+            [initial_variance if row == col else 0.0 for col in range(self.size)]
+            for row in range(self.size)
+        ]
+        self.half_life = half_life  # Seconds of history that count half as much as now
+        self.max_trace = max_trace  # Stop forgetting while the data says little (no windup)
+        self.filtered = dict.fromkeys(self.inputs, 0.0)  # Lagged input at the last sample
+        self.samples = 0
+        self.residual_variance = 0.0  # Exponentially weighted, of the one step rate error
+        self.shadow = None  # Open loop run: value, lagged inputs, samples since anchored
+        self.shadow_filtered = None
+        self.shadow_steps = 0
+        self.prediction_variance = 0.0  # Exponentially weighted, of the open loop error
+
+    def advance(self, filtered, on, dt):
+        # Lag the inputs over dt seconds with on held, returns (average over dt, end value)
+        average = {}
+        end = {}
+        for device in self.inputs:
+            target = on.get(device, 0.0)
+            start = filtered[device]
+            if self.lag <= 0 or device not in self.lagged:
+                average[device] = end[device] = target
+                continue
+            decay = math.exp(-dt / self.lag)
+            end[device] = target + (start - target) * decay
+            average[device] = target + (start - target) * self.lag / dt * (1 - decay)
+        return average, end
+
+    def predict_rate(self, value, average):
+        x = [1.0, value] + [average[device] for device in self.inputs]
+        return sum(t * xi for t, xi in zip(self.theta, x))
+
+    def update(self, value, on, rate, dt):
+        # Fold in one sample: rate seen over dt seconds from value with on
+        measured = value + rate * dt
+        if self.shadow is not None:
+            average, self.shadow_filtered = self.advance(self.shadow_filtered, on, dt)
+            self.shadow += self.predict_rate(self.shadow, average) * dt
+            error = measured - self.shadow
+            alpha = 0.002 if self.samples > 500 else 1.0 / (self.samples + 1)
+            self.prediction_variance += alpha * (error * error - self.prediction_variance)
+            self.shadow_steps += 1
+        average, self.filtered = self.advance(self.filtered, on, dt)
+        x = [1.0, value] + [average[device] for device in self.inputs]
+        n = self.size
+        p = self.p
+        px = [sum(p[row][col] * x[col] for col in range(n)) for row in range(n)]
+        trace = sum(p[i][i] for i in range(n))
+        forget = 0.5 ** (dt / self.half_life) if trace < self.max_trace else 1.0
+        denominator = forget + sum(x[i] * px[i] for i in range(n))
+        gain = [value_px / denominator for value_px in px]
+        error = rate - sum(t * xi for t, xi in zip(self.theta, x))
+        self.theta = [t + g * error for t, g in zip(self.theta, gain)]
+        self.p = [
+            [(p[row][col] - gain[row] * px[col]) / forget for col in range(n)]
+            for row in range(n)
+        ]
+        self.samples += 1
+        alpha = 0.002 if self.samples > 500 else 1.0 / self.samples
+        self.residual_variance += alpha * (error * error - self.residual_variance)
+        if self.shadow is None or self.shadow_steps >= ANCHOR_STEPS:
+            self.shadow = measured
+            self.shadow_filtered = self.filtered
+            self.shadow_steps = 0
+        return error
+
+    def sensible(self, falls=()):
+        # Drifts back towards the room, and each device in falls pushes the value down
+        return self.coefficient("value") < 0 and all(
+            self.coefficient(device) < 0 for device in falls
+        )
+
+    def skip(self, on, dt):
+        # Time passed without a usable sample, only the lagged inputs move on
+        _, self.filtered = self.advance(self.filtered, on, dt)
+        self.shadow = None
+
+    def path(self, value, on, seconds, step):
+        # Values every step seconds for the next seconds, on held, from the last sample
+        filtered = self.filtered
+        path = []
+        for _ in range(max(1, int(math.ceil(seconds / step)))):
+            average, filtered = self.advance(filtered, on, step)
+            value += self.predict_rate(value, average) * step
+            path.append(value)
+        return path
+
+    def coefficient(self, name):
+        # "constant", "value" or one of the input devices
+        if name == "constant":
+            return self.theta[0]
+        if name == "value":
+            return self.theta[1]
+        return self.theta[2 + self.inputs.index(name)]
+
+
+class ChamberModelFit:
+    # A bank of RateModels each for the temperature and the humidity, fed one sample at a time
+
+    def __init__(self, sample_interval=30, half_life=2 * DAY, min_samples=240, lags=None):
+        self.sample_interval = sample_interval  # The tick the models are fitted (and run) at
+        self.min_samples = min_samples  # Samples before predictions are trusted
+        lags = LAGS if lags is None else lags
+        self.temperatures = [
+            RateModel(["cooling", "heating"], lag, half_life=half_life) for lag in lags
+        ]
+        self.humidities = [
+            RateModel(
+                ["cooling", "heating", "humidifier", "dehumidifier"], lag, half_life=half_life
+            )
+            for lag in lags
+        ]
+        self.last = None  # (time, temperature, humidity) of the previous sample
+
+    def observe(self, now, temperature, humidity, on):
+        """
+        Add one sample.  on maps device -> fraction of the time since the
+        previous sample it was on.  A gap well off the sample interval (a
+        restart, a missed tick) isn't fitted.
+        """
+        last, self.last = self.last, (now, temperature, humidity)
+        if last is None:
+            return
+        dt = now - last[0]
+        usable = 0.5 * self.sample_interval <= dt <= 2 * self.sample_interval
+        for models, previous, value in (
+            (self.temperatures, last[1], temperature),
+            (self.humidities, last[2], humidity),
+        ):
+            for model in models:
+                if usable:
+                    model.update(previous, on, (value - previous) / dt, dt)
+                elif dt > 0:
+                    model.skip(on, dt)
+
+    @staticmethod
+    def best(models, falls=()):
+        # The sensible model with the smallest open loop error, the first if none is sensible
+        sensible = [model for model in models if model.sensible(falls)] or models[:1]
+        return min(sensible, key=lambda model: model.prediction_variance)
+
+    @property
+    def temperature(self):
+        return self.best(self.temperatures, ["cooling"])
+
+    @property
+    def humidity(self):
+        return self.best(self.humidities)
+
+    def ready(self):
+        # Enough samples and a model that makes physical sense
+        model = self.temperature
+        return model.samples >= self.min_samples and model.sensible(["cooling"])
+
+    def trajectory(self, on, seconds):
+        """
+        Predicted temperatures every sample_interval for the next seconds
+        from the latest sample, with the devices in on (device -> fraction)
+        held as they are.
+        """
+        return self.temperature.path(self.last[1], on, seconds, self.sample_interval)
+
+    def summary(self):
+        # The fitted models in use for display, coefficients per second
+        return {
+            name: dict(
+                {key: model.coefficient(key) for key in ["constant", "value"] + model.inputs},
+                lag=model.lag,
+                samples=model.samples,
+                rate_error=math.sqrt(model.residual_variance),
+                prediction_error=math.sqrt(model.prediction_variance),
+            )
+            for name, model in (("Temperature", self.temperature), ("Humidity", self.humidity))
+        }
+
+
+def fit_from_history(conn, model, start, end):
+    """
+    Feed model the ENVIROLOG samples from start to end, with the relay states
+    rebuilt from RELAYLOG.  Returns the number of samples.  A DB from before
+    RELAYLOG existed has no relay history, so nothing is fitted from it.
+    """
+    has_relaylog = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'RELAYLOG'"
+    ).fetchone()
+    if not has_relaylog:
+        return 0
+    state = {}  # device -> (on, since)
+    # Where each relay was left before start (SQLite takes State from the MAX(Time) row)
+    for device, on, _ in conn.execute(
+        "SELECT Device, State, MAX(Time) FROM RELAYLOG WHERE Time < ? GROUP BY Device",
+        (start,),
+    ):
+        state[device] = (on, start)
+    transitions = conn.execute(
+        "SELECT Time, Device, State FROM RELAYLOG WHERE Time >= ? AND Time < ? ORDER BY Time",
+        (start, end),
+    )
+    pending = next(transitions, None)
+    count = 0
+    last_time = None
+    for timestamp, temperature, humidity in conn.execute(
+        "SELECT Time, Temperature, Humidity FROM ENVIROLOG "
+        "WHERE Time >= ? AND Time < ? ORDER BY Time",
+        (start, end),
+    ):
+        window = timestamp - last_time if last_time is not None else 0
+        on_time = {}
+        while pending is not None and pending[0] <= timestamp:
+            when, device, on = pending
+            was_on, since = state.get(device, (0, when))
+            if was_on and last_time is not None:
+                on_time[device] = on_time.get(device, 0.0) + when - max(since, last_time)
+            state[device] = (on, when)
+            pending = next(transitions, None)
+        if window > 0:
+            for device, (on, since) in state.items():
+                if on:
+                    on_time[device] = on_time.get(device, 0.0) + timestamp - max(since, last_time)
+        fractions = {}
+        if window > 0:
+            fractions = {
+                device: min(seconds / window, 1.0) for device, seconds in on_time.items()
+            }
+        model.observe(timestamp, temperature, humidity, fractions)
+        last_time = timestamp
+        count += 1
+    return count
@@ -0,0 +1,157 @@
+"""
+Module to run timed actuator actions without blocking the control loop
+
+The humidifier pulse used to be a time.sleep() in the middle of the loop, so nothing
+was sensed or controlled while it ran, and any longer pulse stretched the tick with it.
+TimerScheduler keeps a heap of (deadline, callback) and runs whatever is due from
+run_due(), or from run_until() which the loop waits in between ticks instead of a plain
+sleep.  ActuatorTimers uses it for the duty cycle actions:
+  - pulse(): a device on now and off again after N seconds,
+  - start_duty_cycle(): a device alternating on/off times, i.e. the air pump,
+  - lock_out(): a device not allowed back on for N seconds, i.e. compressor minimum off.
+The clock and sleep are injectable so the timing can be driven without waiting.  Under
+the asyncio runtime (see runtime) a task runs run_due() instead, woken through notify.
+"""
+
+import heapq
+import itertools
+import time
+
+
+class TimerScheduler:
+    # Heap of pending callbacks ordered by deadline, at most one pending timer per key
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.heap = []  # (deadline, sequence, key, callback, args)
+        self.sequence = itertools.count()  # Keeps equal deadlines in scheduling order
+        self.keys = {}  # key -> sequence of its live entry
+        self.run_count = 0
+        self.notify = None  # Called with the deadline of every new timer, i.e. to wake a runtime task
+
+    def __len__(self):
+        return len(self.keys)
+
+    def call_at(self, deadline, callback, *args, key=None):
+        # Run callback(*args) at deadline, replacing any pending timer with the same key
+        sequence = next(self.sequence)
+        if key is None:
+            key = ("anonymous", sequence)
+        self.keys[key] = sequence
+        heapq.heappush(self.heap, (deadline, sequence, key, callback, args))
+        if self.notify is not None:
+            self.notify(deadline)
+        return key
+
+    def call_later(self, delay, callback, *args, key=None):
+        return self.call_at(self.clock() + delay, callback, *args, key=key)
+
+    def cancel(self, key):
+        # Forget a pending timer, its heap entry is skipped when it comes up
+        return self.keys.pop(key, None) is not None
+
+    def pending(self, key):
+        return key in self.keys
+
+    def prune(self):
+        # Drop cancelled or replaced entries from the top of the heap
+        while self.heap and self.keys.get(self.heap[0][2]) != self.heap[0][1]:
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        # When the next live timer is due, None if there is nothing pending
+        self.prune()
+        return self.heap[0][0] if self.heap else None
+
+    def run_due(self, now=None):
+        # Run every timer due by now, including ones the callbacks schedule for now
+        if now is None:
+            now = self.clock()
+        ran = 0
+        while True:
+            self.prune()
+            if not self.heap or self.heap[0][0] > now:
+                return ran
+            deadline, sequence, key, callback, args = heapq.heappop(self.heap)
+            del self.keys[key]
+            callback(*args)
+            ran += 1
+            self.run_count += 1
+
+    def run_until(self, deadline, after=None):
+        """
+        Wait until deadline, running timers as they fall due.  after() is called
+        whenever some ran (i.e. to write the relays).  Replaces a plain sleep.
+        """
+        while True:
+            now = self.clock()
+            if now >= deadline:
+                break
+            next_deadline = self.next_deadline()
+            wake = deadline if next_deadline is None else min(deadline, next_deadline)
+            if wake > now:
+                self.sleep(wake - now)
+            if self.run_due() and after is not None:
+                after()
+        if self.run_due() and after is not None:
+            after()
+
+
+class ActuatorTimers:
+    # Timed device actions on top of a TimerScheduler.  set_status(device, "ON"/"OFF")
+    # stages a relay change, apply() writes staged changes out after a timer fires.
+
+    def __init__(self, scheduler, set_status, apply=None):
+        self.scheduler = scheduler
+        self.set_status = set_status
+        self.apply = apply
+        self.lockouts = {}  # device -> time it may come back on
+
+    def switch(self, device, setting):
+        self.set_status(device, setting)
+        if self.apply is not None:
+            self.apply()
+
+    def pulse(self, device, duration):
+        # Device on now and off after duration seconds, returns the on time
+        started = self.scheduler.clock()
+        self.set_status(device, "ON")
+        self.scheduler.call_later(duration, self.switch, device, "OFF", key=(device, "pulse"))
+        return started
+
+    def pulsing(self, device):
+        return self.scheduler.pending((device, "pulse"))
+
+    def start_duty_cycle(self, device, on_time, off_time):
+        # Alternate on_time seconds on and off_time seconds off, starting with on
+        self.stop_duty_cycle(device)
+        self.duty_step(device, "ON", on_time, off_time)
+
+    def duty_step(self, device, setting, on_time, off_time):
+        self.switch(device, setting)
+        if setting == "ON":
+            self.scheduler.call_later(
+                on_time, self.duty_step, device, "OFF", on_time, off_time, key=(device, "duty")
+            )
+        else:
+            self.scheduler.call_later(
+                off_time, self.duty_step, device, "ON", on_time, off_time, key=(device, "duty")
+            )
+
+    def stop_duty_cycle(self, device):
+        # Stop cycling, the device is left as it is
+        return self.scheduler.cancel((device, "duty"))
+
+    def lock_out(self, device, seconds):
+        # Keep device from coming back on for seconds (extends, never shortens, a lockout)
+        until = self.scheduler.clock() + seconds
+        if until > self.lockouts.get(device, 0):
+            self.lockouts[device] = until
+        return self.lockouts[device]
+
+    def is_locked_out(self, device):
+        return self.scheduler.clock() < self.lockouts.get(device, 0)
+
+    def lockout_remaining(self, device):
+        return max(0, self.lockouts.get(device, 0) - self.scheduler.clock())
@@ -0,0 +1,251 @@
+"""
+Replay logged history through the chamber control logic.
+
+Streams ENVIROLOG rows from an SBCuterie DB through ChamberController
+(modules/controller.py) as fast as the CPU allows and reports the relay
+decisions it would have made: starts, on time, compressor starts per hour,
+humidifier pulses and panics.  Use it to check a logic or settings change
+against weeks of real history in seconds.  Raw rows are only kept for
+RAW_LOG_RETENTION_DAYS (see modules/retention.py), so any older part of the
+range is replayed from the per minute means in ENVIROLOG_1M instead, one
+tick a minute rather than every SLEEP_SECONDS.
+
+    python replay.py --days 90
+    python replay.py --db backup.db --temp-overshoot 1.5 --no-schedule
+    python replay.py --days 1 --decisions     # print every relay change
+    python replay.py --days 30 --estimator    # the same history through the chamber estimator
+"""
+
+import argparse
+import itertools
+import sqlite3
+import time
+
+import modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
+from modules.controller import DEVICES, Readings, build_controller
+from modules.estimator import ChamberEstimator
+from modules.settings_cache import SettingsCache
+
+
+class ReplayStats:
+    # Relay starts and on time per device over a replay
+
+    def __init__(self):
+        self.relays = dict.fromkeys(DEVICES, "OFF")
+        self.starts = dict.fromkeys(DEVICES, 0)
+        self.on_time = dict.fromkeys(DEVICES, 0.0)
+        self.pulses = dict.fromkeys(DEVICES, 0)
+        self.rows = 0
+        self.events = 0
+        self.alerts = 0
+        self.panics = 0
+        self.first = None
+        self.last = None
+
+    def advance(self, now):
+        # Credit on time to every device that has been on since the last row
+        if self.last is not None:
+            for device, setting in self.relays.items():
+                if setting == "ON":
+                    self.on_time[device] += now - self.last
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.rows += 1
+
+    def record(self, commands):
+        # Count what commands did, returns the relay changes that were real transitions
+        toggled = []
+        for device, setting in commands.changes:
+            if self.relays.get(device) != setting:
+                toggled.append((device, setting))
+                if setting == "ON":
+                    self.starts[device] += 1
+            self.relays[device] = setting
+        for device, seconds in commands.pulses.items():
+            self.pulses[device] += 1
+            self.starts[device] += 1
+            self.on_time[device] += seconds
+        self.events += commands.event is not None
+        self.alerts += len(commands.alerts)
+        self.panics += commands.panic
+        return toggled
+
+
+def history_rows(conn, start, end):
+    """
+    (Time, Temperature, Humidity) from start to end in time order: the
+    minute rollups up to the first raw ENVIROLOG row in range, raw rows from
+    there on.  Returns (rows, number of minute rows).
+    """
+    first_raw = conn.execute(
+        "SELECT MIN(Time) FROM ENVIROLOG WHERE Time >= ? AND Time < ?", (start, end)
+    ).fetchone()[0]
+    raw_start = end if first_raw is None else first_raw
+    has_minutes = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ENVIROLOG_1M'"
+    ).fetchone()
+    minute_rows = []
+    if has_minutes and raw_start > start:
+        minute_rows = conn.execute(
+            "SELECT Bucket, TempSum / Count, HumSum / Count FROM ENVIROLOG_1M "
+            "WHERE Bucket >= ? AND Bucket + 60 <= ? ORDER BY Bucket",
+            (start, raw_start),
+        ).fetchall()
+    raw_rows = conn.execute(
+        "SELECT Time, Temperature, Humidity FROM ENVIROLOG "
+        "WHERE Time >= ? AND Time < ? ORDER BY Time",
+        (raw_start, end),
+    )
+    return itertools.chain(minute_rows, raw_rows), len(minute_rows)
+
+
+def load_controller(args, conn_file):
+    settings_cache = SettingsCache(conn_file)
+    settings = settings_cache.get(args.profile)
+    schedule = None
+    if not args.no_schedule:
+        from modules.schedule import schedule_enabled
+
+        if schedule_enabled(settings["ScheduleStatus"]):
+            schedule = settings_cache.get_schedule(settings["ScheduleID"])
+    settings_cache.close()
+    overrides = {
+        "CurrentTempSetPoint": args.temp_setpoint,
+        "CurrentTempMaxOvershoot": args.temp_overshoot,
+        "CurrentHumiditySetpoint": args.humidity_setpoint,
+        "CurrentHumidityMaxOvershoot": args.humidity_overshoot,
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    if args.compressor_idle is not None:
+        CONST.MINIMUM_OFF_TIME = dict(CONST.MINIMUM_OFF_TIME, cooling=args.compressor_idle)
+    return build_controller(CONST, settings, schedule), settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--db", default=CONST.DB_FILE, help="SBCuterie SQLite DB")
+    parser.add_argument("--days", type=float, help="only the last N days of the log")
+    parser.add_argument("--start", type=float, help="unix time to start from")
+    parser.add_argument("--end", type=float, help="unix time to stop at")
+    parser.add_argument("--profile", type=int, help="settings profile ID (default: active)")
+    parser.add_argument("--no-schedule", action="store_true", help="ignore the profile's schedule")
+    parser.add_argument("--temp-setpoint", type=float)
+    parser.add_argument("--temp-overshoot", type=float)
+    parser.add_argument("--humidity-setpoint", type=float)
+    parser.add_argument("--humidity-overshoot", type=float)
+    parser.add_argument(
+        "--compressor-idle", type=float, help="compressor minimum off time in seconds"
+    )
+    parser.add_argument(
+        "--estimator",
+        action="store_true",
+        help="filter the logged values through the chamber estimator (modules/estimator.py)",
+    )
+    parser.add_argument("--decisions", action="store_true", help="print every relay change")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    end = args.end
+    if end is None:
+        end = (conn.execute("SELECT MAX(Time) FROM ENVIROLOG").fetchone()[0] or 0) + 1
+    start = args.start
+    if start is None:
+        start = end - args.days * 86400 if args.days else 0
+
+    controller, settings = load_controller(args, args.db)
+    stats = ReplayStats()
+    estimator = None
+    if args.estimator:
+        # ENVIROLOG only has the quorum average, so it is filtered as a single sensor
+        estimator = ChamberEstimator(
+            CONST.ESTIMATOR_SENSOR_NOISE,
+            CONST.ESTIMATOR_PROCESS_NOISE,
+            confidence=CONST.ESTIMATOR_CONFIDENCE,
+            max_gap=10 * CONST.SLEEP_SECONDS,
+        )
+    rows, minute_rows = history_rows(conn, start, end)
+    started = time.perf_counter()
+    first = True
+    for timestamp, temperature, humidity in rows:
+        if first:
+            controller.reset(timestamp)
+            first = False
+        stats.advance(timestamp)
+        readings = Readings("Good", temperature, "Good", humidity)
+        if estimator is not None:
+            temperature_estimate = estimator.update(
+                "Temperature", [temperature], [True], now=timestamp
+            )
+            humidity_estimate = estimator.update("Humidity", [humidity], [True], now=timestamp)
+            readings = Readings(
+                "Good",
+                temperature_estimate.value,
+                "Good",
+                humidity_estimate.value,
+                temperature_estimate.interval,
+                humidity_estimate.interval,
+            )
+        commands = controller.step(readings, timestamp)
+        toggled = stats.record(commands)
+        if args.decisions and (toggled or commands.pulses):
+            changes = ["{} {}".format(device, setting) for device, setting in toggled]
+            changes += ["{} pulse {}s".format(d, s) for d, s in commands.pulses.items()]
+            print(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)),
+                "{:6.2f} C {:6.2f} %".format(temperature, humidity),
+                ", ".join(changes),
+            )
+    elapsed = time.perf_counter() - started
+    conn.close()
+
+    if not stats.rows:
+        print("No ENVIROLOG rows in range")
+        return
+    hours = max(stats.last - stats.first, 1) / 3600
+    print(
+        "Replayed {} rows ({:.1f} days) in {:.2f} s, {:.0f} rows/s".format(
+            stats.rows, hours / 24, elapsed, stats.rows / elapsed
+        )
+    )
+    if minute_rows:
+        print(
+            "{} rows older than the raw log ({:.1f} days) replayed from the minute "
+            "rollups".format(minute_rows, minute_rows / 1440)
+        )
+    print(
+        "Profile {!r}: temp {} +/- {}, humidity {} +/- {}{}".format(
+            settings["ProfileLabel"],
+            settings["CurrentTempSetPoint"],
+            settings["CurrentTempMaxOvershoot"],
+            settings["CurrentHumiditySetpoint"],
+            settings["CurrentHumidityMaxOvershoot"],
+            ", following schedule" if controller.schedule is not None else "",
+        )
+    )
+    if estimator is not None:
+        print(
+            "band edges inside the confidence interval, not switched: temperature {} "
+            "ticks, humidity {} ticks".format(
+                controller.held["Temperature"], controller.held["Humidity"]
+            )
+        )
+    for device in DEVICES:
+        print(
+            "{:13s} starts {:6d} ({:5.2f}/h)  on {:5.1f}%{}".format(
+                device,
+                stats.starts[device],
+                stats.starts[device] / hours,
+                100 * stats.on_time[device] / (hours * 3600),
+                "  pulses {}".format(stats.pulses[device]) if stats.pulses[device] else "",
+            )
+        )
+    print(
+        "events logged {}  alerts {}  panics {}".format(
+            stats.events, stats.alerts, stats.panics
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
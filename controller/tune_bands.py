@@ -0,0 +1,139 @@
+"""
+Recommend hysteresis bands from how the chamber has been cycling.
+
+Brings the per day summaries of the band tuner (modules/band_tuner.py) up to
+date from the hour rollups and relay duty buckets, then works out the
+CurrentTempMaxOvershoot that gives the target compressor starts per hour and
+a CurrentHumidityMaxOvershoot that covers the humidity swing, and prints
+them.  --apply writes them to the profile, the running controller picks the
+change up on its next tick.  It only applies a change once there is a new
+day of history since the last change it applied, so a dry run first is fine.
+Cheap enough to run from cron every night:
+
+    python tune_bands.py
+    python tune_bands.py --target-starts 2 --max-temp-error 2.5
+    python tune_bands.py --apply      # nightly, e.g. from cron at 00:05
+"""
+
+import argparse
+import sqlite3
+import time
+
+import modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
+from modules.band_tuner import (
+    EVENT_PREFIX,
+    days_since_applied,
+    recommend,
+    update_tuning,
+)
+from modules.settings_cache import SettingsCache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--db", default=CONST.DB_FILE, help="SBCuterie SQLite DB")
+    parser.add_argument("--profile", type=int, help="settings profile ID (default: active)")
+    parser.add_argument("--now", type=float, help="unix time to tune as of (default: now)")
+    parser.add_argument("--days", type=int, default=CONST.BAND_TUNER_HISTORY_DAYS)
+    parser.add_argument(
+        "--target-starts",
+        type=float,
+        default=CONST.BAND_TUNER_TARGET_STARTS,
+        help="compressor starts per hour to aim for",
+    )
+    parser.add_argument(
+        "--max-temp-error", type=float, default=CONST.BAND_TUNER_MAX_TEMP_ERROR
+    )
+    parser.add_argument(
+        "--max-humidity-error", type=float, default=CONST.BAND_TUNER_MAX_HUMIDITY_ERROR
+    )
+    parser.add_argument("--apply", action="store_true", help="write the bands to the profile")
+    args = parser.parse_args()
+
+    settings_cache = SettingsCache(args.db)
+    profile = args.profile if args.profile is not None else settings_cache.active_profile
+    settings = settings_cache.get(profile)
+    settings_cache.close()
+    temp_band = settings["CurrentTempMaxOvershoot"]
+    humidity_band = settings["CurrentHumidityMaxOvershoot"]
+    now = args.now if args.now is not None else time.time()
+
+    conn = sqlite3.connect(args.db)
+    started = time.perf_counter()
+    with conn:
+        added = update_tuning(
+            conn, temp_band, humidity_band, now, args.days, CONST.SLEEP_SECONDS
+        )
+    result = recommend(
+        conn,
+        temp_band,
+        humidity_band,
+        now,
+        target_starts=args.target_starts,
+        max_temp_error=args.max_temp_error,
+        max_humidity_error=args.max_humidity_error,
+        min_temp_band=CONST.BAND_TUNER_MIN_TEMP_BAND,
+        min_humidity_band=CONST.BAND_TUNER_MIN_HUMIDITY_BAND,
+        max_step=CONST.BAND_TUNER_MAX_STEP,
+        history_days=args.days,
+        min_cycle=CONST.MINIMUM_OFF_TIME.get("cooling", 0)
+        + CONST.MINIMUM_ON_TIME.get("cooling", 0),
+    )
+    elapsed = time.perf_counter() - started
+
+    print(
+        "Profile {!r}: {} new day(s) analysed, {} used, in {:.3f} s".format(
+            settings["ProfileLabel"], added, result.days, elapsed
+        )
+    )
+    if result.temp_band is None:
+        print("No recommendation: " + result.note)
+        conn.close()
+        return
+    print(
+        "temperature band +/- {} C -> +/- {} C: compressor {:.2f} -> {:.2f} starts/h "
+        "(target {}), largest error {:.2f} C".format(
+            temp_band,
+            result.temp_band,
+            result.observed_starts,
+            result.predicted_starts,
+            args.target_starts,
+            result.predicted_error,
+        )
+    )
+    if settings["ControlHumidity"] == "YES":
+        print(
+            "humidity band    +/- {} % -> +/- {} %".format(humidity_band, result.humidity_band)
+        )
+    else:
+        result = result._replace(humidity_band=humidity_band)
+    if result.note:
+        print("note: " + result.note)
+
+    changed = (result.temp_band, result.humidity_band) != (temp_band, humidity_band)
+    if args.apply and changed and not days_since_applied(conn):
+        # Applying again on the same days would keep moving the band with nothing new to go on
+        print("not applied, no new days since the last change was applied")
+    elif args.apply and changed:
+        with conn:
+            conn.execute(
+                "UPDATE ENVSETTING SET CurrentTempMaxOvershoot = ?, "
+                "CurrentHumidityMaxOvershoot = ? WHERE ID = ?",
+                (result.temp_band, result.humidity_band, profile),
+            )
+            conn.execute(
+                "INSERT INTO EVENTLOG (Time, Event) VALUES (?,?)",
+                (
+                    int(now),
+                    EVENT_PREFIX
+                    + " temperature +/- {} -> {}, humidity +/- {} -> {}".format(
+                        temp_band, result.temp_band, humidity_band, result.humidity_band
+                    ),
+                ),
+            )
+        print("applied to profile {}".format(profile))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,10 @@ f = open(myfile, "w+")
 conn = sqlite3.connect("PiCuterieDB.db")
 print("Opened database successfully")
 
+# Must be set before any table is created, lets the retention engine in the
+# controller hand freed pages back a few at a time instead of a full VACUUM.
+conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
 
 conn.execute(
     """CREATE TABLE CTRLSETTING 
@@ -31,7 +35,7 @@ conn.execute(
     LogServerStatus INT NOT NULL, 
     CommandEmailStatus TEXT NOT NULL,
     CommandEmailAddress TEXT NOT NULL, 
-    NotificationEmailAddress TEXT NOT NULL, 
+    NotificationEmail TEXT NOT NULL, 
     ReportingConfig INT NOT NULL, 
     GoogleSheetID  TEXT NOT NULL, 
     ScheduleStatus INT NOT NULL,
@@ -42,7 +46,7 @@ print("Control Settings Table created")
 
 conn.execute(
     "INSERT INTO CTRLSETTING (ID,ProfileLabel,AirPumpDuty,AirPumpIdleTime,LogServerStatus,CommandEmailStatus,CommandEmailAddress,NotificationEmail,ReportingConfig,GoogleSheetID,ScheduleStatus,ScheduleID) \
-      VALUES (1, 'Default', 120, 2600 0, NO, 'yourcmd@email.com', 'Your@email.com', 0, 'Unset', '0', '0');"
+      VALUES (1, 'Default', 120, 2600, 0, 'NO', 'yourcmd@email.com', 'Your@email.com', 0, 'Unset', '0', '0');"
 )
 
 print("Control Settings Table populated with default data")
@@ -53,17 +57,17 @@ conn.execute(
     ProfileLabel TEXT NOT NULL, 
     CurrentTempSetPoint REAL NOT NULL,
     CurrentTempMaxOvershoot REAL NOT NULL,
+    ControlTemperature TEXT NOT NULL,
     CurrentHumiditySetpoint REAL NOT NULL,
     CurrentHumidityMaxOvershoot REAL NOT NULL,
-    ControlHumidity TEXT NOT NULL,
-);"""
+    ControlHumidity TEXT NOT NULL);"""
 )
 
 print("Environment Settings Table created successfully")
 
 conn.execute(
     "INSERT INTO ENVSETTING (ID,ProfileLabel,CurrentTempSetPoint,CurrentTempMaxOvershoot,ControlTemperature,CurrentHumiditySetpoint,CurrentHumidityMaxOvershoot,ControlHumidity) \
-      VALUES (1, 'Default', 13, 2, 85, 3, YES);"
+      VALUES (1, 'Default', 13, 2, 'YES', 85, 3, 'YES');"
 )
 
 print("Environment Settings Table populated with default data")
@@ -73,7 +77,8 @@ conn.execute(
     (SchedID INT NOT NULL,
     StartTime TEXT NOT NULL,
     TempSetPoint REAL NOT NULL,
-    HumiditySetPoint REAL NOT NULL);"""
+    HumiditySetPoint REAL NOT NULL,
+    Ramp INT NOT NULL DEFAULT 0);"""
 )
 
 conn.execute(
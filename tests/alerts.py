@@ -0,0 +1,114 @@
+"""
+Exercise the alert dispatcher against a local stand-in SMTP server.
+
+Starts a minimal plain SMTP sink on localhost, fires a burst of alerts through
+modules/alerts.py the way the control loop would (including one alert repeated
+every tick) and prints what the server received and the dispatcher counters.
+
+    python tests/alerts.py
+    python tests/alerts.py --outage 3   # server only comes up after 3 s, alerts retry
+"""
+
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "controller"))
+)
+from modules.alerts import AlertDispatcher  # Queued, deduplicated alert emails
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    # Just enough SMTP to accept mail, every message lands in server.messages
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 sink ready")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line.split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 sink")
+            elif command == "DATA":
+                self.reply("354 end with <CRLF>.<CRLF>")
+                data = []
+                while True:
+                    line = self.rfile.readline().decode()
+                    if line.rstrip("\r\n") == ".":
+                        break
+                    data.append(line)
+                self.server.messages.append("".join(data))
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:  # MAIL, RCPT, RSET, NOOP
+                self.reply("250 ok")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=8025, help="port for the stand-in server")
+    parser.add_argument(
+        "--outage", type=float, default=0, help="seconds before the server comes up"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=20, help="times the repeating alert fires"
+    )
+    parser.add_argument(
+        "--window", type=float, default=2, help="dedup window in seconds"
+    )
+    args = parser.parse_args()
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", args.port), SMTPSink)
+    server.daemon_threads = True
+    server.messages = []
+    server.connections = 0
+    threading.Timer(args.outage, server.serve_forever).start()
+
+    dispatcher = AlertDispatcher(
+        "127.0.0.1",
+        args.port,
+        "sbcuterie@localhost",
+        use_tls=False,
+        dedup_window=args.window,
+        backoff_initial=0.5,
+    )
+    dispatcher.start()
+
+    start = time.perf_counter()
+    dispatcher.send("Picuterie Startup", "System startup", "you@localhost")
+    for tick in range(args.repeats):
+        dispatcher.send(
+            "Chamber Environmental Sensors Disagree",
+            "Tick {} readings disagree".format(tick),
+            "you@localhost",
+        )
+    queued = time.perf_counter() - start
+    time.sleep(args.window + 1.5)
+    dispatcher.stop()
+    server.shutdown()
+
+    print("{} send() calls took {:.2f} ms".format(args.repeats + 1, 1000 * queued))
+    print("server received {} messages over {} connections".format(
+        len(server.messages), server.connections
+    ))
+    for message in server.messages:
+        subject = [line for line in message.splitlines() if line.startswith("Subject:")]
+        repeated = [line for line in message.splitlines() if line.startswith("(repeated")]
+        print("  ", subject[0] if subject else "?", " ".join(repeated))
+    print("dispatcher", dispatcher.get_counters())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Hardware free benchmark of the SBCuterie control loop I2C path.
+
+Runs get_sensor_data() and set_device_status()/apply_device_status() from
+SBCuterie.py against the fake SMBus backend and reports ticks per second,
+I2C transactions per tick and per-phase latency.
+
+    python tests/benchmark.py --ticks 50
+    python tests/benchmark.py --fast          # zero every hardware delay, CPU cost only
+    python tests/benchmark.py --sequential    # compare against non-pipelined sampling
+    python tests/benchmark.py --log-rows 100000  # also measure SQLite log throughput
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "controller"))
+)
+import modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
+import modules.i2c_bus as I2C  # Shared long-lived I2C bus handles
+from modules.fake_smbus import build_chamber_network  # Stand-in for the real I2C bus
+from modules.log_writer import LogWriter  # Buffered SQLite log writer
+import SBCuterie  # Only the functions, the main loop is behind __main__
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    count = len(samples)
+    return "mean {:7.2f} ms  p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms".format(
+        1000 * sum(samples) / count,
+        1000 * samples[count // 2],
+        1000 * samples[min(count - 1, int(count * 0.95))],
+        1000 * samples[-1],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--ticks", type=int, default=50, help="control ticks to run")
+    parser.add_argument(
+        "--conversion-time",
+        type=float,
+        default=0.075,
+        help="seconds the fake AHT20s stay busy per conversion",
+    )
+    parser.add_argument(
+        "--noise", type=float, default=0.05, help="std deviation of fake sensor noise"
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="zero all sensor, mux and relay delays to measure pure CPU cost",
+    )
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="read sensors one after the other instead of pipelined",
+    )
+    parser.add_argument(
+        "--log-rows",
+        type=int,
+        default=0,
+        help="also push this many ENVIROLOG/EVENTLOG row pairs through the log writer",
+    )
+    args = parser.parse_args()
+
+    # Every tick is logged, into a scratch DB rather than the real one
+    scratch = tempfile.TemporaryDirectory()
+    CONST.DB_FILE = os.path.join(scratch.name, "benchmark.db")
+
+    conversion_time = 0.0 if args.fast else args.conversion_time
+    network, sensors, relay_board = build_chamber_network(
+        CONST, noise=args.noise, conversion_time=conversion_time, seed=1
+    )
+    I2C.BUS_MANAGER.set_bus_factory(network.get_bus_factory())
+    CONST.AHT20_PIPELINED_SAMPLING = not args.sequential
+    if args.fast:
+        SBCuterie.mux.settle_time = 0
+        SBCuterie.aht20_poll_strategy.initial_wait = 0
+        SBCuterie.aht20_poll_strategy.poll_interval = 0
+        SBCuterie.get_relay().settle_time = 0
+
+    SBCuterie.sensor_registry.initialize_all(CONST.AHT20_MUX_CHANS)
+    I2C.BUS_MANAGER.reset_counters()
+
+    sense_times = []
+    actuate_times = []
+    log_times = []
+    tick_times = []
+    transactions = []
+    start = time.perf_counter()
+    for tick in range(args.ticks):
+        tick_start = time.perf_counter()
+        (
+            read_time,
+            temp_code,
+            temperature,
+            hum_code,
+            humidity,
+        ) = SBCuterie.get_sensor_data()
+        sensed = time.perf_counter()
+
+        # Flip cooling and heating every few ticks the way a busy control tick would
+        cooling = "ON" if (tick // 3) % 2 else "OFF"
+        SBCuterie.set_device_status("cooling", cooling)
+        SBCuterie.set_device_status("heating", "OFF" if cooling == "ON" else "ON")
+        SBCuterie.set_device_status("humidifier", "OFF")
+        SBCuterie.set_device_status("dehumidifier", "OFF")
+        SBCuterie.apply_device_status()
+        actuated = time.perf_counter()
+
+        SBCuterie.write_logs(temperature, humidity, "State:" + cooling)
+        SBCuterie.get_log_writer().maybe_flush()
+        done = time.perf_counter()
+
+        sense_times.append(sensed - tick_start)
+        actuate_times.append(actuated - sensed)
+        log_times.append(done - actuated)
+        tick_times.append(done - tick_start)
+        transactions.append(
+            I2C.BUS_MANAGER.get_counters()[CONST.I2C_BUS]["transactions"]
+        )
+        I2C.BUS_MANAGER.reset_counters()
+    elapsed = time.perf_counter() - start
+
+    print(
+        "{} ticks in {:.2f} s: {:.1f} ticks/s ({} sampling{})".format(
+            args.ticks,
+            elapsed,
+            args.ticks / elapsed,
+            "sequential" if args.sequential else "pipelined",
+            ", no delays" if args.fast else "",
+        )
+    )
+    print(
+        "I2C transactions per tick: mean {:.1f}  min {}  max {}".format(
+            sum(transactions) / len(transactions), min(transactions), max(transactions)
+        )
+    )
+    print("sense   " + summarize(sense_times))
+    print("actuate " + summarize(actuate_times))
+    print("log     " + summarize(log_times))
+    print("tick    " + summarize(tick_times))
+    print(
+        "mux switches {}  relay board writes {}  AHT20 resets {}".format(
+            SBCuterie.mux.switch_count,
+            relay_board.write_count,
+            sum(sensor.reset_count for sensor in sensors),
+        )
+    )
+    SBCuterie.close_logs()
+
+    if args.log_rows:
+        writer = LogWriter(os.path.join(scratch.name, "throughput.db"))
+        start = time.perf_counter()
+        for row in range(args.log_rows):
+            writer.write(13.0 + (row % 10) / 10, 85.0, "State:Cooling, ", timestamp=row)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        print(
+            "log writer: {} row pairs in {:.2f} s, {:.0f} rows/s in {} flushes".format(
+                args.log_rows, elapsed, 2 * args.log_rows / elapsed, writer.flush_count
+            )
+        )
+    scratch.cleanup()
+
+
+if __name__ == "__main__":
+    main()
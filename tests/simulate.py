@@ -0,0 +1,319 @@
+"""
+Run the SBCuterie control code against a simulated chamber in accelerated time.
+
+The real get_sensor_data(), control_step() and set_device_status() from
+SBCuterie.py drive the fake I2C bus, and the fake sensors and relay board sit on
+a lumped model of the fridge (modules/simulator.py) running on a virtual clock,
+so a month of control takes seconds.  Reports setpoint error, compressor starts
+per hour and relay toggles, to compare control strategies and tunables.
+
+    python tests/simulate.py --days 30
+    python tests/simulate.py --compressor-idle 300 --door-openings 4
+    python tests/simulate.py --days 7 --db sim.db   # keep the simulated ENVIROLOG/EVENTLOG
+    python tests/simulate.py --days 40 --drift-sensor X --drift-rate 0.05   # a sensor going off
+    python tests/simulate.py --noise 0.2 --estimator   # control on the filtered estimate
+    python tests/simulate.py --cooling-lag 300 --control-mode predictive
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "controller"))
+)
+import modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
+import modules.i2c_bus as I2C  # Shared long-lived I2C bus handles
+from modules.controller import build_controller  # The control decisions
+from modules.estimator import ChamberEstimator  # Filtered chamber estimate
+from modules.fake_smbus import build_chamber_network  # Stand-in for the real I2C bus
+from modules.log_writer import LogWriter  # Buffered SQLite log writer
+from modules.sensor_bias import SensorBiasTracker  # Per sensor bias and drift
+from modules.simulator import ChamberModel, ChamberSimulator, ErrorStats, RelayRecorder
+from modules.timers import ActuatorTimers, TimerScheduler
+import SBCuterie  # Only the functions, the main loop is behind __main__
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--days", type=float, default=30, help="simulated days to run")
+    parser.add_argument("--seed", type=int, default=1, help="seed for noise and doors")
+    parser.add_argument(
+        "--noise", type=float, default=0.05, help="std deviation of fake sensor noise"
+    )
+    parser.add_argument("--temp-setpoint", type=float, default=13.0)
+    parser.add_argument("--temp-overshoot", type=float, default=2.0)
+    parser.add_argument("--humidity-setpoint", type=float, default=80.0)
+    parser.add_argument("--humidity-overshoot", type=float, default=3.0)
+    parser.add_argument(
+        "--no-humidity", action="store_true", help="run with ControlHumidity off"
+    )
+    parser.add_argument(
+        "--compressor-idle", type=float, help="compressor minimum off time in seconds"
+    )
+    parser.add_argument("--ambient-temp", type=float, default=21.0)
+    parser.add_argument("--ambient-humidity", type=float, default=50.0)
+    parser.add_argument("--cooling-power", type=float, default=60.0, help="W")
+    parser.add_argument("--heating-power", type=float, default=40.0, help="W")
+    parser.add_argument(
+        "--cooling-lag", type=float, default=0.0, help="evaporator coil time constant, s"
+    )
+    parser.add_argument(
+        "--control-mode",
+        choices=["hysteresis", "predictive"],
+        default=CONST.CONTROL_MODE,
+        help="CONTROL_MODE, predictive runs the compressor off a learned model",
+    )
+    parser.add_argument(
+        "--door-openings", type=float, default=0.0, help="door openings per day"
+    )
+    parser.add_argument(
+        "--drift-sensor", help="name of a sensor (see AHT20_SENSOR_NAMES) that drifts"
+    )
+    parser.add_argument(
+        "--drift-rate", type=float, default=0.05, help="its temperature drift, C per day"
+    )
+    parser.add_argument(
+        "--estimator",
+        action="store_true",
+        help="control on the filtered estimate (CHAMBER_ESTIMATOR) instead of the quorum average",
+    )
+    parser.add_argument("--db", help="keep the simulated ENVIROLOG/EVENTLOG in this DB")
+    args = parser.parse_args()
+
+    CONST.CHAMBER_ESTIMATOR = args.estimator
+    CONST.CONTROL_MODE = args.control_mode
+    if args.compressor_idle is not None:
+        CONST.MINIMUM_OFF_TIME = dict(CONST.MINIMUM_OFF_TIME, cooling=args.compressor_idle)
+    scratch = tempfile.TemporaryDirectory()
+    db_file = args.db or os.path.join(scratch.name, "simulate.db")
+
+    model = ChamberModel(
+        temperature=args.temp_setpoint,
+        humidity=args.humidity_setpoint,
+        ambient_temperature=args.ambient_temp,
+        ambient_humidity=args.ambient_humidity,
+        cooling_power=args.cooling_power,
+        cooling_lag=args.cooling_lag,
+        heating_power=args.heating_power,
+        door_openings_per_day=args.door_openings,
+        seed=args.seed,
+    )
+    simulator = ChamberSimulator(model, start=time.time())
+    network, sensors, relay_board = build_chamber_network(
+        CONST, noise=args.noise, conversion_time=0.0, clock=simulator.time, seed=args.seed
+    )
+    simulator.attach(sensors, relay_board, CONST.RELAY_NUM)
+    recorder = RelayRecorder(CONST.RELAY_NUM, simulator.time)
+    relay_board.listeners.append(recorder.on_change)
+
+    # The real I2C path with every hardware delay zeroed, time only passes in sleep()
+    I2C.BUS_MANAGER.set_bus_factory(network.get_bus_factory())
+    SBCuterie.mux.settle_time = 0
+    SBCuterie.aht20_poll_strategy.initial_wait = 0
+    SBCuterie.aht20_poll_strategy.poll_interval = 0
+    SBCuterie.get_relay().settle_time = 0
+    scheduler = TimerScheduler(clock=simulator.time, sleep=simulator.sleep)
+    SBCuterie.actuator_timers = ActuatorTimers(
+        scheduler, SBCuterie.set_device_status, SBCuterie.apply_device_status
+    )
+    SBCuterie.log_writer = LogWriter(
+        db_file, synchronous="OFF", clock=simulator.time, auto_flush=False
+    )
+    SBCuterie.sensor_bias = SensorBiasTracker(
+        SBCuterie.log_writer,
+        limits={
+            "Temperature": CONST.MAX_TEMP_SENSOR_DRIFT,
+            "Humidity": CONST.MAX_HUMI_SENSOR_DRIFT,
+        },
+        bias_half_life=CONST.SENSOR_BIAS_HALF_LIFE,
+        drift_half_life=CONST.SENSOR_DRIFT_HALF_LIFE,
+        horizon=CONST.SENSOR_DRIFT_HORIZON,
+        apply_offsets=CONST.SENSOR_BIAS_APPLY_OFFSETS,
+        clock=simulator.time,
+    )
+    SBCuterie.chamber_estimator = ChamberEstimator(
+        CONST.ESTIMATOR_SENSOR_NOISE,
+        CONST.ESTIMATOR_PROCESS_NOISE,
+        confidence=CONST.ESTIMATOR_CONFIDENCE,
+        max_gap=10 * CONST.SLEEP_SECONDS,
+        clock=simulator.time,
+    )
+    drifting = None
+    if args.drift_sensor:
+        drifting = sensors[CONST.AHT20_SENSOR_NAMES.index(args.drift_sensor)]
+    alerts = []  # (time, subject), counted rather than mailed
+    SBCuterie.send_alert = lambda subject, body: alerts.append((simulator.time(), subject))
+
+    settings = {
+        "CurrentTempSetPoint": args.temp_setpoint,
+        "CurrentTempMaxOvershoot": args.temp_overshoot,
+        "CurrentHumiditySetpoint": args.humidity_setpoint,
+        "CurrentHumidityMaxOvershoot": args.humidity_overshoot,
+        "ControlHumidity": "NO" if args.no_humidity else "YES",
+    }
+
+    def restart():
+        # As at startup: everything off and the compressor waits out its minimum off time
+        SBCuterie.shutdown_devices()
+        SBCuterie.chamber_estimator.reset()
+        for device, seconds in CONST.MINIMUM_OFF_TIME.items():
+            SBCuterie.actuator_timers.lock_out(device, seconds)
+
+    SBCuterie.sensor_registry.initialize_all(CONST.AHT20_MUX_CHANS)
+    restart()
+    controller = build_controller(
+        CONST, settings, clock=simulator.time, lockout=SBCuterie.device_locked_out
+    )
+
+    temp_error = ErrorStats()
+    humidity_error = ErrorStats()
+    sensed_error = ErrorStats()  # What the controller was given against the true temperature
+    panics = 0
+    ticks = 0
+    first_rejected = None  # When quorum first threw a sensor's temperature out
+    begin = simulator.time()
+    end = begin + args.days * 86400
+    due = begin
+    started = time.perf_counter()
+    while simulator.time() < end:
+        if drifting is not None:
+            drifting.temperature_offset = args.drift_rate * (simulator.time() - begin) / 86400
+        reading = SBCuterie.get_sensor_data()
+        if first_rejected is None and reading[1].startswith("Sensor"):
+            first_rejected = simulator.time()
+        temp_error.add(model.temperature, controller.temp_setpoint, controller.temp_overshoot)
+        if reading[1] != "No Sensors Agree":
+            sensed_error.add(reading[2], model.temperature, 0.1)
+        humidity_error.add(
+            model.humidity, controller.humidity_setpoint, controller.humidity_overshoot
+        )
+        if SBCuterie.control_step(controller, reading, simulator.time()):
+            # The real controller exits and is restarted
+            panics += 1
+            restart()
+            controller.reset()
+        SBCuterie.log_writer.maybe_flush()
+        ticks += 1
+        due += CONST.SLEEP_SECONDS
+        scheduler.run_until(due, after=SBCuterie.apply_device_status)
+    elapsed = time.perf_counter() - started
+    recorder.finish()
+    duty = SBCuterie.log_writer.query_duty(begin, end)
+    SBCuterie.close_logs()
+
+    hours = args.days * 24
+    print(
+        "Simulated {:.1f} days ({} ticks) in {:.2f} s, {:.0f}x real time".format(
+            args.days, ticks, elapsed, hours * 3600 / elapsed
+        )
+    )
+    for name, stats, setpoint, band, unit in (
+        ("temperature", temp_error, args.temp_setpoint, args.temp_overshoot, "C"),
+        ("humidity", humidity_error, args.humidity_setpoint, args.humidity_overshoot, "%"),
+    ):
+        error = stats.as_dict()
+        print(
+            "{:12s} {} +/- {} {}: error mean {:+.2f}  mean abs {:.2f}  rms {:.2f}"
+            "  max {:.2f}  in band {:.1f}%".format(
+                name,
+                setpoint,
+                band,
+                unit,
+                error["mean"],
+                error["mean_abs"],
+                error["rms"],
+                error["max_abs"],
+                100 * error["in_band"],
+            )
+        )
+    error = sensed_error.as_dict()
+    print(
+        "sensed temperature ({}) vs true: rms {:.3f}  max {:.2f}  within 0.1 C {:.1f}%".format(
+            "estimate" if args.estimator else "quorum average",
+            error["rms"],
+            error["max_abs"],
+            100 * error["in_band"],
+        )
+    )
+    if args.estimator:
+        print(
+            "band edges inside the confidence interval, not switched: temperature {} "
+            "ticks, humidity {} ticks".format(
+                controller.held["Temperature"], controller.held["Humidity"]
+            )
+        )
+    for device in CONST.RELAY_NUM:
+        shortest_off = recorder.shortest_off.get(device)
+        print(
+            "{:13s} starts {:6d} ({:5.2f}/h)  toggles {:6d}  on {:5.1f}%{}".format(
+                device,
+                recorder.starts[device],
+                recorder.starts[device] / hours,
+                recorder.toggles[device],
+                100 * recorder.on_time[device] / (hours * 3600),
+                ""
+                if shortest_off is None
+                else "  shortest off {:.0f} s".format(shortest_off),
+            )
+        )
+    print(
+        "relay board writes {}  product water loss {:.0f} g  door openings {}"
+        "  alerts {}  panics {}".format(
+            relay_board.write_count,
+            model.product_loss,
+            model.door_openings,
+            len(alerts),
+            panics,
+        )
+    )
+    # The same from the duty buckets the relay layer kept (see modules/duty.py)
+    totals = {}
+    for _, device, seconds, starts, _ in duty:
+        total = totals.setdefault(device, [0.0, 0])
+        total[0] += seconds
+        total[1] += starts
+    for device, (seconds, starts) in sorted(totals.items()):
+        print(
+            "{:13s} duty log per day: on {:5.0f} min  starts {:6.1f}".format(
+                device, seconds / 60 / args.days, starts / args.days
+            )
+        )
+    if controller.model is not None:
+        fitted = controller.model.summary()["Temperature"]
+        print(
+            "temperature model: cooling {:+.5f} C/s  heating {:+.5f} C/s  lag {} s"
+            "  samples {}{}".format(
+                fitted["cooling"],
+                fitted["heating"],
+                fitted["lag"],
+                fitted["samples"],
+                "" if controller.model.ready() else "  (not trusted)",
+            )
+        )
+    degrading = [when for when, subject in alerts if subject == "Chamber Sensor Degrading"]
+    for what, when in (
+        ("sensor degrading alert", degrading[0] if degrading else None),
+        ("temperature quorum rejected a sensor", first_rejected),
+    ):
+        if when is not None:
+            print("first {} after {:.1f} days".format(what, (when - begin) / 86400))
+    for stats in SBCuterie.get_sensor_bias().summary():
+        if stats["degrading"] or stats["sensor"] == args.drift_sensor:
+            print(
+                "sensor {} {}: bias {:+.2f}  drift {:+.3f}/day  std {:.2f}  {}".format(
+                    stats["sensor"],
+                    stats["quantity"],
+                    stats["bias"],
+                    stats["drift_per_day"],
+                    stats["std"],
+                    ", ".join(stats["degrading"]) or "ok",
+                )
+            )
+    scratch.cleanup()
+
+
+if __name__ == "__main__":
+    main()
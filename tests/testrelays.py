@@ -7,6 +7,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 import controller.modules.const as CONST  # Operating Values that may need to be tweaked moved to separate file in includes.
 from controller.modules.AHT20 import AHT20  # Lib for AHT20 sensors
 import controller.modules.TCA9548A as TCA9548  # Lib for I2C MUX
+from controller.modules.quorum import quorum, reading  # N sensor agreement
 from controller.modules.grove_i2c_relay_regular import RELAY  # Lib for I2C relays
 
 
@@ -53,77 +54,21 @@ def get_sensor_data():
 
     last_sensor_read_time = datetime.datetime.now()
 
-    temp_check = quorum_check(
-        sensor_a_temp, sensor_b_temp, sensor_c_temp, CONST.MAX_TEMP_SENSOR_DRIFT
+    temps = [sensor_a_temp, sensor_b_temp, sensor_c_temp]
+    hums = [sensor_a_hum, sensor_b_hum, sensor_c_hum]
+    return_temp_code, return_temp = reading(
+        "Temperature",
+        quorum(temps, CONST.MAX_TEMP_SENSOR_DRIFT),
+        CONST.AHT20_SENSOR_NAMES,
+        temps,
     )
-    hum_check = quorum_check(
-        sensor_a_hum, sensor_b_hum, sensor_c_hum, CONST.MAX_HUMI_SENSOR_DRIFT
+    return_hum_code, return_hum = reading(
+        "Humidity",
+        quorum(hums, CONST.MAX_HUMI_SENSOR_DRIFT),
+        CONST.AHT20_SENSOR_NAMES,
+        hums,
     )
 
-    if temp_check[0] == 0:
-        # All sensors agree
-        return_temp = temp_check[1]
-        return_temp_code = "Good"
-    if temp_check[0] == 1:
-        # Sensor X Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor X Disagrees"
-        sys.stderr.write("Temperature Sensor X disagrees with other two.")
-    if temp_check[0] == 2:
-        # Sensor Y Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor Y Disagrees"
-        sys.stderr.write("Temperature Sensor Y disagrees with other two.")
-    if temp_check[0] == 3:
-        # Sensor Z Bad
-        return_temp = temp_check[1]
-        return_temp_code = "Sensor Z Disagrees"
-        sys.stderr.write("Temperature Sensor Z disagrees with other two.")
-    if temp_check[0] == 4:
-        # No sensors agree
-        return_temp = 0
-        return_temp_code = "No Sensors Agree"
-        sys.stderr.write("None of the Termperature Sensors agree.")
-    if temp_check[0] == 5:
-        # 2 pair agreement, spread > MAX_DRIFT but average usable
-        return_temp = temp_check[1]
-        return_temp_code = "Large Spread"
-        sys.stderr.write(
-            "Range Across All Temperature Sensors exceeds max delta but pairs good."
-        )
-
-    if hum_check[0] == 0:
-        # All sensors agree
-        return_hum = hum_check[1]
-        return_hum_code = "Good"
-    if hum_check[0] == 1:
-        # Sensor X Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor X Disagrees"
-        sys.stderr.write("Humidity Sensor X disagrees with other two.")
-    if hum_check[0] == 2:
-        # Sensor Y Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor Y Disagrees"
-        sys.stderr.write("Humidity Sensor Y disagrees with other two.")
-    if hum_check[0] == 3:
-        # Sensor Z Bad
-        return_hum = hum_check[1]
-        return_hum_code = "Sensor Z Disagrees"
-        sys.stderr.write("Humidity Sensor Z disagrees with other two.")
-    if hum_check[0] == 4:
-        # No sensors agree
-        return_hum = 0
-        return_hum_code = "No Sensors Agree"
-        sys.stderr.write("None of the Humidity Sensors agree.")
-    if hum_check[0] == 5:
-        # 2 pair agreement, spread > MAX_DRIFT but average usable
-        return_hum = hum_check[1]
-        return_hum_code = "Large Spread"
-        sys.stderr.write(
-            "Range Across All Humidity Sensors exceeds max delta but pairs good."
-        )
-
     return (
         last_sensor_read_time,
         return_temp_code,